@@ -1,11 +1,33 @@
-from election_anomaly import db_routines as dbr
-from election_anomaly import user_interface as ui
-from sqlalchemy.orm import sessionmaker
+import importlib.util
 import os
 from pprint import pprint
 import sys
 import ntpath
-from election_anomaly import analyze_via_pandas as avp
+import time
+
+
+def lazy_import(name):
+    """Returns the module <name>, whose code (and so the import of pandas, sqlalchemy, etc.)
+    runs only when one of its attributes is first used. Importing the package thus stays cheap
+    for, e.g., worker processes that need only one submodule."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    parent, child = name.rsplit('.',1)
+    setattr(sys.modules[parent],child,module)
+    loader.exec_module(module)
+    return module
+
+
+dbr = lazy_import('election_anomaly.db_routines')
+ui = lazy_import('election_anomaly.user_interface')
+avp = lazy_import('election_anomaly.analyze_via_pandas')
+avd = lazy_import('election_anomaly.analyze_via_duckdb')
+anom = lazy_import('election_anomaly.anomaly_scores')
 
 class DataLoader():
     def __new__(self):
@@ -53,6 +75,7 @@ class DataLoader():
         # connect to db
         self.engine = dbr.sql_alchemy_connect(paramfile=self.d['db_paramfile'],
             db_name=self.d['db_name'])
+        from sqlalchemy.orm import sessionmaker
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
 
@@ -68,6 +91,13 @@ class DataLoader():
             mungers_dir=os.path.join(self.d['project_root'],'mungers'),
             session=self.session,munger_name=self.d['munger_name'])
 
+        self.mirror = get_mirror()
+
+        # state of watch mode
+        self.watch_hashes = {}
+        self.watch_log = []
+        self.latest_scores = {}
+
     
     def check_errors(self):
         juris_exists = None
@@ -81,8 +111,6 @@ class DataLoader():
     def reload_requirements(self):
         if self.session:
             self.session.close()
-        if self.engine:
-            self.engine.dispose()
 
         self.d, self.parameter_err = ui.get_runtime_parameters(
             ['project_root','juris_name','db_paramfile',
@@ -100,10 +128,11 @@ class DataLoader():
             dbr.create_new_db(self.d['project_root'], self.d['db_paramfile'], 
                 self.d['db_name'])
 
-        # connect to db
-        eng = dbr.sql_alchemy_connect(paramfile=self.d['db_paramfile'],
+        # connect to db (reusing the engine, if the database is unchanged)
+        self.engine = dbr.sql_alchemy_connect(paramfile=self.d['db_paramfile'],
             db_name=self.d['db_name'])
-        Session = sessionmaker(bind=eng)
+        from sqlalchemy.orm import sessionmaker
+        Session = sessionmaker(bind=self.engine)
         self.session = Session()
 
         self.juris_load_err = self.juris.load_juris_to_db(self.session,
@@ -127,6 +156,7 @@ class DataLoader():
 
         else:
             dbr.save_one_to_db(self.session, '_datafile', db_style_record, True)
+            avp.rollup_cache.invalidate(db_style_record['Election_Id'])
 
 
     def load_results(self):
@@ -134,6 +164,155 @@ class DataLoader():
         ui.new_datafile(self.session, self.munger, self.d['results_file'],
             juris=self.juris, project_root=self.d['project_root'], 
             results_info=results_info)
+        # rollups calculated before this load are out of date
+        avp.rollup_cache.invalidate(results_info[1])
+        self.sync_mirror()
+
+
+    def sync_mirror(self):
+        """Brings the DuckDB mirror (if any) up to date; if another process keeps it busy,
+        leaves it for the next sync (every rollup from the mirror syncs first)"""
+        if self.mirror:
+            try:
+                self.mirror.sync(self.session)
+            except avd.MirrorBusy as e:
+                print(f'{e}; not synced')
+
+
+    def watch(self, drop_dir, election, rollups=None, interval=30, settle_seconds=2, max_polls=None):
+        """Watches <drop_dir> for new or changed results files (e.g., as counties
+        re-publish during the count). Each new or changed file (detected by content
+        hash) is munged with this DataLoader's munger and replaces the VoteCounts
+        previously loaded from the file of the same name; the jurisdiction is not
+        reloaded. After each update, the rollups in <rollups>, a list of
+        (top ReportingUnit, ReportingUnitType) pairs such as
+        [('Pennsylvania;Philadelphia','ward')], are refreshed in the rollup directory
+        and their anomaly scores recalculated (see self.latest_scores).
+        Polls every <interval> seconds until interrupted (or for <max_polls> polls);
+        files modified less than <settle_seconds> ago are left for the next poll.
+        Returns a list with one dictionary of timings per update; 'latency' is the
+        number of seconds from the file's last modification to the refreshed rollups.
+        A file that fails to load is recorded in self.watch_log (with the 'error') and
+        not tried again until it changes; the watch carries on with the other files.
+        Raises an exception, before watching, if the election, the top_reporting_unit
+        or any of the <rollups> is not in the database."""
+        # check every name now, rather than failing on each file dropped
+        unknown = []
+        election_id = dbr.name_to_id(self.session, 'Election', election)
+        if election_id is None:
+            unknown.append(f'Election {election}')
+        if dbr.name_to_id(self.session, 'ReportingUnit', self.d['top_reporting_unit']) is None:
+            unknown.append(f'ReportingUnit {self.d["top_reporting_unit"]} (top_reporting_unit)')
+        rollup_d = {}
+        if rollups:
+            d, error = ui.get_runtime_parameters(['rollup_directory'])
+            if error:
+                print("Parameter file missing requirements.")
+                print(error)
+                print("Not watching.")
+                return []
+            rollup_dir = d['rollup_directory']
+            for top_ru, sub_rutype in rollups:
+                top_ru_id = dbr.name_to_id(self.session, 'ReportingUnit', top_ru)
+                sub_rutype_id = dbr.name_to_id(self.session, 'ReportingUnitType', sub_rutype)
+                if top_ru_id is None:
+                    unknown.append(f'ReportingUnit {top_ru}')
+                if sub_rutype_id is None:
+                    unknown.append(f'ReportingUnitType {sub_rutype}')
+                rollup_d.setdefault(top_ru_id, []).append((sub_rutype_id, ''))
+        else:
+            rollup_dir = None
+        if unknown:
+            raise Exception(f'Not in database: {"; ".join(unknown)}. Not watching.')
+
+        updates = []
+        polls = 0
+        print(f'Watching {drop_dir} for results files. Interrupt (Ctrl-C) to stop.')
+        try:
+            while max_polls is None or polls < max_polls:
+                polls += 1
+                for f in sorted(os.listdir(drop_dir)):
+                    path = os.path.join(drop_dir, f)
+                    if f.startswith('.') or not os.path.isfile(path):
+                        continue
+                    dropped_at = os.path.getmtime(path)
+                    if time.time() - dropped_at < settle_seconds:
+                        # file may still be being written
+                        continue
+                    content_hash = ui.file_hash(path)
+                    if self.watch_hashes.get(path) == content_hash:
+                        continue
+                    try:
+                        updates.append(self.replace_results(
+                            path, election_id, rollup_d, rollup_dir, dropped_at))
+                    except Exception as e:
+                        # one bad file shouldn't stop the watch; it is retried only once changed
+                        self.watch_log.append({'file': f, 'error': repr(e)})
+                        print(f'{f}: not loaded ({e!r}); watching for a corrected version')
+                    self.watch_hashes[path] = content_hash
+                if max_polls is None or polls < max_polls:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+        return updates
+
+
+    def replace_results(self, path, election_id, rollup_d, rollup_dir, dropped_at):
+        """Replaces the VoteCounts from the results file <path> and refreshes
+        the rollups in <rollup_d> (top ReportingUnit Id -> list of sub-ReportingUnitTypes).
+        The new results are loaded beside the old ones, then swapped in (see dbr.replace_datafile);
+        if nothing could be loaded, the old results are kept.
+        Returns a dictionary of timings (in seconds)"""
+        file_name = get_filename(path)
+        start = time.time()
+        try:
+            old_id = dbr.get_datafile_info(self.session, file_name)[0]
+            datafile_id = dbr.stage_datafile(self.session, old_id)
+        except IndexError:
+            old_id = None
+            record = {
+                'short_name': os.path.splitext(file_name)[0],
+                'file_name': file_name,
+                'ReportingUnit_Id': dbr.name_to_id(self.session, 'ReportingUnit', self.d['top_reporting_unit']),
+                'Election_Id': election_id}
+            # (not save_one_to_db, which asks the user what to do about a duplicate)
+            datafile_id = dbr.insert_record(self.session, '_datafile', record)
+        try:
+            ui.new_datafile(self.session, self.munger, path, juris=self.juris,
+                project_root=self.d['project_root'], results_info=(datafile_id, election_id), load_juris=False)
+        except Exception:
+            # don't leave the staged copy (or, for a new file, a datafile without results) behind
+            self.session.rollback()
+            dbr.remove_datafile(self.session, datafile_id)
+            raise
+        loaded = dict(avp.datafile_stamp(self.session, election_id)).get(int(datafile_id), 0)
+        removed = 0
+        if old_id is not None and loaded:
+            removed = dbr.replace_datafile(self.session, old_id, datafile_id)['VoteCount']
+        elif old_id is not None:
+            dbr.remove_datafile(self.session, datafile_id)
+            print(f'{file_name}: no vote counts loaded; previous results kept')
+        avp.rollup_cache.invalidate(election_id)
+        self.sync_mirror()
+        munged = time.time()
+
+        for top_ru_id, sub_rutype_list in rollup_d.items():
+            rollups = avp.create_rollups(self.session, rollup_dir, top_ru_id, sub_rutype_list,
+                election_id, variants=['by_vote_type'], cache=avp.rollup_cache, overwrite=True, mirror=self.mirror)
+            top_ru = dbr.name_from_id(self.session, 'ReportingUnit', top_ru_id)
+            for (sub_rutype, variant), rollup in rollups.items():
+                self.latest_scores[(top_ru, sub_rutype)] = {
+                    'vote_share': anom.vote_share_scores(rollup),
+                    'vote_type': anom.vote_type_divergence(rollup)}
+        done = time.time()
+
+        timings = {
+            'file': file_name, 'vote_counts_removed': removed, 'vote_counts_loaded': loaded,
+            'munge': munged - start, 'rollups': done - munged, 'latency': done - dropped_at}
+        self.watch_log.append(timings)
+        print(f'{file_name}: {loaded} vote counts loaded ({removed} replaced); '
+            f'rollups refreshed {timings["latency"]:.1f} seconds after file drop')
+        return timings
 
 
 class Analyzer():
@@ -164,9 +343,17 @@ class Analyzer():
 
         eng = dbr.sql_alchemy_connect(paramfile=self.d['db_paramfile'],
             db_name=self.d['db_name'])
+        from sqlalchemy.orm import sessionmaker
         Session = sessionmaker(bind=eng)
         self.session = Session()
 
+        # optional on-disk tier for the rollup cache
+        cache_d, cache_err = ui.get_runtime_parameters(['rollup_cache_directory'])
+        if not cache_err:
+            avp.rollup_cache.cache_dir = cache_d['rollup_cache_directory']
+
+        self.mirror = get_mirror()
+
 
     def display_options(self, input):
         results = dbr.get_input_options(self.session, input)
@@ -188,7 +375,7 @@ class Analyzer():
             results_info = dbr.get_datafile_info(self.session, self.d['results_file_short'])
             rollup = avp.create_rollup(self.session, d['rollup_directory'], top_ru_id=rollup_unit_id,
                 sub_rutype_id=sub_unit_id, sub_rutype_othertext='', datafile_id_list=results_info[0], 
-                election_id=results_info[1])
+                election_id=results_info[1], cache=avp.rollup_cache, mirror=self.mirror)
             return
 
 
@@ -205,8 +392,107 @@ class Analyzer():
             results_info = dbr.get_datafile_info(self.session, self.d['results_file_short'])
             rollup = avp.create_rollup(self.session, d['rollup_directory'], top_ru_id=rollup_unit_id,
                 sub_rutype_id=sub_unit_id, sub_rutype_othertext='', datafile_id_list=results_info[0], 
-                election_id=results_info[1], by_vote_type=False)
+                election_id=results_info[1], by_vote_type=False, cache=avp.rollup_cache,
+                mirror=self.mirror)
+            return
+
+
+    def top_counts_multi_level(self, rollup_unit, sub_units, by_vote_type=True, totals=True):
+        """Rollups for each reporting unit type in the list <sub_units> (e.g.,
+        ['county','ward','precinct']), all computed in a single pass. Returns a dictionary
+        of the rollup dataframes, keyed by (sub_unit,variant), e.g. ('ward','total')."""
+        d, error = ui.get_runtime_parameters(['rollup_directory'])
+        if error:
+            print("Parameter file missing requirements.")
+            print(error)
+            print("Data not created.")
+            return
+        else:
+            rollup_unit_id = dbr.name_to_id(self.session, 'ReportingUnit', rollup_unit)
+            sub_rutype_list = [(dbr.name_to_id(self.session, 'ReportingUnitType', s), '') for s in sub_units]
+            results_info = dbr.get_datafile_info(self.session, self.d['results_file_short'])
+            variants = []
+            if by_vote_type:
+                variants.append('by_vote_type')
+            if totals:
+                variants.append('total')
+            rollups = avp.create_rollups(self.session, d['rollup_directory'], rollup_unit_id,
+                sub_rutype_list, results_info[1], variants=variants, cache=avp.rollup_cache, mirror=self.mirror)
+            return rollups
+
+
+    def vote_share_anomalies(self, rollup_unit, sub_unit, by_vote_type=False, min_total=0, processes=None):
+        """Outlier scores for the vote share of each selection in each <sub_unit>
+        (e.g., 'precinct') of <rollup_unit>, most anomalous first.
+        If <processes> is greater than 1, contests are scored in parallel."""
+        d, error = ui.get_runtime_parameters(['rollup_directory'])
+        if error:
+            print("Parameter file missing requirements.")
+            print(error)
+            print("Data not created.")
+            return
+        else:
+            rollup_unit_id = dbr.name_to_id(self.session, 'ReportingUnit', rollup_unit)
+            sub_unit_id = dbr.name_to_id(self.session, 'ReportingUnitType', sub_unit)
+            results_info = dbr.get_datafile_info(self.session, self.d['results_file_short'])
+            rollup = avp.create_rollup(self.session, d['rollup_directory'], top_ru_id=rollup_unit_id,
+                sub_rutype_id=sub_unit_id, sub_rutype_othertext='', datafile_id_list=results_info[0],
+                election_id=results_info[1], by_vote_type=by_vote_type, cache=avp.rollup_cache, mirror=self.mirror)
+            return anom.vote_share_scores(rollup, by_vote_type=by_vote_type, min_total=min_total,
+                processes=processes)
+
+
+    def vote_type_anomalies(self, rollup_unit, sub_unit, min_total=0, n=None):
+        """For each selection, compares the mix of vote types in each <sub_unit>
+        of <rollup_unit> to the mix in the other <sub_unit>s with the same parent,
+        most divergent first"""
+        d, error = ui.get_runtime_parameters(['rollup_directory'])
+        if error:
+            print("Parameter file missing requirements.")
+            print(error)
+            print("Data not created.")
             return
+        else:
+            rollup_unit_id = dbr.name_to_id(self.session, 'ReportingUnit', rollup_unit)
+            sub_unit_id = dbr.name_to_id(self.session, 'ReportingUnitType', sub_unit)
+            results_info = dbr.get_datafile_info(self.session, self.d['results_file_short'])
+            rollup = avp.create_rollup(self.session, d['rollup_directory'], top_ru_id=rollup_unit_id,
+                sub_rutype_id=sub_unit_id, sub_rutype_othertext='', datafile_id_list=results_info[0],
+                election_id=results_info[1], by_vote_type=True, cache=avp.rollup_cache, mirror=self.mirror)
+            return anom.vote_type_divergence(rollup, min_total=min_total, n=n)
+
+
+    def export_parquet(self, election):
+        """Export all vote counts for <election> (e.g., '2018 General') to a
+        Parquet dataset in the rollup directory"""
+        d, error = ui.get_runtime_parameters(['rollup_directory'])
+        if error:
+            print("Parameter file missing requirements.")
+            print(error)
+            print("Data not created.")
+            return
+        else:
+            election_id = dbr.name_to_id(self.session, 'Election', election)
+            avp.export_election_to_parquet(self.session, d['rollup_directory'], election_id)
+            return
+
+
+    def pool_statistics(self):
+        """Connection pool counts for each database engine in use"""
+        return dbr.pool_statistics()
+
+
+    def rollup_cache_statistics(self):
+        """Hit/miss counts and memory use of the rollup cache"""
+        return avp.rollup_cache.statistics()
+
+
+def get_mirror():
+    """Returns the DuckDB mirror given by the optional parameter duckdb_file, or None"""
+    d, error = ui.get_runtime_parameters(['duckdb_file'])
+    if error:
+        return None
+    return avd.get_mirror(d['duckdb_file'])
 
 
 def get_filename(path):
@@ -0,0 +1,267 @@
+import os
+import time
+import pandas as pd
+from pathlib import Path
+
+
+# tables copied whole (or, when only new rows have been added, by appending the new rows)
+dimension_tables = [
+	'ReportingUnit','ComposingReportingUnitJoin','ReportingUnitType','CountItemType','Election',
+	'ElectionContestJoin','CandidateContestSelectionJoin','CandidateContest','CandidateSelection','Candidate',
+	'Office','BallotMeasureContestSelectionJoin','BallotMeasureContest','BallotMeasureSelection']
+
+# one row per ElectionContestSelectionVoteCountJoin record, with its VoteCount attached
+fact_table_ddl = """
+	CREATE TABLE IF NOT EXISTS vote_count (
+		"Id" BIGINT PRIMARY KEY,
+		"_datafile_Id" BIGINT,
+		"ElectionContestJoin_Id" BIGINT,
+		"ContestSelectionJoin_Id" BIGINT,
+		"VoteCount_Id" BIGINT,
+		"Count" BIGINT,
+		"CountItemType_Id" BIGINT,
+		"OtherCountItemType" VARCHAR,
+		"ReportingUnit_Id" BIGINT)"""
+
+# ContestSelectionJoin Id -> contest and selection names (cf. analyze_via_pandas.contest_selection_from_tables)
+contest_selection_sql = """
+	SELECT ccsj."Id" AS "ContestSelectionJoin_Id", cc."Id" AS "Contest_Id", cc."Name" AS "Contest",
+		can."BallotName" AS "Selection", o."ElectionDistrict_Id", 'Candidate' AS contest_type
+	FROM "CandidateContestSelectionJoin" ccsj
+	LEFT JOIN "CandidateContest" cc ON ccsj."CandidateContest_Id" = cc."Id"
+	LEFT JOIN "CandidateSelection" cs ON ccsj."CandidateSelection_Id" = cs."Id"
+	LEFT JOIN "Candidate" can ON cs."Candidate_Id" = can."Id"
+	LEFT JOIN "Office" o ON cc."Office_Id" = o."Id"
+	UNION ALL
+	SELECT bmcsj."Id", bmc."Id", bmc."Name", bms."Selection", bmc."ElectionDistrict_Id", 'BallotMeasure'
+	FROM "BallotMeasureContestSelectionJoin" bmcsj
+	LEFT JOIN "BallotMeasureContest" bmc ON bmcsj."BallotMeasureContest_Id" = bmc."Id"
+	LEFT JOIN "BallotMeasureSelection" bms ON bmcsj."BallotMeasureSelection_Id" = bms."Id"
+"""
+
+
+class Mirror:
+	"""Columnar copy, in the DuckDB file <path>, of the VoteCounts and of the tables needed to roll them up
+	(requires duckdb). The copy is brought up to date by sync(), which copies only what has changed:
+	the vote counts of each datafile whose records were added, replaced or deleted since the last sync,
+	and each other table whose row count or largest Id has changed.
+	Rows changed in place (same Id) in the other tables are not noticed; use sync(session,full=True).
+	The file is opened only for each sync or rollup, and closed after, so that several processes
+	(e.g., a DataLoader watching for results and an Analyzer) can share it. DuckDB lets only one process
+	at a time have the file open for writing, so each waits up to <lock_timeout> seconds for the others;
+	after that, MirrorBusy is raised."""
+	def __init__(self,path,lock_timeout=10):
+		self.path = path
+		self.lock_timeout = lock_timeout
+
+	def connect(self,read_only=False):
+		"""Returns a new connection to the mirror (to be closed by the caller), creating the mirror's
+		tables unless <read_only>"""
+		import duckdb
+		Path(os.path.dirname(os.path.abspath(self.path))).mkdir(parents=True,exist_ok=True)
+		deadline = time.monotonic() + self.lock_timeout
+		while True:
+			try:
+				con = duckdb.connect(self.path,read_only=read_only)
+				break
+			except duckdb.IOException as e:
+				if 'lock' not in str(e).lower():
+					raise
+				if time.monotonic() > deadline:
+					raise MirrorBusy(f'DuckDB mirror {self.path} is in use by another process: {e}')
+				time.sleep(0.1)
+		if not read_only:
+			con.execute(fact_table_ddl)
+			con.execute("""
+				CREATE TABLE IF NOT EXISTS _mirror_stamp (
+					table_name VARCHAR PRIMARY KEY, row_count BIGINT, max_id BIGINT)""")
+			con.execute('CREATE TABLE IF NOT EXISTS _mirror_source (url VARCHAR)')
+		return con
+
+	def close(self):
+		"""Nothing to do: connections are closed after each sync or rollup (kept for existing callers)"""
+		pass
+
+	def sync(self,session,full=False,batch_size=100000):
+		"""Bring the mirror up to date with the database of <session>.
+		Returns a dictionary of the number of rows copied, by table"""
+		con = self.connect()
+		try:
+			# a mirror of some other database is replaced entirely
+			url = str(session.bind.url)
+			if con.execute('SELECT url FROM _mirror_source').fetchall() != [(url,)]:
+				full = True
+				con.execute('DELETE FROM _mirror_source')
+				con.execute('INSERT INTO _mirror_source VALUES (?)',[url])
+			copied = {}
+			for table in dimension_tables:
+				copied[table] = self.sync_table(con,session,table,full=full)
+			copied['vote_count'] = self.sync_vote_counts(con,session,full=full,batch_size=batch_size)
+		finally:
+			con.close()
+		return copied
+
+	def sync_table(self,con,session,table,full=False):
+		row_count, max_id = session.execute(f'SELECT count(*), max("Id") FROM "{table}"').fetchone()
+		old = con.execute(
+			'SELECT row_count, max_id FROM _mirror_stamp WHERE table_name = ?',[table]).fetchone()
+		if not full and old is not None and (old[0],old[1]) == (row_count,max_id):
+			return 0
+
+		new_rows = None
+		if not full and old is not None and old[1] is not None:
+			new_rows = pd.read_sql(f'SELECT * FROM "{table}" WHERE "Id" > {int(old[1])}',session.bind)
+			if len(new_rows) != row_count - old[0]:
+				# rows were deleted, too
+				new_rows = None
+		con.begin()
+		try:
+			if new_rows is not None:
+				con.register('incoming',new_rows)
+				con.execute(f'INSERT INTO "{table}" BY NAME SELECT * FROM incoming')
+				copied = len(new_rows)
+			else:
+				df = pd.read_sql_table(table,session.bind)
+				con.register('incoming',df)
+				con.execute(f'CREATE OR REPLACE TABLE "{table}" AS SELECT * FROM incoming')
+				copied = len(df)
+			con.unregister('incoming')
+			con.execute(
+				'INSERT OR REPLACE INTO _mirror_stamp VALUES (?, ?, ?)',[table,row_count,max_id])
+			con.commit()
+		except Exception:
+			con.rollback()
+			if new_rows is None:
+				raise
+			# e.g., new rows whose types don't fit the mirrored table; copy the whole table instead
+			return self.sync_table(con,session,table,full=True)
+		return copied
+
+	def sync_vote_counts(self,con,session,full=False,batch_size=100000):
+		"""Copies the vote counts of each datafile whose (number of records, largest record Id) differs
+		between the database and the mirror; removes those of datafiles no longer in the database.
+		Returns the number of rows copied."""
+		stamp_q = """
+			SELECT "_datafile_Id", count(*), max("Id")
+			FROM "ElectionContestSelectionVoteCountJoin"
+			GROUP BY "_datafile_Id" """
+		source = {r[0]:(int(r[1]),int(r[2])) for r in session.execute(stamp_q).fetchall()}
+		mirrored = {r[0]:(int(r[1]),int(r[2])) for r in con.execute(stamp_q.replace(
+			'"ElectionContestSelectionVoteCountJoin"','vote_count')).fetchall()}
+		stale = [d for d in set(source.keys()) | set(mirrored.keys()) if full or source.get(d) != mirrored.get(d)]
+
+		copied = 0
+		for datafile_id in stale:
+			if datafile_id is None:
+				condition = 'IS NULL'
+			else:
+				condition = f'= {int(datafile_id)}'
+			q = f"""
+				SELECT j."Id", j."_datafile_Id", j."ElectionContestJoin_Id", j."ContestSelectionJoin_Id",
+					j."VoteCount_Id", vc."Count", vc."CountItemType_Id", vc."OtherCountItemType", vc."ReportingUnit_Id"
+				FROM "ElectionContestSelectionVoteCountJoin" j
+				JOIN "VoteCount" vc ON j."VoteCount_Id" = vc."Id" AND j."_datafile_Id" = vc."_datafile_Id"
+				WHERE j."_datafile_Id" {condition}"""
+			# one transaction per datafile, so a failed sync leaves each datafile either old or new
+			con.begin()
+			try:
+				con.execute(f'DELETE FROM vote_count WHERE "_datafile_Id" {condition}')
+				if datafile_id in source.keys():
+					with session.bind.connect().execution_options(stream_results=True) as conn:
+						for batch in pd.read_sql(q,conn,chunksize=batch_size):
+							con.register('incoming',batch)
+							con.execute('INSERT INTO vote_count BY NAME SELECT * FROM incoming')
+							con.unregister('incoming')
+							copied += len(batch)
+				con.commit()
+			except Exception:
+				con.rollback()
+				raise
+		return copied
+
+	def rollup_counts(self,session,top_ru_id,sub_rutype_d,election_id):
+		"""Syncs the mirror, then returns a dataframe of vote counts for the election <election_id>, summed
+		by sub_rutype, contest_type, Contest, contest_district_type, Selection, ReportingUnit and CountItemType,
+		for the ReportingUnits nested in <top_ru_id> whose type is one of those in <sub_rutype_d>
+		(name -> (ReportingUnitType_Id, OtherReportingUnitType)). The rows are those that
+		analyze_via_pandas.create_rollups would sum, so summing the result again gives the same rollups.
+		Returns None if the mirror is kept busy by another process (see MirrorBusy)."""
+		try:
+			self.sync(session)
+			con = self.connect(read_only=True)
+		except MirrorBusy as e:
+			print(f'{e}; summing without it')
+			return None
+		try:
+			return self.rollup_counts_from(con,session,top_ru_id,sub_rutype_d,election_id)
+		finally:
+			con.close()
+
+	def rollup_counts_from(self,con,session,top_ru_id,sub_rutype_d,election_id):
+		"""rollup_counts, from the mirror open on <con> (without syncing)"""
+		requested = ' UNION ALL '.join([
+			f"""SELECT {quote(name)} AS sub_rutype, {int(rutype_id)} AS rutype_id, {quote(othertext or '')} AS othertext"""
+			for name,(rutype_id,othertext) in sub_rutype_d.items()])
+		levels = f"""
+			SELECT DISTINCT r.sub_rutype, ru."Id", ru."Name"
+			FROM "ComposingReportingUnitJoin" cruj
+			JOIN "ReportingUnit" ru ON cruj."ChildReportingUnit_Id" = ru."Id"
+			JOIN requested r ON ru."ReportingUnitType_Id" = r.rutype_id
+				AND COALESCE(ru."OtherReportingUnitType",'') = r.othertext
+			WHERE cruj."ParentReportingUnit_Id" = {int(top_ru_id)}"""
+		missing = con.execute(f"""
+			WITH requested AS ({requested}), levels AS ({levels})
+			SELECT sub_rutype FROM requested WHERE sub_rutype NOT IN (SELECT sub_rutype FROM levels)""").fetchall()
+		if missing:
+			raise Exception(
+				f'Database {session.bind.url.database} shows no ReportingUnits of type {missing[0][0]} '
+				f'nested inside ReportingUnit {top_ru_id}')
+
+		q = f"""
+			WITH requested AS ({requested}), levels AS ({levels}),
+			ecj AS (SELECT * FROM "ElectionContestJoin" WHERE "Election_Id" = {int(election_id)}),
+			cs AS ({contest_selection_sql})
+			SELECT l.sub_rutype, cs.contest_type, cs."Contest",
+				{plaintext('rut','district."OtherReportingUnitType"')} AS contest_district_type,
+				cs."Selection", l."Name" AS "ReportingUnit",
+				{plaintext('cit','vc."OtherCountItemType"')} AS "CountItemType",
+				CAST(sum(vc."Count") AS BIGINT) AS "Count"
+			FROM vote_count vc
+			JOIN "ComposingReportingUnitJoin" cruj ON vc."ReportingUnit_Id" = cruj."ChildReportingUnit_Id"
+			JOIN levels l ON cruj."ParentReportingUnit_Id" = l."Id"
+			JOIN cs ON vc."ContestSelectionJoin_Id" = cs."ContestSelectionJoin_Id"
+			JOIN "ReportingUnit" district ON cs."ElectionDistrict_Id" = district."Id"
+			JOIN "ReportingUnitType" rut ON district."ReportingUnitType_Id" = rut."Id"
+			JOIN "CountItemType" cit ON vc."CountItemType_Id" = cit."Id"
+			WHERE vc."ElectionContestJoin_Id" IN (SELECT "Id" FROM ecj)
+				AND cs."Contest_Id" IN (SELECT "Contest_Id" FROM ecj)
+				AND cs."Contest" IS NOT NULL AND cs."Selection" IS NOT NULL
+			GROUP BY ALL"""
+		return con.execute(q).df()
+
+
+class MirrorBusy(Exception):
+	"""Raised when the mirror file stays locked by another process"""
+	pass
+
+
+def plaintext(enum_alias,othertext):
+	"""SQL for the plaintext of the enumeration table <enum_alias>'s row, replaced by <othertext>
+	(if not empty) for 'other' (cf. munge_routines.plaintext_from_id_othertext)"""
+	return f"""CASE WHEN {enum_alias}."Txt" = 'other' AND COALESCE({othertext},'') != ''
+		THEN {othertext} ELSE {enum_alias}."Txt" END"""
+
+
+def quote(text):
+	"""<text> as an SQL string literal"""
+	return "'" + str(text).replace("'","''") + "'"
+
+
+# one Mirror per DuckDB file, shared by the Analyzer and the DataLoader
+mirrors = {}
+
+
+def get_mirror(path):
+	if path not in mirrors.keys():
+		mirrors[path] = Mirror(path)
+	return mirrors[path]
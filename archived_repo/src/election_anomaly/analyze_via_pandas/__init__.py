@@ -6,10 +6,10 @@ from election_anomaly import user_interface as ui
 from election_anomaly import munge_routines as mr
 import datetime
 import os
+import hashlib
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
-from pandas.api.types import is_numeric_dtype
 from election_anomaly import db_routines as dbr
 
 
@@ -31,7 +31,7 @@ def child_rus_by_id(session,parents,ru_type=None):
 
 def create_rollup(
 		session,target_dir,top_ru_id=None,sub_rutype_id=None,sub_rutype_othertext=None,election_id=None,
-		datafile_id_list=None,by_vote_type=True,exclude_total=True):
+		datafile_id_list=None,by_vote_type=True,exclude_total=True,cache=None,overwrite=False,mirror=None):
 	"""<target_dir> is the directory where the resulting rollup will be stored.
 	<election_id> identifies the election; <datafile_id_list> the datafile whose results will be rolled up.
 	<top_ru_id> is the internal cdf name of the ReportingUnit whose results will be reported
@@ -39,7 +39,10 @@ def create_rollup(
 	of the ReportingUnits used in each line of the results file
 	created by the routine. (E.g., county or ward)
 	If <exclude_total> is True, don't include 'total' CountItemType
-	(unless 'total' is the only CountItemType)"""
+	(unless 'total' is the only CountItemType)
+	If a RollupCache <cache> is given, a still-valid earlier result is exported instead of recalculated.
+	If <overwrite> is True, an existing export file is replaced without asking.
+	If an analyze_via_duckdb.Mirror <mirror> is given, the vote counts are summed there instead of in pandas."""
 	# Get name of db for error messages
 	db = session.bind.url.database
 
@@ -73,23 +76,423 @@ def create_rollup(
 	else:
 		sub_rutype = dbr.name_from_id(session, 'ReportingUnitType', sub_rutype_id)
 
-	# pull relevant tables
+	cis = 'unknown'  # TODO placeholder while CountItemStatus is unused
+	if cache is not None:
+		cache_key = cache.key(election_id,top_ru_id,sub_rutype,datafile_id_list,by_vote_type,exclude_total)
+		summed_by_name, cit = cache.get(session,cache_key)
+		if summed_by_name is not None:
+			export_rollup(session,target_dir,election,top_ru,sub_rutype,cit,cis,summed_by_name,overwrite=overwrite)
+			return summed_by_name
+
+	unsummed = None
+	if mirror is not None:
+		# sum in the analytical mirror; the sums below leave these sums unchanged
+		#  (None if another process keeps the mirror busy)
+		unsummed = mirror.rollup_counts(
+			session,top_ru_id,{sub_rutype:(sub_rutype_id,sub_rutype_othertext)},election_id)
+	if unsummed is None:
+		# pull relevant tables
+		df = pull_rollup_tables(session,election_id)
+
+		#  limit to relevant Election-Contest pairs
+		ecj = df['ElectionContestJoin'][df['ElectionContestJoin'].Election_Id == election_id]
+
+		contest_selection = contest_selection_from_tables(df)
+
+		#  limit to relevant ContestSelection pairs
+		contest_ids = ecj.Contest_Id.unique()
+		csj = contest_selection[contest_selection.Contest_Id.isin(contest_ids)]
+
+		# find ReportingUnits of the correct type that are subunits of top_ru
+		sub_ru_ids = child_rus_by_id(session,[top_ru_id],ru_type=[sub_rutype_id, sub_rutype_othertext])
+		if not sub_ru_ids:
+			# TODO better error handling (while not sub_ru_list....)
+			raise Exception(f'Database {db} shows no ReportingUnits of type {sub_rutype} nested inside {top_ru}')
+		sub_ru = df['ReportingUnit'].loc[sub_ru_ids]
+
+		# find all children of subReportingUnits
+		children_of_subs_ids = child_rus_by_id(session,sub_ru_ids)
+		ru_children = df['ReportingUnit'].loc[children_of_subs_ids]
+
+		# check for any reporting units that should be included in roll-up but were missed
+		# TODO list can be long and irrelevant. Instead list ReportingUnitTypes of the missing
+		# missing = [str(x) for x in child_rus_by_id(session,[top_ru_id]) if x not in children_of_subs_ids]
+		# if missing:
+		# TODO report these out to the export directory
+		#	ui.report_problems(missing,msg=f'The following reporting units are nested in {top_ru["Name"]} '
+		#							f'but are not nested in any {sub_rutype} nested in {top_ru["Name"]}')
+
+		# limit to relevant vote counts
+		ecsvcj = df['ElectionContestSelectionVoteCountJoin'][
+			(df['ElectionContestSelectionVoteCountJoin'].ElectionContestJoin_Id.isin(ecj.index)) &
+			(df['ElectionContestSelectionVoteCountJoin'].ContestSelectionJoin_Id.isin(csj.index))]
+
+		# calculate specified dataframe with columns [ReportingUnit,Contest,Selection,VoteCount,CountItemType]
+		#  1. create unsummed dataframe of results
+		unsummed = ecsvcj.merge(
+			df['VoteCount'],left_on='VoteCount_Id',right_index=True).merge(
+			df['ComposingReportingUnitJoin'],left_on='ReportingUnit_Id',right_on='ChildReportingUnit_Id').merge(
+			ru_children,left_on='ChildReportingUnit_Id',right_index=True).merge(
+			sub_ru,left_on='ParentReportingUnit_Id',right_index=True,suffixes=['','_Parent'])
+		unsummed.rename(columns={'Name_Parent':'ReportingUnit'},inplace=True)
+		# add columns with names
+		unsummed = mr.enum_col_from_id_othertext(unsummed,'CountItemType',df['CountItemType'])
+		unsummed = unsummed.merge(contest_selection,how='left',left_on='ContestSelectionJoin_Id',right_index=True)
+
+	if by_vote_type:
+		cit_list = unsummed['CountItemType'].unique()
+	else:
+		cit_list = ['all']
+		if exclude_total:
+			unsummed = unsummed[unsummed.CountItemType != 'total']
+	if len(cit_list) > 1:
+		cit = 'mixed'
+		if exclude_total:
+			unsummed = unsummed[unsummed.CountItemType != 'total']
+	elif len(cit_list) == 1:
+		cit = cit_list[0]
+	else:
+		raise Exception(
+			f'Results dataframe has no CountItemTypes; maybe dataframe is empty?')
+
+	if by_vote_type:
+		index_cols = ['contest_type','Contest','contest_district_type','Selection','ReportingUnit','CountItemType']
+	else:
+		index_cols = ['contest_type','Contest','contest_district_type','Selection','ReportingUnit']
+
+	# sum by groups
+	summed_by_name = unsummed[index_cols + ['Count']].groupby(index_cols).sum()
+	if cache is not None:
+		cache.put(session,cache_key,summed_by_name,cit)
+
+	export_rollup(session,target_dir,election,top_ru,sub_rutype,cit,cis,summed_by_name,overwrite=overwrite)
+	return summed_by_name
+
+
+def create_rollups(
+		session,target_dir,top_ru_id,sub_rutype_list,election_id,variants=('by_vote_type','total'),
+		exclude_total=True,cache=None,overwrite=False,mirror=None):
+	"""Like create_rollup, but for several ReportingUnitTypes under the same <top_ru_id>, computed
+	in a single pass: tables are read once, each VoteCount is joined once to all of its ancestors
+	via ComposingReportingUnitJoin, and all levels are summed in one groupby.
+	<sub_rutype_list> is a list of (ReportingUnitType_Id,OtherReportingUnitType) pairs.
+	<variants> may contain 'by_vote_type' (one line per CountItemType) and 'total' (summed over CountItemType).
+	If <exclude_total> is True, don't include 'total' CountItemType (in 'by_vote_type', unless 'total'
+	is the only CountItemType), exactly as create_rollup does
+	If a RollupCache <cache> holds valid results for every level and variant, nothing is recalculated.
+	If <overwrite> is True, existing export files are replaced without asking.
+	If an analyze_via_duckdb.Mirror <mirror> is given, the vote counts are summed there instead of in pandas.
+	Each rollup is exported via export_to_inventory_file_tree; returns a dictionary
+	of the summed dataframes, keyed by (sub_rutype,variant)."""
+	# Get name of db for error messages
+	db = session.bind.url.database
+
+	bad_variants = [v for v in variants if v not in ['by_vote_type','total']]
+	if bad_variants:
+		raise Exception(f'Rollup variant(s) not recognized: {",".join(bad_variants)}')
+
+	top_ru_id, top_ru = ui.pick_record_from_db(session,'ReportingUnit',required=True,db_idx=top_ru_id)
+	election_id,election = ui.pick_record_from_db(session,'Election',required=True,db_idx=election_id)
+	sub_rutype_d = {}
+	for sub_rutype_id, sub_rutype_othertext in sub_rutype_list:
+		if sub_rutype_othertext:
+			sub_rutype_d[sub_rutype_othertext] = (sub_rutype_id,sub_rutype_othertext)
+		else:
+			sub_rutype_d[dbr.name_from_id(session,'ReportingUnitType',sub_rutype_id)] = (sub_rutype_id,'')
+
+	cis = 'unknown'  # TODO placeholder while CountItemStatus is unused
+	rollups = {}
+	labels = {}
+	if cache is not None:
+		for sub_rutype in sub_rutype_d.keys():
+			for variant in variants:
+				key = cache.key(election_id,top_ru_id,sub_rutype,None,variant == 'by_vote_type',exclude_total)
+				cached, cit = cache.get(session,key)
+				if cached is not None:
+					rollups[(sub_rutype,variant)], labels[(sub_rutype,variant)] = cached, cit
+		if len(rollups) == len(sub_rutype_d)*len(variants):
+			for (sub_rutype,variant),summed_by_name in rollups.items():
+				export_rollup(
+					session,target_dir,election,top_ru,sub_rutype,labels[(sub_rutype,variant)],cis,summed_by_name,
+					overwrite=overwrite)
+			return rollups
+
+	unsummed = None
+	if mirror is not None:
+		# (None if another process keeps the mirror busy)
+		unsummed = mirror.rollup_counts(session,top_ru_id,sub_rutype_d,election_id)
+	if unsummed is None:
+		# pull relevant tables once for all levels
+		df = pull_rollup_tables(session,election_id)
+		ecj = df['ElectionContestJoin'][df['ElectionContestJoin'].Election_Id == election_id]
+		contest_selection = contest_selection_from_tables(df)
+		csj = contest_selection[contest_selection.Contest_Id.isin(ecj.Contest_Id.unique())]
+		ecsvcj = df['ElectionContestSelectionVoteCountJoin'][
+			(df['ElectionContestSelectionVoteCountJoin'].ElectionContestJoin_Id.isin(ecj.index)) &
+			(df['ElectionContestSelectionVoteCountJoin'].ContestSelectionJoin_Id.isin(csj.index))]
+
+		# label every subunit of top_ru having one of the requested types with the name of that type
+		cruj = df['ComposingReportingUnitJoin']
+		all_subs = df['ReportingUnit'].loc[cruj[cruj.ParentReportingUnit_Id == top_ru_id].ChildReportingUnit_Id.unique()]
+		level_list = []
+		for sub_rutype,(sub_rutype_id,sub_rutype_othertext) in sub_rutype_d.items():
+			level = all_subs[
+				(all_subs.ReportingUnitType_Id == sub_rutype_id) &
+				(all_subs.OtherReportingUnitType.fillna('') == sub_rutype_othertext)][['Name']]
+			if level.empty:
+				raise Exception(f'Database {db} shows no ReportingUnits of type {sub_rutype} nested inside {top_ru}')
+			level_list.append(level.rename(columns={'Name':'ReportingUnit'}).assign(sub_rutype=sub_rutype))
+		levels = pd.concat(level_list)
+
+		# one row for each (VoteCount, requested ancestor) pair
+		unsummed = ecsvcj.merge(
+			df['VoteCount'],left_on='VoteCount_Id',right_index=True).merge(
+			cruj,left_on='ReportingUnit_Id',right_on='ChildReportingUnit_Id').merge(
+			levels,left_on='ParentReportingUnit_Id',right_index=True)
+		unsummed = mr.enum_col_from_id_othertext(unsummed,'CountItemType',df['CountItemType'])
+		unsummed = unsummed.merge(contest_selection,how='left',left_on='ContestSelectionJoin_Id',right_index=True)
+	if unsummed.empty:
+		raise Exception(f'Results dataframe has no CountItemTypes; maybe dataframe is empty?')
+
+	# sum all levels at once
+	index_cols = ['contest_type','Contest','contest_district_type','Selection','ReportingUnit']
+	summed_all = unsummed[['sub_rutype'] + index_cols + ['CountItemType','Count']].groupby(
+		['sub_rutype'] + index_cols + ['CountItemType']).sum()
+
+	rollups = {}
+	for sub_rutype in sub_rutype_d.keys():
+		by_cit = summed_all.xs(sub_rutype,level='sub_rutype')
+		cit_list = by_cit.index.get_level_values('CountItemType').unique()
+		if exclude_total:
+			without_total = by_cit[by_cit.index.get_level_values('CountItemType') != 'total']
+		else:
+			without_total = by_cit
+		# 'total' is left out as in create_rollup: by vote type, only if there are other CountItemTypes;
+		#  from the sum over CountItemTypes, always
+		for variant in variants:
+			if variant == 'by_vote_type':
+				if len(cit_list) > 1:
+					summed_by_name = without_total
+					cit = 'mixed'
+				else:
+					summed_by_name = by_cit
+					cit = cit_list[0]
+			else:
+				summed_by_name = without_total.groupby(level=index_cols).sum()
+				cit = 'all'
+			if cache is not None:
+				key = cache.key(election_id,top_ru_id,sub_rutype,None,variant == 'by_vote_type',exclude_total)
+				cache.put(session,key,summed_by_name,cit)
+			export_rollup(session,target_dir,election,top_ru,sub_rutype,cit,cis,summed_by_name,overwrite=overwrite)
+			rollups[(sub_rutype,variant)] = summed_by_name
+	return rollups
+
+
+def export_rollup(session,target_dir,election,top_ru,sub_rutype,cit,cis,summed_by_name,overwrite=False):
+	"""Export rollup <summed_by_name> to the inventory file tree in <target_dir>"""
+	inventory_columns = [
+		'Election','ReportingUnitType','CountItemType','CountItemStatus',
+		'source_db_url','timestamp']
+	inventory_values = [
+		election['Name'],sub_rutype,cit,cis,
+		str(session.bind.url),datetime.date.today()]
+	sub_dir = os.path.join(election['Name'],top_ru["Name"],f'by_{sub_rutype}')
+	export_to_inventory_file_tree(
+		target_dir,sub_dir,f'TYPE{cit}_STATUS{cis}.txt',inventory_columns,inventory_values,summed_by_name,
+		overwrite=overwrite)
+	return
+
+
+def datafile_stamp(session,election_id):
+	"""Returns a tuple of (_datafile Id, number of vote counts) pairs for all datafiles of the election.
+	The stamp changes whenever a datafile touching the election is loaded, replaced or deleted."""
+	q = f"""
+		SELECT d."Id", count(j."Id")
+		FROM _datafile d
+		LEFT JOIN "ElectionContestSelectionVoteCountJoin" j ON j."_datafile_Id" = d."Id"
+		WHERE d."Election_Id" = {int(election_id)}
+		GROUP BY d."Id"
+		ORDER BY d."Id"
+	"""
+	return tuple((int(r[0]),int(r[1])) for r in session.execute(q).fetchall())
+
+
+class RollupCache:
+	"""Cache of rollup dataframes, keyed by
+	(election_id, top_ru_id, sub_rutype, datafile ids, by_vote_type, exclude_total).
+	Keeps the most recently used results in memory, up to <max_bytes>; if <cache_dir> is given,
+	results are also written there as Parquet files (requires pyarrow).
+	Each entry carries the datafile_stamp of its election at calculation time,
+	and is dropped when the stamp no longer matches. The stamp of each election is read from the
+	database once and kept until invalidate() is called for the election, as it is whenever results
+	are loaded, replaced or removed (results loaded by another process are seen after invalidate()).
+	Dataframes are copied on the way in and out, so callers may modify what they get."""
+	# names of the cache's files in <cache_dir> start with this, so invalidate removes only those
+	file_prefix = 'rollup_'
+
+	def __init__(self,max_bytes=256*2**20,cache_dir=None):
+		self.max_bytes = max_bytes
+		self.cache_dir = cache_dir
+		self.entries = OrderedDict()  # key -> (stamp, dataframe, label, bytes)
+		self.stamps = {}  # election_id -> stamp read from db, until invalidated
+		self.current_bytes = 0
+		self.counts = {'hits':0,'disk_hits':0,'misses':0,'evictions':0,'invalidations':0}
+
+	@staticmethod
+	def key(election_id,top_ru_id,sub_rutype,datafile_id_list,by_vote_type,exclude_total):
+		if datafile_id_list is None:
+			datafile_ids = None
+		elif np.ndim(datafile_id_list) == 0:
+			datafile_ids = (int(datafile_id_list),)
+		else:
+			datafile_ids = tuple(sorted(int(x) for x in datafile_id_list))
+		return int(election_id),int(top_ru_id),sub_rutype,datafile_ids,bool(by_vote_type),bool(exclude_total)
+
+	def get(self,session,key):
+		"""Returns (dataframe, label) for <key>, or (None, None) if there is no valid entry"""
+		stamp = self.stamp(session,key[0])
+		if key in self.entries:
+			if self.entries[key][0] == stamp:
+				self.entries.move_to_end(key)
+				self.counts['hits'] += 1
+				return self.entries[key][1].copy(), self.entries[key][2]
+			self.drop(key)
+			self.counts['invalidations'] += 1
+		if self.cache_dir:
+			df, label = self.read_from_disk(key,stamp)
+			if df is not None:
+				self.counts['disk_hits'] += 1
+				self.store_in_memory(key,stamp,df.copy(),label)
+				return df, label
+		self.counts['misses'] += 1
+		return None, None
+
+	def put(self,session,key,df,label=None):
+		"""Store rollup <df> (and optional string <label>, e.g. the CountItemType of the rollup) under <key>"""
+		stamp = self.stamp(session,key[0])
+		self.store_in_memory(key,stamp,df.copy(),label)
+		if self.cache_dir:
+			self.write_to_disk(key,stamp,df,label)
+
+	def stamp(self,session,election_id):
+		"""Returns the datafile_stamp of the election, reading it from the database only if it
+		isn't already known"""
+		if int(election_id) not in self.stamps.keys():
+			self.stamps[int(election_id)] = datafile_stamp(session,election_id)
+		return self.stamps[int(election_id)]
+
+	def invalidate(self,election_id=None):
+		"""Drop all entries for <election_id> (or all entries, if <election_id> is None)
+		from memory and disk"""
+		for key in [k for k in self.entries.keys() if election_id is None or k[0] == int(election_id)]:
+			self.drop(key)
+			self.counts['invalidations'] += 1
+		if election_id is None:
+			self.stamps = {}
+		else:
+			self.stamps.pop(int(election_id),None)
+		if self.cache_dir and os.path.isdir(self.cache_dir):
+			prefix = self.file_prefix if election_id is None else f'{self.file_prefix}{int(election_id)}_'
+			for f in os.listdir(self.cache_dir):
+				if f.startswith(prefix) and f.endswith('.parquet'):
+					os.remove(os.path.join(self.cache_dir,f))
+					self.counts['invalidations'] += 1
+
+	def statistics(self):
+		"""Returns a dictionary of hit/miss counts and memory use"""
+		s = dict(self.counts)
+		lookups = s['hits'] + s['disk_hits'] + s['misses']
+		s['hit_rate'] = (s['hits'] + s['disk_hits'])/lookups if lookups else None
+		s['entries'] = len(self.entries)
+		s['bytes'] = self.current_bytes
+		s['max_bytes'] = self.max_bytes
+		return s
+
+	def drop(self,key):
+		self.current_bytes -= self.entries[key][3]
+		del self.entries[key]
+
+	def store_in_memory(self,key,stamp,df,label):
+		if key in self.entries:
+			self.drop(key)
+		size = int(df.memory_usage(index=True,deep=True).sum())
+		if size > self.max_bytes:
+			# too big to keep in memory; disk tier (if any) still holds it
+			return
+		self.entries[key] = (stamp,df,label,size)
+		self.current_bytes += size
+		while self.current_bytes > self.max_bytes:
+			self.drop(next(iter(self.entries)))
+			self.counts['evictions'] += 1
+
+	def disk_path(self,key,stamp):
+		digest = hashlib.sha1(repr((key,stamp)).encode()).hexdigest()
+		return os.path.join(self.cache_dir,f'{self.file_prefix}{key[0]}_{digest}.parquet')
+
+	def read_from_disk(self,key,stamp):
+		path = self.disk_path(key,stamp)
+		if not os.path.isfile(path):
+			return None, None
+		import pyarrow.parquet as pq
+		table = pq.read_table(path)
+		label = (table.schema.metadata or {}).get(b'rollup_label')
+		if label is not None:
+			label = label.decode()
+		return table.to_pandas(), label
+
+	def write_to_disk(self,key,stamp,df,label):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+		Path(self.cache_dir).mkdir(parents=True,exist_ok=True)
+		table = pa.Table.from_pandas(df)
+		metadata = dict(table.schema.metadata or {})
+		if label is not None:
+			metadata[b'rollup_label'] = str(label).encode()
+		pq.write_table(table.replace_schema_metadata(metadata),self.disk_path(key,stamp))
+
+
+# cache shared by the Analyzer and the DataLoader (which invalidates it as results are loaded)
+rollup_cache = RollupCache()
+
+
+def election_datafile_ids(session,election_id):
+	"""Returns the list of Ids of the datafiles of the election"""
+	q = f'SELECT "Id" FROM _datafile WHERE "Election_Id" = {int(election_id)} ORDER BY "Id"'
+	return [int(r[0]) for r in session.execute(q).fetchall()]
+
+
+def pull_rollup_tables(session,election_id=None):
+	"""Returns a dictionary of dataframes, one for each table needed for rollups.
+	Elements and joins are indexed by 'Id'; enumerations keep 'Id' as a column.
+	If <election_id> is given, only the vote counts of the election's datafiles are read
+	(so only their partitions, where the tables are partitioned by datafile)."""
 	df = {}
+	if election_id is None:
+		restrict = None
+	else:
+		restrict = {'_datafile_Id':election_datafile_ids(session,election_id)}
+	for element in ['ElectionContestSelectionVoteCountJoin','VoteCount']:
+		df[element] = dbr.read_table(session,element,index_col='Id',restrict=restrict)
 	for element in [
-		'ElectionContestSelectionVoteCountJoin','VoteCount','CandidateContestSelectionJoin',
+		'CandidateContestSelectionJoin',
 		'BallotMeasureContestSelectionJoin','ComposingReportingUnitJoin','Election','ReportingUnit',
 		'ElectionContestJoin','CandidateContest','CandidateSelection','BallotMeasureContest',
 		'BallotMeasureSelection','Office','Candidate']:
 		# pull directly from db, using 'Id' as index
 		df[element] = pd.read_sql_table(element,session.bind,index_col='Id')
+	# the join table has the datafile too
+	df['VoteCount'] = df['VoteCount'].drop('_datafile_Id',axis=1)
 
 	# pull enums from db, keeping 'Id as a column, not the index
 	for enum in ["ReportingUnitType","CountItemType"]:
-		df[enum] = pd.read_sql_table(enum,session.bind)
+		df[enum] = mr.get_enum_registry(session.bind).table(enum)
+	return df
 
-	#  limit to relevant Election-Contest pairs
-	ecj = df['ElectionContestJoin'][df['ElectionContestJoin'].Election_Id == election_id]
 
+def contest_selection_from_tables(df):
+	"""Given the dictionary <df> of tables from pull_rollup_tables, returns a dataframe indexed by
+	ContestSelectionJoin Id, with columns Contest_Id, Contest, Selection_Id, Selection,
+	ElectionDistrict_Id, contest_type and contest_district_type"""
 	# create contest_selection dataframe, adding Contest, Selection and ElectionDistrict_Id columns
 	cc = df['CandidateContestSelectionJoin'].merge(
 		df['CandidateContest'],how='left',left_on='CandidateContest_Id',right_index=True).rename(
@@ -127,106 +530,35 @@ def create_rollup(
 	contest_selection = mr.enum_col_from_id_othertext(contest_selection,'ReportingUnitType',df['ReportingUnitType'])
 	contest_selection.rename(columns={'ReportingUnitType':'contest_district_type'},inplace=True)
 
-	#  limit to relevant ContestSelection pairs
-	contest_ids = ecj.Contest_Id.unique()
-	csj = contest_selection[contest_selection.Contest_Id.isin(contest_ids)]
-
-	# find ReportingUnits of the correct type that are subunits of top_ru
-	sub_ru_ids = child_rus_by_id(session,[top_ru_id],ru_type=[sub_rutype_id, sub_rutype_othertext])
-	if not sub_ru_ids:
-		# TODO better error handling (while not sub_ru_list....)
-		raise Exception(f'Database {db} shows no ReportingUnits of type {sub_rutype} nested inside {top_ru}')
-	sub_ru = df['ReportingUnit'].loc[sub_ru_ids]
-
-	# find all subReportingUnits of top_ru
-	all_subs_ids = child_rus_by_id(session,[top_ru_id])
-
-	# find all children of subReportingUnits
-	children_of_subs_ids = child_rus_by_id(session,sub_ru_ids)
-	ru_children = df['ReportingUnit'].loc[children_of_subs_ids]
-
-	# check for any reporting units that should be included in roll-up but were missed
-	# TODO list can be long and irrelevant. Instead list ReportingUnitTypes of the missing
-	# missing = [str(x) for x in all_subs_ids if x not in children_of_subs_ids]
-	# if missing:
-	# TODO report these out to the export directory
-	#	ui.report_problems(missing,msg=f'The following reporting units are nested in {top_ru["Name"]} '
-	#							f'but are not nested in any {sub_rutype} nested in {top_ru["Name"]}')
-
-	# limit to relevant vote counts
-	ecsvcj = df['ElectionContestSelectionVoteCountJoin'][
-		(df['ElectionContestSelectionVoteCountJoin'].ElectionContestJoin_Id.isin(ecj.index)) &
-		(df['ElectionContestSelectionVoteCountJoin'].ContestSelectionJoin_Id.isin(csj.index))]
-
-	# calculate specified dataframe with columns [ReportingUnit,Contest,Selection,VoteCount,CountItemType]
-	#  1. create unsummed dataframe of results
-	unsummed = ecsvcj.merge(
-		df['VoteCount'],left_on='VoteCount_Id',right_index=True).merge(
-		df['ComposingReportingUnitJoin'],left_on='ReportingUnit_Id',right_on='ChildReportingUnit_Id').merge(
-		ru_children,left_on='ChildReportingUnit_Id',right_index=True).merge(
-		sub_ru,left_on='ParentReportingUnit_Id',right_index=True,suffixes=['','_Parent'])
-	unsummed.rename(columns={'Name_Parent':'ReportingUnit'},inplace=True)
-	# add columns with names
-	unsummed = mr.enum_col_from_id_othertext(unsummed,'CountItemType',df['CountItemType'])
-	unsummed = unsummed.merge(contest_selection,how='left',left_on='ContestSelectionJoin_Id',right_index=True)
-
-	cis = 'unknown'  # TODO placeholder while CountItemStatus is unused
-	if by_vote_type:
-		cit_list = unsummed['CountItemType'].unique()
-	else:
-		cit_list = ['all']
-		if exclude_total:
-			unsummed = unsummed[unsummed.CountItemType != 'total']
-	if len(cit_list) > 1:
-		cit = 'mixed'
-		if exclude_total:
-			unsummed = unsummed[unsummed.CountItemType != 'total']
-	elif len(cit_list) == 1:
-		cit = cit_list[0]
-	else:
-		raise Exception(
-			f'Results dataframe has no CountItemTypes; maybe dataframe is empty?')
-	count_item = f'TYPE{cit}_STATUS{cis}'
-
-	if by_vote_type:
-		index_cols = ['contest_type','Contest','contest_district_type','Selection','ReportingUnit','CountItemType']
-	else:
-		index_cols = ['contest_type','Contest','contest_district_type','Selection','ReportingUnit']
-
-	# sum by groups
-	summed_by_name = unsummed[index_cols + ['Count']].groupby(index_cols).sum()
-
-	inventory_columns = [
-		'Election','ReportingUnitType','CountItemType','CountItemStatus',
-		'source_db_url','timestamp']
-	inventory_values = [
-		election['Name'],sub_rutype,cit,cis,
-		str(session.bind.url),datetime.date.today()]
-	sub_dir = os.path.join(election['Name'],top_ru["Name"],f'by_{sub_rutype}')
-	export_to_inventory_file_tree(
-		target_dir,sub_dir,f'{count_item}.txt',inventory_columns,inventory_values,summed_by_name)
-
-	return summed_by_name
+	return contest_selection
 
 
 def short_name(text,sep=';'):
 	return text.split(sep)[-1]
 
 
-def export_to_inventory_file_tree(target_dir,target_sub_dir,target_file,inventory_columns,inventory_values,df):
+def export_to_inventory_file_tree(
+		target_dir,target_sub_dir,target_file,inventory_columns,inventory_values,df,overwrite=False):
 	# TODO standard order for columns
 	# export to file system
 	out_path = os.path.join(
 		target_dir,target_sub_dir)
 	Path(out_path).mkdir(parents=True,exist_ok=True)
 
-	while os.path.isfile(os.path.join(out_path,target_file)):
+	while not overwrite and os.path.isfile(os.path.join(out_path,target_file)):
 		target_file = input(f'There is already a file called {target_file}. Pick another name.\n')
 
 	out_file = os.path.join(out_path,target_file)
 	df.to_csv(out_file,sep='\t')
 
-	# create record in inventory.txt
+	record_in_inventory(target_dir,inventory_columns,inventory_values)
+
+	print(f'Results exported to {out_file}')
+	return
+
+
+def record_in_inventory(target_dir,inventory_columns,inventory_values):
+	"""Append a row <inventory_values> to inventory.txt in <target_dir>, creating the file if necessary"""
 	inventory_file = os.path.join(target_dir,'inventory.txt')
 	inv_exists = os.path.isfile(inventory_file)
 	if inv_exists:
@@ -243,6 +575,90 @@ def export_to_inventory_file_tree(target_dir,target_sub_dir,target_file,inventor
 		if not inv_exists:
 			wr.writerow(inventory_columns)
 		wr.writerow(inventory_values)
-
-	print(f'Results exported to {out_file}')
 	return
+
+
+def export_election_to_parquet(session,target_dir,election_id,batch_size=100000):
+	"""Export every VoteCount for the election with Id <election_id>, one row per count, with all
+	dimensions (contest, selection, reporting unit, vote type, datafile) spelled out by name, to a Parquet
+	dataset in <target_dir>, partitioned by Contest and CountItemType (requires pyarrow).
+	Rows are read from a server-side cursor <batch_size> at a time, so memory use is bounded by the batch size.
+	Returns the number of rows exported."""
+	import pyarrow as pa
+	import pyarrow.dataset as ds
+
+	election = pd.read_sql_table('Election',session.bind,index_col='Id').loc[election_id]
+	sub_dir = os.path.join(election['Name'],'vote_counts.parquet')
+	out_path = os.path.join(target_dir,sub_dir)
+	while os.path.exists(out_path):
+		sub_dir = input(f'There is already a dataset at {out_path}. Pick another name (relative to {target_dir}).\n')
+		out_path = os.path.join(target_dir,sub_dir)
+
+	# name the election's datafiles, so only their partitions are read
+	datafiles = ','.join(str(i) for i in election_datafile_ids(session,election_id)) or 'NULL'
+	# TODO other count item statuses
+	q = f"""
+		SELECT
+			e."Name" AS "Election",
+			COALESCE(cc."Name", bmc."Name") AS "Contest",
+			CASE WHEN cc."Id" IS NOT NULL THEN 'Candidate' ELSE 'BallotMeasure' END AS contest_type,
+			COALESCE(can."BallotName", bms."Selection") AS "Selection",
+			p."Name" AS "Party",
+			ru."Name" AS "ReportingUnit",
+			CASE WHEN rut."Txt" = 'other' THEN ru."OtherReportingUnitType" ELSE rut."Txt" END AS "ReportingUnitType",
+			CASE WHEN cit."Txt" = 'other' THEN vc."OtherCountItemType" ELSE cit."Txt" END AS "CountItemType",
+			d.short_name AS "_datafile",
+			vc."Count"
+		FROM "ElectionContestSelectionVoteCountJoin" j
+		JOIN "ElectionContestJoin" ecj ON j."ElectionContestJoin_Id" = ecj."Id"
+		JOIN "Election" e ON ecj."Election_Id" = e."Id"
+		JOIN "VoteCount" vc ON j."VoteCount_Id" = vc."Id" AND j."_datafile_Id" = vc."_datafile_Id"
+		JOIN "ReportingUnit" ru ON vc."ReportingUnit_Id" = ru."Id"
+		JOIN "ReportingUnitType" rut ON ru."ReportingUnitType_Id" = rut."Id"
+		JOIN "CountItemType" cit ON vc."CountItemType_Id" = cit."Id"
+		LEFT JOIN _datafile d ON j."_datafile_Id" = d."Id"
+		LEFT JOIN "CandidateContestSelectionJoin" ccsj ON j."ContestSelectionJoin_Id" = ccsj."Id"
+		LEFT JOIN "CandidateContest" cc ON ccsj."CandidateContest_Id" = cc."Id"
+		LEFT JOIN "CandidateSelection" cs ON ccsj."CandidateSelection_Id" = cs."Id"
+		LEFT JOIN "Candidate" can ON cs."Candidate_Id" = can."Id"
+		LEFT JOIN "Party" p ON can."Party_Id" = p."Id"
+		LEFT JOIN "BallotMeasureContestSelectionJoin" bmcsj ON j."ContestSelectionJoin_Id" = bmcsj."Id"
+		LEFT JOIN "BallotMeasureContest" bmc ON bmcsj."BallotMeasureContest_Id" = bmc."Id"
+		LEFT JOIN "BallotMeasureSelection" bms ON bmcsj."BallotMeasureSelection_Id" = bms."Id"
+		WHERE ecj."Election_Id" = {int(election_id)}
+			AND j."_datafile_Id" IN ({datafiles}) AND vc."_datafile_Id" IN ({datafiles})
+	"""
+	partition_cols = ['Contest','CountItemType']
+	dimension_cols = ['Election','contest_type','Selection','Party','ReportingUnit','ReportingUnitType','_datafile']
+	schema = pa.schema(
+		[(c,pa.dictionary(pa.int32(),pa.string())) for c in dimension_cols]
+		+ [('Count',pa.int64())]
+		+ [(c,pa.string()) for c in partition_cols])
+	partitioning = ds.partitioning(pa.schema([(c,pa.string()) for c in partition_cols]),flavor='hive')
+
+	row_count = 0
+	# stream_results asks the driver for a server-side cursor (e.g., a named cursor with psycopg2)
+	with session.bind.connect().execution_options(stream_results=True) as conn:
+		for i, batch in enumerate(pd.read_sql(q,conn,chunksize=batch_size)):
+			batch['Count'] = batch['Count'].astype('int64')
+			for c in partition_cols + dimension_cols:
+				batch[c] = batch[c].fillna('').astype(str)
+			table = pa.Table.from_pandas(batch,schema=schema,preserve_index=False)
+			ds.write_dataset(
+				table,out_path,format='parquet',partitioning=partitioning,
+				basename_template=f'part-{i}-{{i}}.parquet',existing_data_behavior='overwrite_or_ignore')
+			row_count += len(batch)
+
+	if row_count == 0:
+		print(f'No vote counts found for election {election["Name"]}; nothing exported.')
+		return 0
+
+	inventory_columns = [
+		'Election','ReportingUnitType','CountItemType','CountItemStatus',
+		'source_db_url','timestamp']
+	inventory_values = [
+		election['Name'],'all','all','unknown',
+		str(session.bind.url),datetime.date.today()]
+	record_in_inventory(target_dir,inventory_columns,inventory_values)
+	print(f'{row_count} vote counts exported to {out_path}')
+	return row_count
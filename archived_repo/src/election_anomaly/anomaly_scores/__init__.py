@@ -0,0 +1,227 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+# scale factor making the MAD a consistent estimator of the standard deviation for normal data
+MAD_SCALE = 1.4826
+
+
+def group_codes(df,cols):
+	"""Returns an integer array assigning each row of <df> a code for its combination of values in <cols>,
+	together with the number of groups"""
+	codes = df.groupby(cols,sort=False,dropna=False).ngroup().values
+	return codes, (int(codes.max()) + 1 if len(codes) else 0)
+
+
+def group_sums(codes,n_groups,values):
+	return np.bincount(codes,weights=values,minlength=n_groups)
+
+
+def group_medians(codes,n_groups,values):
+	"""Median of <values> within each group given by <codes>, as an array of length <n_groups>.
+	One sort for all groups: values are ordered within groups, and each group's median is read off
+	at the positions given by the group sizes."""
+	order = np.lexsort((values,codes))
+	sorted_values = values[order]
+	sizes = np.bincount(codes,minlength=n_groups)
+	starts = np.concatenate(([0],np.cumsum(sizes)[:-1]))
+	medians = np.full(n_groups,np.nan)
+	nonempty = sizes > 0
+	lo = starts[nonempty] + (sizes[nonempty] - 1)//2
+	hi = starts[nonempty] + sizes[nonempty]//2
+	medians[nonempty] = (sorted_values[lo] + sorted_values[hi])/2
+	return medians
+
+
+def score_arrays(codes,n_groups,values):
+	"""Outlier scores for each entry of <values> relative to the other entries in its group.
+	Returns a dictionary of arrays, each the same length as <values>:
+	'median', 'mad' (median absolute deviation from the group median),
+	'robust_z' ((value - median)/(MAD_SCALE*mad); nan where the mad is 0) and
+	'loo_z' (z-score of the value against the mean and standard deviation
+	of the rest of its group; nan for groups of fewer than 3)."""
+	values = np.asarray(values,dtype=float)
+	median = group_medians(codes,n_groups,values)[codes]
+	deviation = np.abs(values - median)
+	mad = group_medians(codes,n_groups,deviation)[codes]
+
+	# leave-one-out mean and sample variance, from the group sums of x and x^2
+	n = np.bincount(codes,minlength=n_groups)[codes].astype(float)
+	s1 = group_sums(codes,n_groups,values)[codes] - values
+	s2 = group_sums(codes,n_groups,values**2)[codes] - values**2
+	with np.errstate(divide='ignore',invalid='ignore'):
+		robust_z = np.where(mad > 0,(values - median)/(MAD_SCALE*mad),np.nan)
+		loo_mean = s1/(n - 1)
+		loo_var = np.clip((s2 - (n - 1)*loo_mean**2)/(n - 2),0,None)
+		loo_z = np.where((n > 2) & (loo_var > 0),(values - loo_mean)/np.sqrt(loo_var),np.nan)
+	return {'median':median,'mad':mad,'robust_z':robust_z,'loo_z':loo_z}
+
+
+SCORE_NAMES = ['median','mad','robust_z','loo_z']
+
+
+def score_rows_in_shared_memory(codes_name,data_name,n_rows,start,stop):
+	"""Worker for parallel_score_arrays: scores rows <start> to <stop> of the arrays held in the
+	shared memory blocks <codes_name> (group codes) and <data_name> (values, followed by one row
+	for each score), writing the scores back in place"""
+	codes_shm = shared_memory.SharedMemory(name=codes_name)
+	data_shm = shared_memory.SharedMemory(name=data_name)
+	try:
+		codes = np.ndarray((n_rows,),dtype=np.int64,buffer=codes_shm.buf)
+		data = np.ndarray((len(SCORE_NAMES) + 1,n_rows),dtype=float,buffer=data_shm.buf)
+		groups, local_codes = np.unique(codes[start:stop],return_inverse=True)
+		scores = score_arrays(local_codes,len(groups),data[0,start:stop].copy())
+		for i, k in enumerate(SCORE_NAMES):
+			data[i + 1,start:stop] = scores[k]
+		# views must be released before the blocks can be closed
+		del codes, data
+	finally:
+		codes_shm.close()
+		data_shm.close()
+	return start, stop
+
+
+def parallel_score_arrays(codes,values,split_codes,processes=None,tasks_per_process=4):
+	"""Same result as score_arrays, computed across a pool of <processes> worker processes.
+	<split_codes> assigns each entry to a unit of work (e.g., a contest); every group in <codes> must
+	lie within a single unit. Inputs and outputs live in shared memory, so workers receive only
+	row ranges, not copies of the arrays.
+	If <processes> is None or 1, everything is computed in this process."""
+	codes = np.asarray(codes,dtype=np.int64)
+	values = np.asarray(values,dtype=float)
+	n_rows = len(values)
+	if processes is None or processes <= 1 or n_rows == 0:
+		return score_arrays(codes,int(codes.max()) + 1 if n_rows else 0,values)
+
+	# make each unit of work a contiguous block of rows (stable, so results match score_arrays exactly)
+	order = np.argsort(split_codes,kind='stable')
+	sorted_split = np.asarray(split_codes)[order]
+	unit_starts = np.concatenate(([0],np.flatnonzero(sorted_split[1:] != sorted_split[:-1]) + 1,[n_rows]))
+	# cut at the unit boundaries closest to equal-sized tasks
+	targets = np.linspace(0,n_rows,processes*tasks_per_process + 1)
+	cuts = np.unique(unit_starts[np.clip(np.searchsorted(unit_starts,targets),0,len(unit_starts) - 1)])
+
+	codes_shm = shared_memory.SharedMemory(create=True,size=codes.nbytes)
+	data_shm = shared_memory.SharedMemory(create=True,size=(len(SCORE_NAMES) + 1)*n_rows*8)
+	try:
+		shared_codes = np.ndarray((n_rows,),dtype=np.int64,buffer=codes_shm.buf)
+		data = np.ndarray((len(SCORE_NAMES) + 1,n_rows),dtype=float,buffer=data_shm.buf)
+		shared_codes[:] = codes[order]
+		data[0] = values[order]
+		with ProcessPoolExecutor(max_workers=processes) as pool:
+			futures = [
+				pool.submit(score_rows_in_shared_memory,codes_shm.name,data_shm.name,n_rows,start,stop)
+				for start, stop in zip(cuts[:-1],cuts[1:])]
+			for f in futures:
+				f.result()
+		scores = {}
+		for i, k in enumerate(SCORE_NAMES):
+			scores[k] = np.empty(n_rows)
+			scores[k][order] = data[i + 1]
+		del shared_codes, data
+	finally:
+		codes_shm.close()
+		codes_shm.unlink()
+		data_shm.close()
+		data_shm.unlink()
+	return scores
+
+
+def vote_share_scores(rollup,by_vote_type=False,min_total=0,processes=None):
+	"""Given a rollup dataframe <rollup> as returned by create_rollup (indexed by contest_type, Contest,
+	contest_district_type, Selection, ReportingUnit and possibly CountItemType, with a Count column),
+	returns a dataframe of vote-share outlier scores, one row for each contest, selection and
+	ReportingUnit (and CountItemType, if <by_vote_type> is True), most anomalous first.
+	Each ReportingUnit's share of the contest vote for a selection is compared to the shares
+	of the same selection in all other ReportingUnits of the rollup.
+	ReportingUnits with fewer than <min_total> votes in the contest are left out.
+	If <processes> is greater than 1, contests are scored in parallel (see parallel_score_arrays)."""
+	if 'CountItemType' in rollup.index.names and not by_vote_type:
+		rollup = rollup.groupby(level=[x for x in rollup.index.names if x != 'CountItemType']).sum()
+	elif 'CountItemType' not in rollup.index.names:
+		by_vote_type = False
+	counts = rollup.reset_index()
+	contest_cols = ['contest_type','Contest']
+	if by_vote_type:
+		contest_cols.append('CountItemType')
+
+	# total votes in the contest in each ReportingUnit
+	unit_codes, n_units = group_codes(counts,contest_cols + ['ReportingUnit'])
+	counts['contest_total'] = group_sums(unit_codes,n_units,counts['Count'].values.astype(float))[unit_codes]
+	counts = counts[(counts.contest_total > 0) & (counts.contest_total >= min_total)].copy()
+	counts['share'] = counts['Count']/counts['contest_total']
+
+	# compare each share to those for the same selection across ReportingUnits
+	codes, n_groups = group_codes(counts,contest_cols + ['Selection'])
+	if processes is None or processes <= 1:
+		scores = score_arrays(codes,n_groups,counts['share'].values)
+	else:
+		contest_codes, _ = group_codes(counts,contest_cols)
+		scores = parallel_score_arrays(codes,counts['share'].values,contest_codes,processes=processes)
+	for k, v in scores.items():
+		counts[k] = v
+
+	counts['abs_robust_z'] = counts['robust_z'].abs()
+	counts = counts.sort_values(['abs_robust_z'],ascending=False,na_position='last').drop(columns='abs_robust_z')
+	return counts.reset_index(drop=True)
+
+
+def parent_from_name(ru_name,sep=';'):
+	"""By convention, the internal name of a ReportingUnit begins with the name of its parent
+	(e.g., 'Pennsylvania;Philadelphia;Ward 1' is nested in 'Pennsylvania;Philadelphia')"""
+	return ru_name.rsplit(sep,1)[0] if sep in ru_name else ''
+
+
+def vote_type_divergence(rollup,parent=None,min_total=0,n=None):
+	"""Given a by-vote-type rollup dataframe <rollup> as returned by create_rollup(by_vote_type=True),
+	compares each ReportingUnit's distribution of votes over CountItemTypes, for each contest and selection,
+	with the combined distribution of its peers (all other ReportingUnits of the rollup with the same parent).
+	<parent> is a dictionary or series mapping ReportingUnit names to parent names; by default the parent
+	is read off the ReportingUnit name (see parent_from_name).
+	Returns a dataframe, most divergent first (only the top <n> rows if <n> is given), with columns
+	'js' (Jensen-Shannon divergence, in bits, between unit and peer distributions) and
+	'chi2', 'dof' (Pearson chi-square statistic of the unit's counts against the peer distribution,
+	over the CountItemTypes the peers used, and its degrees of freedom).
+	Units with fewer than <min_total> votes for the selection are left out."""
+	counts = rollup.reset_index()
+	if counts.CountItemType.nunique() > 1:
+		counts = counts[counts.CountItemType != 'total']
+	row_cols = ['contest_type','Contest','Selection','ReportingUnit']
+	mat = counts.pivot_table(index=row_cols,columns='CountItemType',values='Count',aggfunc='sum',fill_value=0)
+	rows = mat.index.to_frame(index=False)
+	x = mat.values.astype(float)
+	unit_total = x.sum(axis=1)
+	keep = (unit_total > 0) & (unit_total >= min_total)
+	rows, x, unit_total = rows[keep].reset_index(drop=True), x[keep], unit_total[keep]
+
+	if parent is None:
+		rows['parent'] = rows.ReportingUnit.map(parent_from_name)
+	else:
+		rows['parent'] = rows.ReportingUnit.map(parent)
+
+	# peer counts: group sums over units with the same contest, selection and parent, less the unit itself
+	codes, n_groups = group_codes(rows,['contest_type','Contest','Selection','parent'])
+	group_x = np.stack([group_sums(codes,n_groups,x[:,j]) for j in range(x.shape[1])],axis=1)
+	peer_x = group_x[codes] - x
+	peer_total = peer_x.sum(axis=1)
+
+	with np.errstate(divide='ignore',invalid='ignore'):
+		p = x/unit_total[:,None]
+		q = peer_x/peer_total[:,None]
+		m = (p + q)/2
+		js = 0.5*np.where(p > 0,p*np.log2(p/m),0).sum(axis=1) + 0.5*np.where(q > 0,q*np.log2(q/m),0).sum(axis=1)
+		expected = unit_total[:,None]*q
+		chi2 = np.where(expected > 0,(x - expected)**2/expected,0).sum(axis=1)
+	dof = (expected > 0).sum(axis=1) - 1
+
+	no_peers = peer_total == 0
+	rows['total'] = unit_total
+	rows['peer_total'] = peer_total
+	rows['js'] = np.where(no_peers,np.nan,js)
+	rows['chi2'] = np.where(no_peers,np.nan,chi2)
+	rows['dof'] = np.where(no_peers,0,dof)
+	rows = rows.sort_values('js',ascending=False,na_position='last').reset_index(drop=True)
+	if n is not None:
+		rows = rows.head(n)
+	return rows
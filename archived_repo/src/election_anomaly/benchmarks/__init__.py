@@ -0,0 +1,328 @@
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from election_anomaly import db_routines as dbr
+from election_anomaly import user_interface as ui
+from election_anomaly import analyze_via_pandas as avp
+from election_anomaly import analyze_via_duckdb as avd
+from election_anomaly import synthetic_data as sd
+
+
+# metrics compared by compare_runs, with the smallest change worth reporting
+metrics = {'seconds':0.05,'peak_rss_mb':5,'queries':0}
+
+# seconds allowed (see check_import_budgets) for importing each module and loading what it needs
+import_budgets = {
+    'election_anomaly':0.1,'election_anomaly.anomaly_scores':1.0,'election_anomaly.db_routines':1.5,
+    'election_anomaly.analyze_via_pandas':1.5}
+
+
+class Measurement:
+    """Context manager recording wall-clock seconds, peak resident memory (MB) and the number
+    of SQL statements sent through <engine> while the block runs, appended to <results> under <name>.
+    Peak memory is sampled if psutil is installed; otherwise it is the peak for the whole process so far.
+    Statements sent on raw DBAPI cursors (e.g., dbr.raw_query_via_sqlalchemy) are not counted.
+    If <statements> (a dictionary) is given, each distinct statement is recorded there with its
+    parameters and the benchmarks sending it (see seq_scan_report).
+    If the block fails, the error is recorded and swallowed, and <session> (if given) is rolled back and
+    closed, returning its connection to the pool, so that the next benchmark starts clean."""
+    def __init__(self,name,engine,results,statements=None,session=None):
+        self.name = name
+        self.engine = engine
+        self.results = results
+        self.statements = statements
+        self.session = session
+
+    def count_query(self,conn,cursor,statement,parameters,context,executemany):
+        self.queries += 1
+        if self.statements is not None and not executemany:
+            self.statements.setdefault(statement,{'parameters':parameters,'benchmarks':set()})
+            self.statements[statement]['benchmarks'].add(self.name)
+
+    def sample_rss(self):
+        while not self.done.wait(0.01):
+            self.peak = max(self.peak,self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.queries = 0
+        self.peak = 0
+        self.done = threading.Event()
+        self.sampler = None
+        try:
+            import psutil
+            self.process = psutil.Process()
+            self.peak = self.process.memory_info().rss
+            self.sampler = threading.Thread(target=self.sample_rss,daemon=True)
+            self.sampler.start()
+        except ImportError:
+            pass
+        event.listen(self.engine,'before_cursor_execute',self.count_query)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        seconds = time.perf_counter() - self.start
+        event.remove(self.engine,'before_cursor_execute',self.count_query)
+        self.done.set()
+        if self.sampler:
+            self.sampler.join()
+            peak_mb = self.peak/2**20
+        else:
+            import resource
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+            peak_mb = peak_kb/2**20 if platform.system() == 'Darwin' else peak_kb/2**10
+        self.results.append({
+            'name':self.name,'seconds':seconds,'peak_rss_mb':peak_mb,'queries':self.queries,
+            'error':None if exc_type is None else repr(exc_value)})
+        if exc_type is not None and self.session is not None:
+            self.session.rollback()
+            self.session.close()
+        # record a failure and carry on with the other benchmarks (but let Ctrl-C through)
+        return exc_type is None or issubclass(exc_type,Exception)
+
+
+def read_cases(cases_file):
+    """Reads a tab-separated file with columns juris_name, munger_name, results_file, election
+    and top_reporting_unit (one line per results file to ingest) into a list of dictionaries"""
+    return pd.read_csv(cases_file,sep='\t',encoding='iso-8859-1').to_dict(orient='records')
+
+
+def synthetic_case(project_root,size,seed=0):
+    """Generates a synthetic jurisdiction with <size> = (counties, wards per county, precincts per ward)
+    and returns the benchmark case for it"""
+    n_counties, wards, precincts = size
+    name = f'Benchmark{n_counties}x{wards}x{precincts}'
+    paths = sd.create_synthetic(
+        project_root,juris_name=name,n_counties=n_counties,wards_per_county=wards,precincts_per_ward=precincts,
+        n_congressional=min(10,n_counties),seed=seed)
+    return {
+        'juris_name':name,'munger_name':name.lower(),'results_file':paths['results_files'][0],
+        'election':'2018 General','top_reporting_unit':name}
+
+
+def run_benchmarks(
+        project_root,paramfile,db_name='election_anomaly_benchmark',cases=None,
+        synthetic_sizes=((10,10,10),(100,10,10)),rollup_levels=('county','ward','precinct'),out_file=None,
+        duckdb_file=None,juris_load_workers=1):
+    """Runs each benchmark case against a freshly created database <db_name> (any existing
+    database of that name is reset!) on the PostgreSQL server or in the SQLite directory given in <paramfile>:
+    jurisdiction load (and reload, unchanged), results ingest and rollups for each of the <rollup_levels>, one level at a time
+    (create_rollup) and all at once (create_rollups). The time to import the modules in import_budgets
+    is measured too.
+    <cases> is a list of dictionaries as returned by read_cases; a synthetic case is added for each
+    (counties, wards per county, precincts per ward) triple in <synthetic_sizes>.
+    If <duckdb_file> is given, the sync of a DuckDB mirror there and the rollups summed in it are timed too.
+    The jurisdiction is loaded by <juris_load_workers> threads (see load_juris_elements); the timings
+    for each element are kept with the load_juris_to_db measurement, under 'elements'.
+    The filtered queries sent are then checked for sequential scans (see seq_scan_report).
+    Writes the measurements as JSON to <out_file> (if given) and returns them."""
+    cases = list(cases or [])
+    for size in synthetic_sizes:
+        cases.append(synthetic_case(project_root,size))
+
+    dbr.create_new_db(project_root,paramfile,db_name)
+    engine = dbr.sql_alchemy_connect(paramfile=paramfile,db_name=db_name)
+    session = sessionmaker(bind=engine)()
+    rollup_dir = tempfile.mkdtemp(prefix='rollups_')
+    if duckdb_file and os.path.isfile(duckdb_file):
+        os.remove(duckdb_file)
+    mirror = avd.Mirror(duckdb_file) if duckdb_file else None
+    results = []
+    statements = {}
+    for module in import_budgets.keys():
+        results.append({
+            'name':f'import/{module}','seconds':time_import(module),'peak_rss_mb':None,'queries':None,'error':None})
+    for case in cases:
+        prefix = f'{case["juris_name"]}/{os.path.basename(case["results_file"])}'
+        if not os.path.isfile(case['results_file']):
+            results.append({'name':f'{prefix}/ingest','error':'results file not found'})
+            continue
+
+        juris, juris_err = ui.pick_juris_from_filesystem(
+            project_root,juris_name=case['juris_name'],check_files=True)
+        with Measurement(f'{case["juris_name"]}/load_juris_to_db',engine,results,statements,session=session):
+            juris.load_juris_to_db(session,project_root,workers=juris_load_workers)
+        results[-1]['elements'] = juris.load_timings
+        # again, with nothing changed
+        with Measurement(f'{case["juris_name"]}/reload_juris_to_db',engine,results,statements,session=session):
+            juris.load_juris_to_db(session,project_root)
+
+        munger, munger_err = ui.pick_munger(
+            project_root=project_root,mungers_dir=os.path.join(project_root,'mungers'),
+            session=session,munger_name=case['munger_name'])
+        election_id = dbr.name_to_id(session,'Election',case['election'])
+        top_ru_id = dbr.name_to_id(session,'ReportingUnit',case['top_reporting_unit'])
+        record = {
+            'short_name':os.path.basename(case['results_file']),'file_name':os.path.basename(case['results_file']),
+            'ReportingUnit_Id':top_ru_id,'Election_Id':election_id}
+        datafile_id = dbr.save_one_to_db(session,'_datafile',record,upsert=True)[0]
+        with Measurement(f'{prefix}/ingest',engine,results,statements,session=session):
+            ui.new_datafile(
+                session,munger,case['results_file'],project_root=project_root,juris=juris,
+                results_info=(datafile_id,election_id),load_juris=False)
+
+        sub_rutype_list = []
+        for level in rollup_levels:
+            sub_rutype_id = dbr.name_to_id(session,'ReportingUnitType',level)
+            sub_rutype_list.append((sub_rutype_id,''))
+            with Measurement(f'{prefix}/rollup_{level}',engine,results,statements,session=session):
+                avp.create_rollup(
+                    session,rollup_dir,top_ru_id=top_ru_id,sub_rutype_id=sub_rutype_id,sub_rutype_othertext='',
+                    election_id=election_id,datafile_id_list=datafile_id,overwrite=True)
+        with Measurement(f'{prefix}/rollups_{"_".join(rollup_levels)}',engine,results,statements,session=session):
+            avp.create_rollups(
+                session,rollup_dir,top_ru_id,sub_rutype_list,election_id,overwrite=True)
+        if mirror:
+            with Measurement(f'{prefix}/duckdb_sync',engine,results,statements,session=session):
+                mirror.sync(session)
+            with Measurement(f'{prefix}/duckdb_rollups_{"_".join(rollup_levels)}',engine,results,statements,session=session):
+                avp.create_rollups(
+                    session,rollup_dir,top_ru_id,sub_rutype_list,election_id,overwrite=True,mirror=mirror)
+
+    session.close()
+    if mirror:
+        mirror.close()
+    seq_scans = seq_scan_report(engine,statements,backend=dbr.get_backend(paramfile))
+    run = {
+        'timestamp':datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':platform.python_version(),'platform':platform.platform(),
+        'db_name':db_name,'backend':dbr.get_backend(paramfile).name,
+        'pool':dbr.pool_statistics().get((os.path.abspath(paramfile),db_name)),'results':results,
+        'seq_scans':seq_scans}
+    if out_file:
+        with open(out_file,'w') as f:
+            json.dump(run,f,indent=2)
+        print(f'Benchmark results written to {out_file}')
+    return run
+
+
+def seq_scan_report(engine,statements,backend):
+    """Index advisor: asks the database (via <backend>) for the plan of each of the <statements>
+    (as recorded by Measurement) that filters or joins, and reports the tables read by sequential scan,
+    i.e., where an index (see indexes.txt in the CDF schema definition) might help. Small tables are
+    often scanned even when indexed, so this is a list of candidates, not of problems.
+    Only tables of the CDF schema are reported. Prints a table and returns a list of dictionaries,
+    one per table, most-scanned first."""
+    cdf_tables = dbr.get_catalog(engine).table_names()
+    by_table = {}
+    with engine.connect() as conn:
+        for statement, info in statements.items():
+            words = statement.upper().split()
+            if not words or words[0] != 'SELECT' or ('WHERE' not in words and 'JOIN' not in words):
+                continue
+            try:
+                scanned = backend.seq_scans(conn,statement,info['parameters'])
+            except Exception:
+                # e.g., statements on objects since dropped
+                continue
+            # skip system catalogs
+            for table in [t for t in scanned if t in cdf_tables]:
+                entry = by_table.setdefault(table,{'table':table,'statements':0,'benchmarks':set(),'example':statement})
+                entry['statements'] += 1
+                entry['benchmarks'].update(info['benchmarks'])
+    report = sorted(by_table.values(),key=lambda x: -x['statements'])
+    for entry in report:
+        entry['benchmarks'] = sorted(entry['benchmarks'])
+    if report:
+        print('Sequential scans in filtered queries (candidates for indexes):')
+        print('table\tstatements\tbenchmarks\texample')
+        for entry in report:
+            example = ' '.join(entry['example'].split())[:100]
+            print(f'{entry["table"]}\t{entry["statements"]}\t{len(entry["benchmarks"])}\t{example}')
+    return report
+
+
+def time_import(module,repeat=3):
+    """Seconds taken, in a fresh python interpreter, to import <module> and load it (submodules of
+    election_anomaly are imported lazily, so are loaded only when first used); the best of <repeat> tries"""
+    code = f"""
+import importlib, time
+start = time.perf_counter()
+importlib.import_module('{module}').__dict__
+print(time.perf_counter() - start)"""
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join([p for p in sys.path if p]))
+    times = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,check=True,env=env)
+        times.append(float(out.stdout.split()[-1]))
+    return min(times)
+
+
+def check_import_budgets(budgets=None):
+    """Times the import of each module in the dictionary <budgets> (default: import_budgets) of
+    module:seconds. Prints a table and returns the list of modules over budget."""
+    budgets = budgets or import_budgets
+    over = []
+    print('module\tseconds\tbudget\t')
+    for module, budget in budgets.items():
+        seconds = time_import(module)
+        print(f'{module}\t{seconds:.3f}\t{budget:.3f}\t{"OVER BUDGET" if seconds > budget else ""}')
+        if seconds > budget:
+            over.append(module)
+    return over
+
+
+def compare_runs(old_file,new_file,tolerance=0.1):
+    """Compares two benchmark result files. A benchmark regresses if a metric grew by more than
+    the fraction <tolerance> (and by more than the floor given in <metrics>); any increase in the
+    number of queries counts. A benchmark that fails in the new run but not in the old one, or that
+    is missing from the new run, also counts (and its metrics are not compared).
+    Prints a table and returns the list of regressions."""
+    with open(old_file) as f:
+        old = {r['name']:r for r in json.load(f)['results']}
+    with open(new_file) as f:
+        new = {r['name']:r for r in json.load(f)['results']}
+
+    regressions = []
+    lines = []
+    for name in [n for n in new.keys() if n in old.keys()]:
+        if new[name].get('error') or old[name].get('error'):
+            # the timings of a failed step measure nothing
+            continue
+        for metric, floor in metrics.items():
+            a, b = old[name].get(metric), new[name].get(metric)
+            if a is None or b is None:
+                continue
+            change = (b - a)/a if a else 0
+            regressed = b - a > floor and (metric == 'queries' or b > a*(1 + tolerance))
+            lines.append(f'{name}\t{metric}\t{a:.2f}\t{b:.2f}\t{change:+.0%}\t{"REGRESSION" if regressed else ""}')
+            if regressed:
+                regressions.append({'name':name,'metric':metric,'old':a,'new':b})
+    for name in new.keys():
+        if new[name].get('error'):
+            failed_before = name in old.keys() and old[name].get('error')
+            lines.append(f'{name}\terror\t\t\t\t{new[name]["error"]}\t{"" if failed_before else "REGRESSION"}')
+            if not failed_before:
+                regressions.append({'name':name,'metric':'error','old':None,'new':new[name]['error']})
+    print('benchmark\tmetric\told\tnew\tchange\t')
+    print('\n'.join(lines))
+    missing = [n for n in old.keys() if n not in new.keys()]
+    if missing:
+        print(f'Not in {new_file}: {", ".join(missing)}')
+        regressions += [{'name':n,'metric':'missing','old':None,'new':None} for n in missing]
+    return regressions
+
+
+def compare_backends(run_files):
+    """Prints, for each benchmark, the seconds taken in each of the <run_files> (e.g., one run against
+    PostgreSQL and one against SQLite), with the ratio to the first file. Returns the table as a dataframe."""
+    runs = []
+    for run_file in run_files:
+        with open(run_file) as f:
+            run = json.load(f)
+        label = f'{run.get("backend","postgresql")} ({os.path.basename(run_file)})'
+        runs.append(pd.Series({r['name']:r.get('seconds') for r in run['results']},name=label))
+    ratios = [(r/runs[0]).rename(f'{r.name} / first') for r in runs[1:]]
+    table = pd.concat(runs + ratios,axis=1)
+    print(table.round(2).to_string())
+    return table
@@ -0,0 +1,44 @@
+"""Command line for the benchmark suite, e.g.
+    python -m election_anomaly.benchmarks run --project_root . --paramfile local.par --out before.json
+    python -m election_anomaly.benchmarks compare before.json after.json
+    python -m election_anomaly.benchmarks backends postgres.json sqlite.json
+    python -m election_anomaly.benchmarks imports"""
+import argparse
+import sys
+from election_anomaly import benchmarks as bm
+
+parser = argparse.ArgumentParser(prog='python -m election_anomaly.benchmarks')
+sub = parser.add_subparsers(dest='command',required=True)
+run = sub.add_parser('run',help='run the benchmarks against a local PostgreSQL server or SQLite directory')
+run.add_argument('--project_root',required=True)
+run.add_argument('--paramfile',required=True)
+run.add_argument('--db_name',default='election_anomaly_benchmark')
+run.add_argument('--cases',help='tab-separated file of results files to ingest (see read_cases)')
+run.add_argument('--duckdb_file',help='also time rollups summed in a DuckDB mirror kept in this file')
+run.add_argument('--juris_load_workers',type=int,default=1,help='threads loading the jurisdiction')
+run.add_argument('--out',required=True)
+compare = sub.add_parser('compare',help='compare two benchmark result files')
+compare.add_argument('old')
+compare.add_argument('new')
+compare.add_argument('--tolerance',type=float,default=0.1)
+backends = sub.add_parser('backends',help='show the time taken by each benchmark in runs against different backends')
+backends.add_argument('runs',nargs='+')
+imports = sub.add_parser('imports',help='check the time taken to import the package and its main modules')
+args = parser.parse_args()
+
+if args.command == 'run':
+    cases = bm.read_cases(args.cases) if args.cases else None
+    bm.run_benchmarks(args.project_root,args.paramfile,db_name=args.db_name,cases=cases,out_file=args.out,
+        duckdb_file=args.duckdb_file,juris_load_workers=args.juris_load_workers)
+elif args.command == 'backends':
+    bm.compare_backends(args.runs)
+elif args.command == 'imports':
+    over = bm.check_import_budgets()
+    if over:
+        print(f'{len(over)} module(s) over budget')
+        sys.exit(1)
+else:
+    regressions = bm.compare_runs(args.old,args.new,tolerance=args.tolerance)
+    if regressions:
+        print(f'{len(regressions)} regression(s)')
+        sys.exit(1)
@@ -1,20 +1,21 @@
 #!/usr/bin/python3
 # db_routines/__init__.py
 
-import psycopg2
+import datetime
 import sqlalchemy
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from psycopg2 import sql
-import sqlalchemy as db
-import sqlalchemy_utils
 from election_anomaly import user_interface as ui
 from configparser import MissingSectionHeaderError
 import pandas as pd
 from election_anomaly import munge_routines as mr
-import re
 from election_anomaly.db_routines import create_cdf_db as db_cdf
+from election_anomaly.db_routines import backends as dbb
+from configparser import ConfigParser
+from contextlib import contextmanager
 import os
 
+# the schema definition shipped with the package
+schema_def_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'CDF_schema_def_info')
+
 
 def get_database_names(con):
     """Return dataframe with one column called `datname` """
@@ -23,6 +24,7 @@ def get_database_names(con):
 
 
 def create_database(con,cur,db_name):
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
     con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     q = "DROP DATABASE IF EXISTS {0}"
     sql_ids = [db_name]
@@ -73,21 +75,30 @@ def append_to_composing_reporting_unit_join(session,ru):
     return cruj_dframe
 
 
+def get_backend(paramfile):
+    """Returns the database backend described by <paramfile>: SQLite if the file has a [sqlite]
+    section, otherwise PostgreSQL"""
+    if not paramfile:
+        paramfile = ui.pick_paramfile()
+    parser = ConfigParser()
+    parser.read(paramfile)
+    if parser.has_section('sqlite'):
+        return dbb.SqliteBackend(dict(parser.items('sqlite')))
+    return dbb.PostgresBackend(ui.config(paramfile))
+
+
 def establish_connection(paramfile, db_name='postgres'):
     """Check for DB and relevant tables; if they don't exist, return
     error message"""
     try:
-        params = ui.config(paramfile)
+        backend = get_backend(paramfile)
     except MissingSectionHeaderError as e:
         return {'message': 'database.ini file not found suggested location.'}
-    params['dbname']=db_name
-    try:
-        con = psycopg2.connect(**params)
-    except psycopg2.OperationalError as e:
+    engine = sql_alchemy_connect(paramfile, db_name)
+    if not backend.can_connect(engine):
         return {'message': 'Unable to establish connection to database.'}
 
     # Look for tables
-    engine = sql_alchemy_connect(paramfile, db_name)
     elems, enums, joins, o = get_cdf_db_table_names(engine)
 
     # All tables except "Others" must be created. Essentially looks for
@@ -95,88 +106,222 @@ def establish_connection(paramfile, db_name='postgres'):
     if not elems or not enums or not joins:
         return {'message': 'Required tables not found.'}
 
-    con.close()
+    check_partitioning(engine)
     return None
 
 
+def check_partitioning(eng):
+    """Raises an exception if the database behind <eng> was created before vote counts were kept
+    by datafile (see partition_by.txt in the schema definition), since loading into it would fail"""
+    catalog = get_catalog(eng)
+    missing = [f'{table}.{column}' for table,column in db_cdf.partitioned_tables(schema_def_dir).items()
+               if table in catalog.table_names() and column not in catalog.table_columns(table)]
+    if missing:
+        raise Exception(
+            f'Database {eng.url.database} predates datafile partitioning (no column {", ".join(missing)}); '
+            f'rebuild it with create_new_db')
+
+
 def create_new_db(project_root, paramfile, db_name):
-    # get connection to default postgres DB to create new one
-    try:    
-        params = ui.config(paramfile)
-        params['dbname'] = 'postgres'
-        con = psycopg2.connect(**params)
+    backend = get_backend(paramfile)
+    try:
+        exists = backend.database_exists(db_name)
     except:
         # Can't connect to the default postgres database, so there
         # seems to be something wrong with connection. Fail here.
         print('Unable to find database. Exiting.')
         quit()
-    cur = con.cursor()
-    db_df = get_database_names(con)
-
-    eng = sql_alchemy_connect(paramfile=paramfile,db_name=db_name)
-    Session = sqlalchemy.orm.sessionmaker(bind=eng)
-    sess = Session()
 
     # DB already exists.
     # TODO if DB exists, check that desired_db has right format?
-    if db_name in db_df.datname.unique():
+    if exists:
+        eng = sql_alchemy_connect(paramfile=paramfile,db_name=db_name)
+        Session = sqlalchemy.orm.sessionmaker(bind=eng)
+        sess = Session()
         # Clean out DB
         db_cdf.reset_db(sess,
             os.path.join(project_root,'election_anomaly','CDF_schema_def_info'))
     else:
-        create_database(con, cur, db_name)
+        backend.create_database(db_name)
+        eng = sql_alchemy_connect(paramfile=paramfile,db_name=db_name)
+        Session = sqlalchemy.orm.sessionmaker(bind=eng)
+        sess = Session()
 
     # load cdf tables
     db_cdf.create_common_data_format_tables(
         sess,dirpath=os.path.join(project_root,'election_anomaly','CDF_schema_def_info'))
     db_cdf.fill_cdf_enum_tables(
         sess,None,dirpath=os.path.join(project_root,'election_anomaly/CDF_schema_def_info/'))
-    con.close()
+    sess.commit()
+    get_catalog(eng).refresh()
+    mr.get_enum_registry(eng).refresh()
+    get_resolver(eng).invalidate()
+
+
+# engines shared by the whole process, keyed by (paramfile, db_name), and counts of pool events for each
+engines = {}
+pool_counts = {}
 
 
 def sql_alchemy_connect(paramfile=None,db_name='postgres'):
-    """Returns an engine and a metadata object"""
+    """Returns the engine for database <db_name> described by <paramfile>. The engine (with its
+    connection pool) is created on first use and shared by all later callers in the process."""
     if not paramfile:
         paramfile = ui.pick_paramfile()
-    params = ui.config(paramfile)
-    if db_name != 'postgres':
-        params['dbname'] = db_name
-    # We connect with the help of the PostgreSQL URL
-    url = 'postgresql://{user}:{password}@{host}:{port}/{dbname}'
-    url = url.format(**params)
-
-    # The return value of create_engine() is our connection object
-    engine = db.create_engine(url, client_encoding='utf8')
-    return engine
+    key = (os.path.abspath(paramfile),db_name)
+    if key not in engines.keys():
+        engine = get_backend(paramfile).create_engine(db_name)
+        pool_counts[key] = {'connects':0,'checkouts':0,'checkins':0,'invalidations':0}
+        for event_name,count in [
+                ('connect','connects'),('checkout','checkouts'),('checkin','checkins'),
+                ('invalidate','invalidations')]:
+            sqlalchemy.event.listen(engine,event_name,count_pool_event(key,count))
+        engines[key] = engine
+    return engines[key]
+
+
+def count_pool_event(key,count):
+    def listener(*args):
+        pool_counts[key][count] += 1
+    return listener
+
+
+def pool_statistics():
+    """Returns a dictionary, keyed by (paramfile, db_name), of the number of new database connections
+    ('connects'), of checkouts from and checkins to the pool, of connections found dead ('invalidations'),
+    and of connections currently checked out ('checked_out') and idle in the pool ('idle')"""
+    stats = {}
+    for key,engine in engines.items():
+        stats[key] = dict(pool_counts[key])
+        stats[key]['checked_out'] = engine.pool.checkedout() if hasattr(engine.pool,'checkedout') else None
+        stats[key]['idle'] = engine.pool.checkedin() if hasattr(engine.pool,'checkedin') else None
+    return stats
+
+
+def dispose_engines():
+    """Closes all pooled connections of all shared engines and forgets the engines"""
+    for engine in engines.values():
+        engine.dispose()
+    engines.clear()
+    pool_counts.clear()
 
 
 def add_integer_cols(session,table,col_list):
-    add = ','.join([f' ADD COLUMN "{c}" INTEGER' for c in col_list])
-    q = f'ALTER TABLE "{table}" {add}'
-    sql_ids=[]
-    strs = []
-    raw_query_via_sqlalchemy(session,q,sql_ids,strs)
+    dbb.for_engine(session.bind).add_integer_cols(session,table,col_list)
+    get_catalog(session.bind).refresh(table)
     return
 
 
 def drop_cols(session,table,col_list):
-    drop = ','.join([f' DROP COLUMN "{c}"' for c in col_list])
-    q = f'ALTER TABLE "{table}" {drop}'
-    sql_ids=[]
-    strs = []
-    raw_query_via_sqlalchemy(session,q,sql_ids,strs)
+    dbb.for_engine(session.bind).drop_cols(session,table,col_list)
+    get_catalog(session.bind).refresh(table)
     return
 
 
+class Catalog:
+    """What the CDF database behind the engine <eng> looks like: the columns of each table (and the
+    enumerations they reference), foreign keys, unique constraints and the name field of each element.
+    Each is read from the database the first time it is needed, and kept, so that later questions are
+    dictionary lookups. Use get_catalog(eng) rather than creating a Catalog directly."""
+    def __init__(self,eng):
+        self.eng = eng
+        self.backend = dbb.for_engine(eng)
+        self.columns = None  # table -> list of column names
+        self.fk = {}  # table -> dataframe of foreign keys (see foreign_keys)
+        self.unique = {}  # table -> list of unique constraints (each a list of column names)
+        self.tables = {}  # table -> sqlalchemy Table
+
+    def column_lists(self):
+        if self.columns is None:
+            df = self.backend.column_catalog(self.eng)
+            self.columns = {t:list(g.column_name) for t,g in df.groupby('table_name',sort=False)}
+        return self.columns
+
+    def table_names(self):
+        return list(self.column_lists().keys())
+
+    def table_columns(self,table):
+        return self.column_lists().get(table,[])
+
+    def enumerations(self,table):
+        """Enumerations referenced in <table>, identified by the pair of columns <enum>_Id and Other<enum>"""
+        cols = self.table_columns(table)
+        return [c[:-3] for c in cols if c[-3:] == '_Id' and f'Other{c[:-3]}' in cols]
+
+    def foreign_keys(self,table):
+        """Dataframe whose index is the name of the field in the <table> table, with columns
+        foreign_table_name and foreign_column_name"""
+        if table not in self.fk.keys():
+            self.fk[table] = self.backend.foreign_keys(self.eng,table)
+        return self.fk[table]
+
+    def table(self,table):
+        """Returns the sqlalchemy Table object for <table>, for building queries"""
+        if table not in self.tables.keys():
+            self.tables[table] = sqlalchemy.Table(table,sqlalchemy.MetaData(),autoload_with=self.eng)
+        return self.tables[table]
+
+    def unique_constraints(self,table):
+        if table not in self.unique.keys():
+            self.unique[table] = [
+                uc['column_names'] for uc in sqlalchemy.inspect(self.eng).get_unique_constraints(table)]
+        return self.unique[table]
+
+    def name_field(self,table):
+        return get_name_field(table)
+
+    def referring_tables(self,table):
+        """All tables with a chain of foreign keys to <table>, those furthest from <table> first"""
+        found = []
+        to_check = [table]
+        while to_check:
+            t = to_check.pop()
+            for other in self.table_names():
+                if other not in found and other != table and t in self.foreign_keys(other).foreign_table_name.values:
+                    found.insert(0,other)
+                    to_check.append(other)
+        return found
+
+    def refresh(self,table=None):
+        """Forget what is known about <table> (or about all tables), e.g. after columns are added or dropped"""
+        if table is None:
+            self.columns = None
+            self.fk = {}
+            self.unique = {}
+            self.tables = {}
+            return
+        if self.columns is not None:
+            df = self.backend.column_catalog(self.eng,table=table)
+            if df.empty:
+                self.columns.pop(table,None)
+            else:
+                self.columns[table] = list(df.column_name)
+        self.fk.pop(table,None)
+        self.unique.pop(table,None)
+        self.tables.pop(table,None)
+
+
+# one Catalog per engine
+catalogs = {}
+
+
+def get_catalog(eng):
+    if eng not in catalogs.keys():
+        catalogs[eng] = Catalog(eng)
+    return catalogs[eng]
+
+
+# element -> name field, read from the schema definition on first use
+name_fields = {}
+
+
 def get_cdf_db_table_names(eng):
-    """This is postgresql-specific"""
-    db_columns = pd.read_sql_table('columns',eng,schema='information_schema')
-    public = db_columns[db_columns.table_schema=='public']
+    catalog = get_catalog(eng)
     cdf_elements = set()
     cdf_enumerations = set()
     cdf_joins = set()
     others = set()
-    for t in public.table_name.unique():
+    for t in catalog.table_names():
         # main_routines table name string
         if t[0] == '_':
             others.add(t)
@@ -184,7 +329,7 @@ def get_cdf_db_table_names(eng):
             cdf_joins.add(t)
         else:
             # main_routines columns
-            cols = public[public.table_name == t].column_name.unique()
+            cols = catalog.table_columns(t)
             if set(cols) == {'Id','Txt'} or set(cols) == {'Id','Selection'}:
                 cdf_enumerations.add(t)
             else:
@@ -196,14 +341,14 @@ def get_cdf_db_table_names(eng):
 def read_enums_from_db_table(sess,element):
 	"""Returns list of enum names (e.g., 'CountItemType') for the given <element>.
 	Identifies enums by the Other{enum} column name (e.g., 'OtherCountItemType)"""
-	df = pd.read_sql_table(element,sess.bind,index_col='Id')
-	other_cols = [x for x in df.columns if x[:5] == 'Other']
+	other_cols = [x for x in get_catalog(sess.bind).table_columns(element) if x[:5] == 'Other']
 	enums = [x[5:] for x in other_cols]
 	return enums
 
 
 # TODO combine query() and raw_query_via_sqlalchemy()?
 def query(q,sql_ids,strs,con,cur):  # needed for some raw queries, e.g., to create db and schemas
+    from psycopg2 import sql
     format_args = [sql.Identifier(a) for a in sql_ids]
     cur.execute(sql.SQL(q).format(*format_args),strs)
     con.commit()
@@ -214,54 +359,31 @@ def query(q,sql_ids,strs,con,cur):  # needed for some raw queries, e.g., to crea
 
 
 def raw_query_via_sqlalchemy(session,q,sql_ids,strs):
-    connection = session.bind.connect()
-    con = connection.connection
-    cur = con.cursor()
-    format_args = [sql.Identifier(a) for a in sql_ids]
-    cur.execute(sql.SQL(q).format(*format_args),strs)
-    con.commit()
-    if cur.description:
-        return_item = cur.fetchall()
-    else:
-        return_item = None
-    cur.close()
-    con.close()
+    from psycopg2 import sql
+    # borrow a pooled connection, returning it to the pool when done
+    with session.bind.connect() as connection:
+        con = connection.connection
+        cur = con.cursor()
+        format_args = [sql.Identifier(a) for a in sql_ids]
+        cur.execute(sql.SQL(q).format(*format_args),strs)
+        con.commit()
+        if cur.description:
+            return_item = cur.fetchall()
+        else:
+            return_item = None
+        cur.close()
     return return_item
 
 
 def get_enumerations(session,element):
     """Returns a list of enumerations referenced in the <element> table"""
-    q = f"""
-        SELECT column_name
-        FROM information_schema.columns
-        WHERE table_name='{element}';
-    """
-    col_df = pd.read_sql(q,session.bind)
-    maybe_enum_list = [x[:-3] for x in col_df.column_name if x[-3:] == '_Id']
-    enum_list = [x for x in maybe_enum_list if f'Other{x}' in col_df.column_name.unique()]
-    return enum_list
+    return get_catalog(session.bind).enumerations(element)
 
 
 def get_foreign_key_df(session,element):
     """Returns a dataframe whose index is the name of the field in the <element> table, with columns
     foreign_table_name and foreign_column_name"""
-    q = f"""
-        SELECT
-        kcu.column_name,
-        ccu.table_name AS foreign_table_name,
-        ccu.column_name AS foreign_column_name
-        FROM
-        information_schema.table_constraints AS tc
-        JOIN information_schema.key_column_usage AS kcu
-          ON tc.constraint_name = kcu.constraint_name
-          AND tc.table_schema = kcu.table_schema
-        JOIN information_schema.constraint_column_usage AS ccu
-          ON ccu.constraint_name = tc.constraint_name
-          AND ccu.table_schema = tc.table_schema
-        WHERE tc.constraint_type = 'FOREIGN KEY' AND tc.table_name='{element}';
-    """
-    fk_df = pd.read_sql(q,session.bind,index_col='column_name')
-    return fk_df
+    return get_catalog(session.bind).foreign_keys(element).copy()
 
 
 def add_foreign_key_name_col(sess,df,foreign_key_col,foreign_key_element,drop_old=False):
@@ -276,18 +398,34 @@ def add_foreign_key_name_col(sess,df,foreign_key_col,foreign_key_element,drop_ol
     return df_copy
 
 
-def dframe_to_sql(dframe,session,table,index_col='Id',flush=True,raw_to_votecount=False,return_records='all'):
+def append_to_table(df,session,table,schema=None):
+    """Appends the rows of <df> to <table> in one transaction, taking their Ids from the database's
+    sequence as a single block where the backend doesn't assign them itself"""
+    with session.bind.begin() as conn:
+        first = dbb.for_engine(session.bind).reserve_ids(conn,df.shape[0])
+        if first is not None:
+            df = df.assign(Id=range(first,first + df.shape[0]))
+        df.to_sql(table,conn,schema=schema,if_exists='append',index=False)
+
+
+def dframe_to_sql(
+        dframe,session,table,index_col='Id',flush=True,raw_to_votecount=False,return_records='all',restrict=None):
     """
     Given a dataframe <dframe >and an existing cdf db table <table>>, clean <dframe>
     (i.e., drop any columns that are not in <table>, add null columns to match any missing columns)
     append records any new records to the corresponding table in the db (and commit!)
-    Return the updated dataframe, including all rows from the db and all from the dframe.
+    Return the updated dataframe, including all rows from the db and all from the dframe,
+    and a dictionary of errors (None if there were none); if the db refused the new records,
+    e.g. for a violated constraint, none are appended and the error is under 'integrity'.
     <return_records> is a flag defaulting to "all" (return all records in db)
     but can be set to "original" to return only the records from the input <dframe>.
+    <restrict> is an optional dictionary of column:list of values; if given, only the rows of the table
+    with those values (e.g., the vote counts of the datafile being loaded) are compared with <dframe>
+    and returned, so the work does not grow with the rest of the table.
 
     """
     # pull copy of existing table
-    target = pd.read_sql_table(table,session.bind,index_col=index_col)
+    target = read_table(session,table,index_col=index_col,restrict=restrict)
     # VoteCount table gets added columns during raw data upload, needs special treatment
 
     if dframe.empty:
@@ -297,7 +435,7 @@ def dframe_to_sql(dframe,session,table,index_col='Id',flush=True,raw_to_votecoun
             return target, None
     if raw_to_votecount:
         # join with ECSVCJ
-        secvcj = pd.read_sql_table('ElectionContestSelectionVoteCountJoin',session.bind,index_col=None)
+        secvcj = read_table(session,'ElectionContestSelectionVoteCountJoin',restrict=restrict)
         # drop columns that don't belong, but were temporarily created in order
         #  to get VoteCount_Id correctly into ECSVCJ
         target=target.drop(['ElectionContestJoin_Id','ContestSelectionJoin_Id','_datafile_Id'],axis=1)
@@ -330,20 +468,20 @@ def dframe_to_sql(dframe,session,table,index_col='Id',flush=True,raw_to_votecoun
 
     error = {}
     try:
-        appendable.to_sql(table, session.bind, if_exists='append', index=False)
+        append_to_table(appendable,session,table)
+        get_resolver(session.bind).invalidate(table)
     except sqlalchemy.exc.IntegrityError as e:
         # FIXME: target, pulled from DB, has datetime, while dframe has date,
         #  so record might look like same-name-different-date when it isn't really
-        # FIXME: IntegrityError will fail silently because it broke the dataload
-        # error["type"] = e
-        pass
+        # none of the records were appended; reported, rather than raised, since raising broke the dataload
+        error['integrity'] = str(e.orig)
     if not error:
         error = None
     
     if table == 'ReportingUnit' and not appendable.empty:
         append_to_composing_reporting_unit_join(session,appendable)
 
-    up_to_date_dframe = pd.read_sql_table(table,session.bind)
+    up_to_date_dframe = read_table(session,table,restrict=restrict)
     up_to_date_dframe = format_dates(up_to_date_dframe)
 
     if raw_to_votecount:
@@ -361,6 +499,16 @@ def dframe_to_sql(dframe,session,table,index_col='Id',flush=True,raw_to_votecoun
         return up_to_date_dframe, error
 
 
+def read_table(session,table,index_col=None,restrict=None):
+    """Reads the <table> into a dataframe, as pd.read_sql_table does; if <restrict>, a dictionary
+    of column:list of values, only the rows with those values"""
+    if not restrict:
+        return pd.read_sql_table(table,session.bind,index_col=index_col)
+    t = get_catalog(session.bind).table(table)
+    q = sqlalchemy.select([t]).where(sqlalchemy.and_(*[t.c[c].in_([py_value(v) for v in values]) for c,values in restrict.items()]))
+    return pd.read_sql(q,session.bind,index_col=index_col)
+
+
 def format_dates(dframe):
     """ensure any date columns are pulled in 2020-05-20 format"""
     df = dframe.copy()
@@ -380,8 +528,6 @@ def save_one_to_db(session,element,record,upsert=False):
     changed = False
     ok = False
 
-    # define regex for pulling info from IntegrityError
-    pattern = re.compile(r'Key \((?P<fields>.+)\)=\((?P<values>.+)\) already exists.')
     while not ok:
         problems = []
         if record == {}:
@@ -390,20 +536,19 @@ def save_one_to_db(session,element,record,upsert=False):
             df = pd.DataFrame({k:[v] for k,v in record.items()})
             # currently this upsert only used for the _datafile record
             if upsert:
-                session.execute(f'''
-                    DELETE FROM _datafile 
-                    WHERE short_name = '{record['short_name']}';''')
-                session.commit()                
-            df.to_sql(element,session.bind,if_exists='append',index=False)
+                # remove the old record, with everything loaded from it
+                existing = name_to_id(session,element,record[get_name_field(element)])
+                if existing is not None:
+                    remove_datafile(session,existing)
+            append_to_table(df,session,element)
+            get_resolver(session.bind).invalidate(element)
             enum_plaintext_dict = mr.enum_plaintext_dict_from_db_record(session,element,record)
             fk_plaintext_dict = mr.fk_plaintext_dict_from_db_record(
                 session,element,record,excluded=enum_plaintext_dict.keys())
             db_idx = name_to_id(session,element,record[get_name_field(element)])
         except sqlalchemy.exc.IntegrityError as e:
-            if 'duplicate key value violates unique constraint' in e.orig.pgerror:
-                m = pattern.search(e.orig.pgerror)
-                field_str = m.group("fields")
-                value_str = m.group("values")
+            field_str, value_str = dbb.for_engine(session.bind).duplicate_key(e,record)
+            if field_str:
                 use_existing = input(f'Record already exists with value(s)\n\t{value_str}\n'
                                     f'in field(s)\n\t{field_str}\n'
                                     f'Use existing record (y/n?\n')
@@ -436,51 +581,381 @@ def save_one_to_db(session,element,record,upsert=False):
     return [db_idx, record, enum_plaintext_dict, fk_plaintext_dict, changed]
 
 
-def name_from_id(session,element,idx):
+class NameResolver:
+    """Translates between the Ids and the names (see get_name_field) of records in the database behind
+    the engine <eng>, a whole list or series at a time. Each batch of values not yet known is looked up
+    in one parameterized query; the answers are kept until the table is written to (see invalidate).
+    Use get_resolver(eng) rather than creating a NameResolver directly."""
+    batch_size = 1000
+
+    def __init__(self,eng):
+        self.eng = eng
+        self.to_id = {}  # element -> {name:Id}
+        self.from_id = {}  # element -> {Id:name}
+
+    def lookup(self,element,by,values):
+        """Reads from the db the records of <element> whose <by> field ('Id' or the name field)
+        is one of <values> and remembers their Ids and names"""
+        to_id = self.to_id.setdefault(element,{})
+        from_id = self.from_id.setdefault(element,{})
+        for idx, name in select_ids_and_names(self.eng,element,by,values):
+            # as before, the first record found wins if names are not unique
+            to_id.setdefault(name,idx)
+            from_id[idx] = name
+
+    def resolve(self,element,values,direction):
+        """Returns a series (with the index of <values>, if it is a series) of the Ids (if <direction>
+        is 'to_id') or names (if 'from_id') of <values>; null where there is no such record"""
+        values = pd.Series(values)
+        known = getattr(self,direction).setdefault(element,{})
+        distinct = {v:py_value(v) for v in values.dropna().unique()}
+        unknown = [v for v in distinct.values() if v not in known.keys()]
+        if unknown:
+            if direction == 'to_id':
+                self.lookup(element,get_name_field(element),unknown)
+            else:
+                self.lookup(element,'Id',unknown)
+        return values.map({v:known[p] for v,p in distinct.items() if p in known.keys()})
+
+    def names_to_ids(self,element,names):
+        return self.resolve(element,names,'to_id')
+
+    def ids_to_names(self,element,ids):
+        return self.resolve(element,ids,'from_id')
+
+    def invalidate(self,element=None):
+        """Forget what is known about <element> (or about all elements)"""
+        if element is None:
+            self.to_id = {}
+            self.from_id = {}
+        else:
+            self.to_id.pop(element,None)
+            self.from_id.pop(element,None)
+
+
+# one NameResolver per engine
+resolvers = {}
+
+
+def get_resolver(eng):
+    if eng not in resolvers.keys():
+        resolvers[eng] = NameResolver(eng)
+    return resolvers[eng]
+
+
+def py_value(value):
+    """<value> as a plain python object (e.g., 3 rather than numpy.int64(3) or 3.0), for use as a query parameter"""
+    if hasattr(value,'item'):
+        value = value.item()
+    if isinstance(value,float) and value.is_integer():
+        value = int(value)
+    return value
+
+
+def select_ids_and_names(eng,element,by,values):
+    """Returns a list of the (Id, name) pairs of the records of <element> whose <by> field ('Id' or the
+    name field) is one of <values>, read in one parameterized query per NameResolver.batch_size values"""
     name_field = get_name_field(element)
-    q = f"""SELECT "{name_field}" FROM "{element}" WHERE "Id" = {idx}"""
-    name_df = pd.read_sql(q,session.bind)
-    try:
-        name = name_df.loc[0,name_field]
-    except KeyError:
+    values = [py_value(v) for v in values]
+    q = sqlalchemy.text(
+        f'SELECT "Id", "{name_field}" FROM "{element}" WHERE "{by}" IN :values').bindparams(
+        sqlalchemy.bindparam('values',expanding=True))
+    pairs = []
+    with eng.connect() as conn:
+        for i in range(0,len(values),NameResolver.batch_size):
+            pairs += conn.execute(q,{'values':values[i:i + NameResolver.batch_size]}).fetchall()
+    return [tuple(p) for p in pairs]
+
+
+def read_name_ids(session,element,names,name_ids):
+    """Adds to the dictionary <name_ids> (of name -> Id for <element>) those of the <names> it lacks,
+    reading them from the db in as few queries as possible. Names not found in the db are left out."""
+    unknown = [n for n in dict.fromkeys(names) if n not in name_ids.keys()]
+    if unknown:
+        for idx, name in select_ids_and_names(session.bind,element,get_name_field(element),unknown):
+            # as in NameResolver, the first record found wins if names are not unique
+            name_ids.setdefault(name,idx)
+    return name_ids
+
+
+def names_to_ids(session,element,names):
+    """Returns a series of the Ids of the <element> records named in the list or series <names>"""
+    return get_resolver(session.bind).names_to_ids(element,names)
+
+
+def names_from_ids(session,element,ids):
+    """Returns a series of the names of the <element> records with the Ids in the list or series <ids>"""
+    return get_resolver(session.bind).ids_to_names(element,ids)
+
+
+def name_from_id(session,element,idx):
+    name = names_from_ids(session,element,[idx])[0]
+    if pd.isnull(name):
         # if no record with Id = <idx> was found
         name = None
     return name
 
 
 def name_to_id(session,element,name):
-    name_field = get_name_field(element)
-    q = f"""SELECT "Id" FROM "{element}" WHERE "{name_field}" = '{name}' """
-    idx_df = pd.read_sql(q,session.bind)
-    try:
-        idx = idx_df.loc[0,'Id']
-    except KeyError:
+    idx = names_to_ids(session,element,[name])[0]
+    if pd.isnull(idx):
         # if no record with name <name> was found
         idx = None
     return idx
 
 
 def get_name_field(element):
-    # TODO pull from db or filesystem instead of hard coding
-    if element == 'BallotMeasureSelection':
-        field = 'Selection'
-    elif element == 'Candidate':
-        field = 'BallotName'
-    elif element in ['CountItemType','ElectionType','IdentifierType','ReportingUnitType']:
-        field = 'Txt'
-    elif element == '_datafile':
-        field = 'short_name'
-    else:
-        field = 'Name'
-    return field
+    """Returns the field holding the plain-text name of each record of <element> (e.g., 'BallotName' for
+    Candidate), as given by the schema definition; 'Name' for tables without one"""
+    if not name_fields:
+        name_fields.update(db_cdf.name_fields(schema_def_dir))
+    return name_fields.get(element,'Name')
+
+
+def records_query(session,element,filters=None,name_prefix=None):
+    """Returns a query (a sqlalchemy Select) for the records of <element>, with a plaintext column for
+    each enumeration (e.g., ReportingUnitType, beside ReportingUnitType_Id and OtherReportingUnitType),
+    restricted to those matching the dictionary <filters> of <field>:<value> (fields that are neither
+    columns nor enumerations of <element> are ignored) and, if <name_prefix> is given,
+    to those whose name starts with <name_prefix>. Records are ordered by name, then Id."""
+    catalog = get_catalog(session.bind)
+    t = catalog.table(element)
+    columns = list(t.c)
+    plaintext = {}
+    from_clause = t
+    for e in catalog.enumerations(element):
+        e_table = catalog.table(e).alias(f'_enum_{e}')
+        other = t.c[f'Other{e}']
+        plaintext[e] = sqlalchemy.case(
+            [(sqlalchemy.and_(e_table.c.Txt == 'other',sqlalchemy.func.coalesce(other,'') != ''),other)],
+            else_=e_table.c.Txt)
+        from_clause = from_clause.outerjoin(e_table,t.c[f'{e}_Id'] == e_table.c.Id)
+        columns.append(plaintext[e].label(e))
+    q = sqlalchemy.select(columns).select_from(from_clause)
+
+    for field, value in (filters or {}).items():
+        if field in t.c.keys():
+            q = q.where(t.c[field] == py_value(value))
+        elif field in plaintext.keys():
+            q = q.where(plaintext[field] == py_value(value))
+    name_field = get_name_field(element)
+    if name_field in t.c.keys():
+        if name_prefix:
+            q = q.where(t.c[name_field].startswith(name_prefix,autoescape=True))
+        q = q.order_by(t.c[name_field])
+    return q.order_by(t.c.Id)
+
+
+def query_records(session,element,filters=None,name_prefix=None,limit=None,offset=0):
+    """Returns a dataframe, indexed by Id, of at most <limit> records of <element> (skipping the first
+    <offset>) chosen and ordered as in records_query"""
+    q = records_query(session,element,filters=filters,name_prefix=name_prefix)
+    if limit is not None:
+        q = q.limit(limit)
+    if offset:
+        q = q.offset(offset)
+    t = get_catalog(session.bind).table(element)
+    dates = [c.name for c in t.c if isinstance(c.type,(sqlalchemy.Date,sqlalchemy.DateTime))]
+    return pd.read_sql(q,session.bind,index_col='Id',parse_dates=dates)
+
+
+def record_by_id(session,element,idx):
+    """Returns a dictionary of <field>:<value> (excluding Id) for the record of <element> with Id <idx>;
+    None if there is no such record"""
+    t = get_catalog(session.bind).table(element)
+    df = pd.read_sql(
+        sqlalchemy.select([t]).where(t.c.Id == py_value(idx)),session.bind,index_col='Id',
+        parse_dates=[c.name for c in t.c if isinstance(c.type,(sqlalchemy.Date,sqlalchemy.DateTime))])
+    if df.empty:
+        return None
+    return df.iloc[0].to_dict()
+
+
+@contextmanager
+def indexes_deferred(session,tables):
+    """Within the block, the secondary indexes (see indexes.txt in the schema definition) of those of
+    <tables> that are empty are dropped, to be rebuilt at the end: for a first bulk load into a table,
+    building each index once afterward is faster than updating it for every row.
+    This is done in a session of its own, so nothing is committed in <session>; but the index
+    statements wait for any uncommitted writes to <tables> (on SQLite, to any table) in <session>."""
+    own_session = sqlalchemy.orm.Session(bind=session.bind)
+    empty = []
+    try:
+        empty = [t for t in tables if own_session.execute(f'SELECT 1 FROM "{t}" LIMIT 1').fetchone() is None]
+        own_session.commit()
+        if empty:
+            db_cdf.drop_indexes(own_session,schema_def_dir,empty)
+        yield empty
+    finally:
+        try:
+            if empty:
+                db_cdf.create_indexes(own_session,schema_def_dir,empty)
+        finally:
+            own_session.close()
 
 
 def truncate_table(session, table_name):
-    session.execute(f'TRUNCATE TABLE "{table_name}" CASCADE')
-    session.commit()
+    dbb.for_engine(session.bind).truncate(session,table_name)
+    # truncation cascades to other tables
+    get_resolver(session.bind).invalidate()
+    forget_element_hashes(session)
     return
 
 
+def get_element_hashes(session,juris):
+    """Returns a dictionary of element -> hash (see juris_and_munger.element_hashes) for the elements of the
+    jurisdiction <juris> (its short name) as last loaded into the database"""
+    if '_element_hash' not in get_catalog(session.bind).table_names():
+        # database created before element hashes were kept
+        return {}
+    q = sqlalchemy.text('SELECT element, content_hash FROM _element_hash WHERE jurisdiction = :juris')
+    return {r[0]:r[1] for r in session.execute(q,{'juris':juris}).fetchall()}
+
+
+def save_element_hashes(session,juris,hashes):
+    """Records the dictionary <hashes> of element -> hash for the jurisdiction <juris> (its short name),
+    replacing any earlier hashes for those elements"""
+    if not hashes or '_element_hash' not in get_catalog(session.bind).table_names():
+        return
+    records = [{'juris':juris,'element':e,'content_hash':h} for e,h in hashes.items()]
+    session.execute(
+        sqlalchemy.text('DELETE FROM _element_hash WHERE jurisdiction = :juris AND element = :element'),records)
+    first = dbb.for_engine(session.bind).reserve_ids(session.connection(),len(records))
+    if first is None:
+        q = 'INSERT INTO _element_hash (jurisdiction, element, content_hash) VALUES (:juris, :element, :content_hash)'
+    else:
+        records = [dict(r,Id=first + i) for i,r in enumerate(records)]
+        q = 'INSERT INTO _element_hash ("Id", jurisdiction, element, content_hash) VALUES (:Id, :juris, :element, :content_hash)'
+    session.execute(sqlalchemy.text(q),records)
+    session.commit()
+
+
+def forget_element_hashes(session,juris=None):
+    """Forgets the hashes of the elements of the jurisdiction <juris> (default: of all jurisdictions),
+    so that they are all loaded again next time"""
+    if '_element_hash' not in get_catalog(session.bind).table_names():
+        return
+    if juris is None:
+        session.execute('DELETE FROM _element_hash')
+    else:
+        session.execute(sqlalchemy.text('DELETE FROM _element_hash WHERE jurisdiction = :juris'),{'juris':juris})
+    session.commit()
+
+
+def create_datafile_partitions(session,datafile_id):
+    """Creates (where the backend partitions tables) the partitions of VoteCount and
+    ElectionContestSelectionVoteCountJoin for the datafile with Id <datafile_id>, if they do not exist yet"""
+    db_cdf.create_partitions(session.connection(),schema_def_dir,int(datafile_id))
+    session.commit()
+
+
+# tables holding the facts loaded from a datafile, in the order they can be deleted
+datafile_tables = ['ElectionContestSelectionVoteCountJoin','VoteCount']
+
+
+def delete_datafile_rows(session,datafile_id):
+    """Deletes (without committing) the rows of each of the datafile_tables loaded from the datafile
+    with Id <datafile_id>: where the datafile has partitions of its own (see create_datafile_partitions),
+    they are detached and dropped; otherwise the rows are deleted by datafile in one statement per table.
+    Returns a dictionary of the number of rows removed from each table."""
+    datafile_id = int(datafile_id)
+    conn = session.connection()
+    backend = dbb.for_engine(session.bind)
+    backend.defer_constraints(conn)
+    partitions = db_cdf.partitioned_tables(schema_def_dir)
+    removed = {}
+    for table in datafile_tables:
+        count = None
+        if table in partitions.keys():
+            count = backend.drop_partition(conn,table,partitions[table],datafile_id)
+        if count is None:
+            count = conn.execute(f'DELETE FROM "{table}" WHERE "_datafile_Id" = {datafile_id}').rowcount
+        removed[table] = count
+    return removed
+
+
+def delete_datafile_vote_counts(session,datafile_id):
+    """Delete all VoteCounts loaded from the datafile with Id <datafile_id>, together with
+    their ElectionContestSelectionVoteCountJoin records, in one transaction (see delete_datafile_rows).
+    Returns the number of VoteCounts deleted."""
+    try:
+        removed = delete_datafile_rows(session,datafile_id)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    get_resolver(session.bind).invalidate('VoteCount')
+    return removed['VoteCount']
+
+
+def remove_datafile(session,datafile_id):
+    """Removes the datafile with Id <datafile_id>: its _datafile record and everything loaded from it,
+    in one transaction. Returns a dictionary of the number of rows removed from each table."""
+    election_id = session.execute(f'SELECT "Election_Id" FROM _datafile WHERE "Id" = {int(datafile_id)}').scalar()
+    try:
+        removed = delete_datafile_rows(session,datafile_id)
+        removed['_datafile'] = session.execute(f'DELETE FROM _datafile WHERE "Id" = {int(datafile_id)}').rowcount
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    for table in ['VoteCount','_datafile']:
+        get_resolver(session.bind).invalidate(table)
+    forget_rollups(election_id)
+    return removed
+
+
+def forget_rollups(election_id):
+    """Discards the cached rollups of the election, now out of date"""
+    from election_anomaly import analyze_via_pandas as avp
+    if election_id is not None:
+        avp.rollup_cache.invalidate(election_id)
+
+
+def replace_datafile(session,datafile_id,staged_id):
+    """Swaps in the datafile with Id <staged_id>, already loaded alongside the datafile with Id <datafile_id>
+    (under a different short_name; see stage_datafile), in its place: in one transaction, the old datafile
+    is removed and the staged one takes its short_name. Until then the old results stay in place, so readers
+    see either all the old results or all the new.
+    Returns a dictionary of the number of rows removed from each table."""
+    short_name, election_id = session.execute(
+        f'SELECT short_name, "Election_Id" FROM _datafile WHERE "Id" = {int(datafile_id)}').fetchone()
+    try:
+        removed = delete_datafile_rows(session,datafile_id)
+        removed['_datafile'] = session.execute(f'DELETE FROM _datafile WHERE "Id" = {int(datafile_id)}').rowcount
+        session.execute(
+            sqlalchemy.text('UPDATE _datafile SET short_name = :short_name WHERE "Id" = :idx'),
+            {'short_name':short_name,'idx':int(staged_id)})
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    for table in ['VoteCount','_datafile']:
+        get_resolver(session.bind).invalidate(table)
+    forget_rollups(election_id)
+    return removed
+
+
+# marks the short_name of a staged datafile (see stage_datafile)
+staged_suffix = ' (replacement '
+
+
+def stage_datafile(session,datafile_id):
+    """Creates a copy of the _datafile record with Id <datafile_id>, under a temporary short_name, to load
+    a new version of the file into before swapping it in with replace_datafile. Returns the Id of the copy."""
+    record = record_by_id(session,'_datafile',int(datafile_id))
+    record['short_name'] = f'{record["short_name"]}{staged_suffix}{datetime.datetime.now().isoformat()})'
+    return insert_record(session,'_datafile',record)
+
+
+def insert_record(session,element,record):
+    """Inserts the dictionary <record> (of field:value) into <element>, without asking the user about
+    problems as save_one_to_db does: e.g., a duplicate raises an IntegrityError. Returns the Id of the new record."""
+    append_to_table(pd.DataFrame([record]),session,element)
+    get_resolver(session.bind).invalidate(element)
+    return name_to_id(session,element,record[get_name_field(element)])
+
+
 def get_input_options(session, input):
     """Returns a list of response options based on the input"""
     # input comes as a pythonic (snake case) input, need to 
@@ -518,9 +993,12 @@ def get_input_options(session, input):
 
 
 def get_datafile_info(session, results_file):
-    q = session.execute(f'''
-        SELECT "Id", "Election_Id" 
-        FROM _datafile 
-        WHERE file_name = '{results_file}'
-        ''').fetchall()
+    """Returns the Id and Election_Id of the datafile for <results_file>, ignoring staged copies
+    (see stage_datafile); raises an IndexError if there is none."""
+    q = session.execute(sqlalchemy.text('''
+        SELECT "Id", "Election_Id"
+        FROM _datafile
+        WHERE file_name = :file_name AND short_name NOT LIKE :staged
+        ORDER BY "Id"
+        '''),{'file_name':results_file,'staged':f'%{staged_suffix}%'}).fetchall()
     return q[0]
\ No newline at end of file
@@ -0,0 +1,340 @@
+"""Database backends. Everything that depends on the flavor of database -- connecting,
+creating and resetting databases, reading the catalog, assigning Ids -- lives here.
+PostgreSQL is the default; an embedded SQLite file is used when the database parameter file
+has a [sqlite] section, e.g.
+
+[sqlite]
+directory=/Users/user/Documents/db
+
+(the database <db_name> is then the file <directory>/<db_name>.db).
+Either section may also set pool_size, max_overflow and pool_recycle (seconds) for the connection pool."""
+import os
+import re
+import pandas as pd
+import sqlalchemy as db
+from sqlalchemy import event, Column, Integer
+from sqlalchemy.pool import QueuePool
+
+# pool settings, which may be overridden in the database parameter file
+pool_defaults = {'pool_size':5,'max_overflow':10,'pool_recycle':3600}
+
+
+def for_engine(eng):
+    """Returns the backend for the SQLAlchemy engine <eng>"""
+    if eng.dialect.name == 'sqlite':
+        return SqliteBackend({'directory':os.path.dirname(eng.url.database or '')})
+    return PostgresBackend({})
+
+
+class PostgresBackend:
+    name = 'postgresql'
+    # declarative partitioning, with foreign keys to partitioned tables (PostgreSQL 12 or later)
+    partitioning = True
+
+    def __init__(self,params):
+        self.params = params
+
+    def create_engine(self,db_name):
+        params = dict(self.params)
+        if db_name != 'postgres':
+            params['dbname'] = db_name
+        # We connect with the help of the PostgreSQL URL
+        url = 'postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**params)
+        # pre-ping replaces pooled connections dropped by the server
+        return db.create_engine(url,client_encoding='utf8',pool_pre_ping=True,**pool_options(self.params))
+
+    def connect_params(self,db_name):
+        params = {k:v for k,v in self.params.items() if k not in pool_defaults.keys()}
+        params['dbname'] = db_name
+        return params
+
+    def can_connect(self,eng):
+        try:
+            eng.connect().close()
+        except db.exc.OperationalError:
+            return False
+        return True
+
+    def database_exists(self,db_name):
+        import psycopg2
+        from election_anomaly import db_routines as dbr
+        con = psycopg2.connect(**self.connect_params('postgres'))
+        exists = db_name in dbr.get_database_names(con).datname.unique()
+        con.close()
+        return exists
+
+    def create_database(self,db_name):
+        import psycopg2
+        from election_anomaly import db_routines as dbr
+        con = psycopg2.connect(**self.connect_params('postgres'))
+        dbr.create_database(con,con.cursor(),db_name)
+        con.close()
+
+    def column_catalog(self,eng,table=None):
+        """Returns a dataframe with columns table_name and column_name for every column of every table
+        (or just of <table>)"""
+        q = """SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = 'public'"""
+        if table:
+            q += f""" AND table_name = '{table}'"""
+        q += ' ORDER BY table_name, ordinal_position'
+        return pd.read_sql(q,eng)
+
+    def foreign_keys(self,eng,table):
+        """Returns a dataframe whose index is the name of the field in the <table> table, with columns
+        foreign_table_name and foreign_column_name"""
+        q = f"""
+            SELECT
+            kcu.column_name,
+            ccu.table_name AS foreign_table_name,
+            ccu.column_name AS foreign_column_name
+            FROM
+            information_schema.table_constraints AS tc
+            JOIN information_schema.key_column_usage AS kcu
+              ON tc.constraint_name = kcu.constraint_name
+              AND tc.table_schema = kcu.table_schema
+            JOIN information_schema.constraint_column_usage AS ccu
+              ON ccu.constraint_name = tc.constraint_name
+              AND ccu.table_schema = tc.table_schema
+            WHERE tc.constraint_type = 'FOREIGN KEY' AND tc.table_name='{table}';
+        """
+        return pd.read_sql(q,eng,index_col='column_name')
+
+    def id_column(self,id_seq):
+        """Column definition for the Id of every table; all Ids come from the single sequence <id_seq>"""
+        return Column('Id',Integer,id_seq,server_default=id_seq.next_value(),primary_key=True)
+
+    def after_create_tables(self,conn,table_names):
+        pass
+
+    def reserve_ids(self,conn,n):
+        # the server default takes each Id from id_seq
+        return None
+
+    def defer_constraints(self,conn):
+        # only deferrable constraints are deferred: the foreign keys of the datafile tables
+        #  (see create_cdf_db.deferrable_tables), checked at commit
+        conn.execute('SET CONSTRAINTS ALL DEFERRED')
+
+    def partition_by(self,column):
+        """Keyword arguments for sqlalchemy's Table making it a table partitioned by the value of <column>"""
+        return {'postgresql_partition_by':f'LIST ("{column}")'}
+
+    def partition_name(self,table,value):
+        return f'{table}_p{int(value)}'
+
+    def create_partition(self,conn,table,column,value):
+        """Creates the partition of <table> holding the rows whose <column> is <value>
+        (or, if <value> is None, the default partition for rows with no partition of their own)"""
+        if value is None:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}_default" PARTITION OF "{table}" DEFAULT')
+        else:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS "{self.partition_name(table,value)}"
+                PARTITION OF "{table}" FOR VALUES IN ({int(value)})''')
+
+    def drop_partition(self,conn,table,column,value):
+        """Detaches and drops the partition of <table> for <column> = <value>, if there is one.
+        Returns the number of rows dropped, or None if there is no such partition (e.g., the rows are in
+        the default partition)"""
+        partition = self.partition_name(table,value)
+        exists = conn.execute(f"SELECT to_regclass('\"{partition}\"')").scalar()
+        if exists is None:
+            return None
+        count = conn.execute(f'SELECT count(*) FROM "{partition}"').scalar()
+        conn.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{partition}"')
+        conn.execute(f'DROP TABLE "{partition}"')
+        return count
+
+    def drop_tables(self,eng,table_names):
+        conn = eng.connect()
+        conn.execute('DROP SEQUENCE IF EXISTS id_seq CASCADE;')
+        for table in table_names:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE;')
+        conn.close()
+
+    def seq_scans(self,conn,statement,parameters):
+        """Returns the list of tables read by sequential scan in the plan for <statement>"""
+        # (a plain string, so the statement and its parameters go to the driver as they were sent)
+        plan = conn.execute(f'EXPLAIN (FORMAT JSON) {statement}',parameters).fetchone()[0]
+        scanned = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Node Type') == 'Seq Scan':
+                scanned.append(node['Relation Name'])
+            nodes += node.get('Plans',[])
+        return scanned
+
+    def truncate(self,session,table):
+        session.execute(f'TRUNCATE TABLE "{table}" CASCADE')
+        session.commit()
+
+    def add_integer_cols(self,session,table,col_list):
+        from election_anomaly import db_routines as dbr
+        add = ','.join([f' ADD COLUMN "{c}" INTEGER' for c in col_list])
+        dbr.raw_query_via_sqlalchemy(session,f'ALTER TABLE "{table}" {add}',[],[])
+
+    def drop_cols(self,session,table,col_list):
+        from election_anomaly import db_routines as dbr
+        drop = ','.join([f' DROP COLUMN "{c}"' for c in col_list])
+        dbr.raw_query_via_sqlalchemy(session,f'ALTER TABLE "{table}" {drop}',[],[])
+
+    def duplicate_key(self,e,record):
+        """If IntegrityError <e> is a violated unique constraint, returns comma-separated strings of
+        the fields and the values involved; otherwise returns None, None"""
+        msg = e.orig.pgerror or ''
+        if 'duplicate key value violates unique constraint' not in msg:
+            return None, None
+        m = re.search(r'Key \((?P<fields>.+)\)=\((?P<values>.+)\) already exists.',msg)
+        return m.group('fields'), m.group('values')
+
+
+class SqliteBackend:
+    name = 'sqlite'
+    # no table partitioning in sqlite: rows of partitioned tables are found through their indexes instead
+    partitioning = False
+
+    def __init__(self,params):
+        self.params = params
+
+    def path(self,db_name):
+        return os.path.join(self.params.get('directory',''),f'{db_name}.db')
+
+    def create_engine(self,db_name):
+        # a pool, rather than sqlalchemy's default of one new connection per checkout, so that
+        # connections (with their page caches) are reused
+        eng = db.create_engine(
+            f'sqlite:///{self.path(db_name)}',poolclass=QueuePool,pool_pre_ping=True,
+            # writers (e.g., threads loading jurisdiction elements) wait up to a minute for each other
+            connect_args={'check_same_thread':False,'timeout':60},**pool_options(self.params))
+        event.listen(eng,'connect',set_pragmas)
+        return eng
+
+    def can_connect(self,eng):
+        # connecting would create the file
+        return os.path.isfile(eng.url.database)
+
+    def database_exists(self,db_name):
+        return os.path.isfile(self.path(db_name))
+
+    def create_database(self,db_name):
+        if os.path.isfile(self.path(db_name)):
+            os.remove(self.path(db_name))
+        # sqlite creates the file on first connection
+        eng = self.create_engine(db_name)
+        eng.connect().close()
+        eng.dispose()
+
+    def column_catalog(self,eng,table=None):
+        """Returns a dataframe with columns table_name and column_name for every column of every table
+        (or just of <table>), in one query"""
+        q = """
+            SELECT m.name AS table_name, p.name AS column_name
+            FROM sqlite_master m JOIN pragma_table_info(m.name) p
+            WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite%%' AND m.name != '_id_seq'"""
+        if table:
+            q += f""" AND m.name = '{table}'"""
+        return pd.read_sql(q,eng)
+
+    def foreign_keys(self,eng,table):
+        """Returns a dataframe whose index is the name of the field in the <table> table, with columns
+        foreign_table_name and foreign_column_name"""
+        q = f"""
+            SELECT "from" AS column_name, "table" AS foreign_table_name, "to" AS foreign_column_name
+            FROM pragma_foreign_key_list('{table}')"""
+        return pd.read_sql(q,eng,index_col='column_name')
+
+    def id_column(self,id_seq):
+        # INTEGER PRIMARY KEY is the rowid; inserts set it explicitly from _id_seq (see reserve_ids)
+        return Column('Id',Integer,primary_key=True)
+
+    def after_create_tables(self,conn,table_names):
+        """SQLite has no sequences, so Ids unique across all tables (as with PostgreSQL's id_seq)
+        come from the AUTOINCREMENT counter of the table _id_seq, kept in sqlite_sequence
+        (see reserve_ids). <conn> is the connection creating the tables."""
+        conn.execute('CREATE TABLE IF NOT EXISTS _id_seq ("Id" INTEGER PRIMARY KEY AUTOINCREMENT)')
+        conn.execute("""
+            INSERT INTO sqlite_sequence (name, seq) SELECT '_id_seq', 0
+            WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = '_id_seq')""")
+
+    def reserve_ids(self,conn,n):
+        """Takes a block of <n> Ids from the counter of _id_seq, in the transaction of <conn>, and returns
+        the first; the block is the caller's alone, since the update holds the database's write lock
+        until the transaction ends"""
+        conn.execute(f"UPDATE sqlite_sequence SET seq = seq + {int(n)} WHERE name = '_id_seq'")
+        return conn.execute("SELECT seq FROM sqlite_sequence WHERE name = '_id_seq'").scalar() - int(n) + 1
+
+    def defer_constraints(self,conn):
+        """Checks foreign keys once, at commit, rather than row by row, for the rest of the transaction"""
+        conn.execute('PRAGMA defer_foreign_keys = ON')
+
+    def partition_by(self,column):
+        return {}
+
+    def create_partition(self,conn,table,column,value):
+        pass
+
+    def drop_partition(self,conn,table,column,value):
+        return None
+
+    def drop_tables(self,eng,table_names):
+        conn = eng.connect()
+        # no CASCADE in sqlite; instead, switch off foreign key checks while dropping
+        conn.execute('PRAGMA foreign_keys = OFF')
+        for table in list(table_names) + ['_id_seq']:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.close()
+
+    def seq_scans(self,conn,statement,parameters):
+        """Returns the list of tables (or aliases) read by full scan, not via an index, in the plan for <statement>"""
+        plan = conn.execute(f'EXPLAIN QUERY PLAN {statement}',parameters).fetchall()
+        scanned = []
+        for r in plan:
+            # e.g. 'SCAN VoteCount' (older SQLite: 'SCAN TABLE VoteCount'); 'SCAN ... USING INDEX ...' is not a full scan
+            words = r[3].replace('SCAN TABLE ','SCAN ').split()
+            if words[0] == 'SCAN' and 'INDEX' not in words and words[1] not in ['SUBQUERY','CONSTANT']:
+                scanned.append(words[1])
+        return scanned
+
+    def truncate(self,session,table):
+        from election_anomaly import db_routines as dbr
+        # no TRUNCATE ... CASCADE in sqlite: empty the tables referring to <table> first
+        for t in dbr.get_catalog(session.bind).referring_tables(table) + [table]:
+            session.execute(f'DELETE FROM "{t}"')
+        session.commit()
+
+    def add_integer_cols(self,session,table,col_list):
+        # one column per ALTER TABLE in sqlite
+        for c in col_list:
+            session.execute(f'ALTER TABLE "{table}" ADD COLUMN "{c}" INTEGER')
+        session.commit()
+
+    def drop_cols(self,session,table,col_list):
+        for c in col_list:
+            session.execute(f'ALTER TABLE "{table}" DROP COLUMN "{c}"')
+        session.commit()
+
+    def duplicate_key(self,e,record):
+        """If IntegrityError <e> is a violated unique constraint, returns comma-separated strings of
+        the fields and the values involved; otherwise returns None, None"""
+        m = re.search(r'UNIQUE constraint failed: (?P<cols>.+)',str(e.orig))
+        if not m:
+            return None, None
+        fields = [x.strip().split('.')[-1] for x in m.group('cols').split(',')]
+        return ','.join(fields), ','.join(str(record.get(f)) for f in fields)
+
+
+def pool_options(params):
+    return {k:int(params.get(k,v)) for k,v in pool_defaults.items()}
+
+
+def set_pragmas(dbapi_con,connection_record):
+    """Settings for each new sqlite connection: enforce foreign keys (as PostgreSQL does),
+    and trade some durability on power loss for much faster bulk inserts"""
+    cur = dbapi_con.cursor()
+    cur.execute('PRAGMA foreign_keys = ON')
+    cur.execute('PRAGMA journal_mode = WAL')
+    cur.execute('PRAGMA synchronous = NORMAL')
+    cur.execute('PRAGMA temp_store = MEMORY')
+    cur.execute('PRAGMA cache_size = -65536')
+    cur.close()
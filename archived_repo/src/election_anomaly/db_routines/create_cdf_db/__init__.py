@@ -3,149 +3,295 @@
 # TODO consistency check on SelectionElectionContestVoteCountJoin to make sure ElectionContestJoin_Id
 #  and ContestSelectionJoin_Id share a contest? Should this happen during the rollup process?
 
+import hashlib
+import json
 import sqlalchemy
-from sqlalchemy import MetaData, Table, Column,CheckConstraint,UniqueConstraint,Integer,String,ForeignKey, Date
+from sqlalchemy import MetaData, Table, Column,CheckConstraint,UniqueConstraint,Integer,String,ForeignKey, Date, Index, \
+    ForeignKeyConstraint
 import os
 import pandas as pd
+from election_anomaly.db_routines import backends as dbb
 
+# the compiled schema, kept in the CDF_schema_def_info directory beside the files it is compiled from
+#  (regenerated by save_compiled_schema, not at run time)
+compiled_file_name = 'compiled_schema.json'
+datatypes = {'String':String,'Encoding':String,'Integer':Integer,'Date':Date}
+# compiled schemas already read in this process, by directory
+schemas = {}
 
-def create_common_data_format_tables(session,dirpath='CDF_schema_def_info/'):
+
+def create_common_data_format_tables(session,dirpath='CDF_schema_def_info/',defer_indexes=False):
     """ schema example: 'cdf'; Creates cdf tables in the given schema
     (or directly in the db if schema == None)
-    e_table_list is a list of enumeration tables for the CDF, e.g., ['ReportingUnitType','CountItemType', ... ]
+    from the compiled schema definition in <dirpath> (see load_schema), in a single transaction.
+    The secondary indexes (from indexes.txt) are created too, unless <defer_indexes>, in which case
+    create_indexes should be called once the tables are loaded.
+    If the backend supports it, tables with a partition_by.txt are partitioned, with a default partition
+    (see create_partitions).
     Does *not* fill enumeration tables.
     """
     eng = session.bind
-    metadata = MetaData(bind=eng)
+    backend = dbb.for_engine(eng)
+    metadata = MetaData()
+    partitions = partitioned_tables(dirpath)
 
     # create the single sequence for all db ids
     id_seq = sqlalchemy.Sequence('id_seq', metadata=metadata)
-
-    # create enumeration tables 
-    e_table_list = enum_table_list(dirpath)
-    for t in e_table_list:
-        create_table(metadata,id_seq,t,'enumerations',dirpath,eng,session)
-    
-    # create element tables (cdf and metadata) and push to db
-    element_path = os.path.join(dirpath, 'elements')
-    elements_to_process = [f for f in os.listdir(element_path) if f[0] != '.']
-    # dynamic list of elements whose tables haven't been created yet
-    while elements_to_process:
-        element = elements_to_process[0]
-        # check foreign keys; if any refers to an elt yet to be processed, change to that elt
-        #  note that any foreign keys for elements are to other elements, so it's OK to do this without considering
-        #  joins first or concurrently.
-        foreign_keys = pd.read_csv(os.path.join(element_path,element,'foreign_keys.txt'),sep='\t')
-        for i,r in foreign_keys.iterrows():
-            fk_set = set(r['refers_to'].split(';'))    # lists all targets of the foreign key r['fieldname']
-            try:
-                element = [e for e in fk_set if e in elements_to_process].pop()
-                break
-            except IndexError:
-                pass
-        # create db table for element
-        create_table(metadata,id_seq,element,'elements',dirpath,eng,session)
-        # remove element from list of yet-to-be-processed
-        elements_to_process.remove(element)
-
-    # create join tables
-    # TODO check for foreign keys, as above
-    # check for foreign keys
-    join_path = os.path.join(dirpath,'joins')
-    joins_to_process = [f for f in os.listdir(join_path) if f[0] != '.']
-    while joins_to_process:
-        j = joins_to_process[0]
-        # check foreign keys; if any refers to an elt yet to be processed, change to that elt
-        #  note that any foreign keys for elements are to other elements, so it's OK to do this without considering
-        #  joins first or concurrently.
-        foreign_keys = pd.read_csv(os.path.join(join_path,j,'foreign_keys.txt'),sep='\t')
-        for i,r in foreign_keys.iterrows():
-            fk_set = set(r['refers_to'].split(';'))  # lists all targets of the foreign key r['fieldname']
-            try:
-                j = [e for e in fk_set if e in joins_to_process].pop()
-                break
-            except IndexError:
-                pass
-        # create db table for element
-        create_table(metadata,id_seq,j,'joins',dirpath,eng,session)
-        # remove element from list of yet-to-be-processed
-        joins_to_process.remove(j)
+    for table in load_schema(dirpath)['tables']:
+        create_table(metadata,id_seq,table,eng,indexes=not defer_indexes,partitions=partitions)
 
     # push all tables to db
-    metadata.create_all()
-    session.flush()
+    with eng.begin() as conn:
+        metadata.create_all(bind=conn)
+        backend.after_create_tables(conn,list(metadata.tables.keys()))
+        for table, column in partitions.items():
+            backend.create_partition(conn,table,column,None)
     return metadata
 
 
-def create_table(metadata,id_seq,name,table_type,dirpath,engine,session):
-    t_path = os.path.join(dirpath,table_type,name)
-    if table_type == 'elements':
-        with open(os.path.join(t_path, 'short_name.txt'), 'r') as f:
-            short_name=f.read().strip()
-
-        # read info from files into dataframes
-        df = {}
-        for filename in ['enumerations','fields','foreign_keys','not_null_fields','unique_constraints']:
-            df[filename] = pd.read_csv(os.path.join(t_path,f'{filename}.txt'),sep='\t')
-
-        # define table
-        df['fields']['datatype'].replace({'Encoding':'String'},inplace=True)
-        field_col_list = [Column(r['fieldname'],eval(r['datatype'])) for i,r in df['fields'].iterrows()]
-        null_constraint_list = [
-            CheckConstraint(
-                f'"{r["not_null_fields"]}" IS NOT NULL',name=f'{short_name}_{r["not_null_fields"]}_not_null')
-            for i,r in df['not_null_fields'].iterrows()]
-        # omit 'foreign keys' that refer to more than one table,
-        #  e.g. Contest_Id to BallotMeasureContest and CandidateContest
-        foreign_key_list = [Column(r['fieldname'],ForeignKey(f'{r["refers_to"]}.Id'))
-                          for i,r in df['foreign_keys'].iterrows() if ';' not in r['refers_to']]
-        # unique constraints
-        df['unique_constraints']['arg_list'] = df['unique_constraints']['unique_constraint'].str.split(',')
-        unique_constraint_list = [UniqueConstraint(*r['arg_list'],name=f'{short_name}_ux{i}')
-                                  for i,r in df['unique_constraints'].iterrows()]
-        enum_id_list = [Column(f'{r["enumeration"]}_Id',ForeignKey(f'{r["enumeration"]}.Id'))
-                        for i,r in df['enumerations'].iterrows()]
-        enum_other_list = [Column(f'Other{r["enumeration"]}',String) for i,r in df['enumerations'].iterrows()]
-        Table(name,metadata,
-              Column('Id',Integer,id_seq,server_default=id_seq.next_value(),primary_key=True),
-              * field_col_list, * enum_id_list, * enum_other_list,
-              * foreign_key_list, * null_constraint_list, * unique_constraint_list)
-
-    elif table_type == 'enumerations':
-        if name == 'BallotMeasureSelection':
-            txt_col = 'Selection'
+# tables holding a datafile and what is loaded from it, whose foreign keys can be deferred to the end
+#  of the transaction (see db_routines.delete_datafile_rows)
+deferrable_tables = ['_datafile','VoteCount','ElectionContestSelectionVoteCountJoin']
+
+
+def create_table(metadata,id_seq,table,engine,indexes=True,partitions=None):
+    """Adds to <metadata> the table defined by <table>, a dictionary from the compiled schema,
+    with its secondary indexes if <indexes>. <partitions> is the dictionary of partitioned tables
+    (see partitioned_tables); if the backend partitions, the partition column is part of the primary key
+    of a partitioned table, and foreign keys to a partitioned table include the partition column.
+    The foreign keys of the deferrable_tables are DEFERRABLE INITIALLY IMMEDIATE."""
+    backend = dbb.for_engine(engine)
+    partitions = partitions if backend.partitioning and partitions else {}
+    name = table['name']
+    if table['table_type'] == 'enumerations':
+        Table(name,metadata,backend.id_column(id_seq),
+              Column(table['name_field'],String,unique=True))
+        return
+
+    short_name = table['short_name']
+    # omit 'foreign keys' that refer to more than one table,
+    #  e.g. Contest_Id to BallotMeasureContest and CandidateContest
+    refers_to = {fk['fieldname']:fk['refers_to'] for fk in table['foreign_keys']}
+    column_names = [c['fieldname'] for c in table['columns']]
+    col_list = []
+    fk_constraint_list = []
+    if name in deferrable_tables:
+        fk_kw = {'deferrable':True,'initially':'IMMEDIATE'}
+    else:
+        fk_kw = {}
+    for c in table['columns']:
+        f = c['fieldname']
+        key = {'primary_key':True} if partitions.get(name) == f else {}
+        targets = refers_to.get(f,[])
+        if len(targets) == 1 and partitions.get(targets[0]) in column_names:
+            # the referenced table is unique only on (Id, partition column)
+            col_list.append(Column(f,datatypes[c['datatype']],**key))
+            fk_constraint_list.append(ForeignKeyConstraint(
+                [f,partitions[targets[0]]],[f'{targets[0]}.Id',f'{targets[0]}.{partitions[targets[0]]}'],**fk_kw))
+        elif len(targets) == 1:
+            col_list.append(Column(f,datatypes[c['datatype']],ForeignKey(f'{targets[0]}.Id',**fk_kw),**key))
         else:
-            txt_col = 'Txt'
-        Table(name,metadata,Column('Id',Integer,id_seq,server_default=id_seq.next_value(),primary_key=True),
-              Column(txt_col,String,unique=True))
-    
-    elif table_type == 'joins':
-        with open(os.path.join(t_path, 'short_name.txt'), 'r') as f:
-            short_name=f.read().strip()
-        # read info from files into dataframes
-        
-        fk = pd.read_csv(os.path.join(t_path,'foreign_keys.txt'),sep='\t')
-
-        # define table
-        col_list = [Column(r['fieldname'],Integer) for i,r in fk.iterrows()]
-        null_constraint_list = [
-            CheckConstraint(
-                f'"{r["fieldname"]}" IS NOT NULL',name=f'{short_name}_{r["fieldname"]}_not_null')
-            for i,r in fk.iterrows()]
-        # omit 'foreign keys' that refer to more than one table,
-        #  e.g. Contest_Id to BallotMeasureContest and CandidateContest
-        true_foreign_key_list = [Column(r['fieldname'],ForeignKey(f'{r["refers_to"]}.Id'))
-                          for i,r in fk.iterrows() if ';' not in r['refers_to']]
-
-        Table(name,metadata,
-              Column('Id',Integer,id_seq,server_default=id_seq.next_value(),primary_key=True),
-              * col_list,
-              * true_foreign_key_list, * null_constraint_list)
+            col_list.append(Column(f,datatypes[c['datatype']],**key))
+    null_constraint_list = [
+        CheckConstraint(f'"{f}" IS NOT NULL',name=f'{short_name}_{f}_not_null') for f in table['not_null']]
+    unique_constraint_list = [
+        UniqueConstraint(*u,name=f'{short_name}_ux{i}') for i,u in enumerate(table['unique_constraints'])]
+    if indexes:
+        index_list = [Index(index_name,*cols) for index_name,cols in table_indexes(table)]
+    else:
+        index_list = []
+    if name in partitions.keys():
+        partition_kw = backend.partition_by(partitions[name])
     else:
-        raise Exception(f'table_type {table_type} not recognized')
+        partition_kw = {}
+    Table(name,metadata,
+          backend.id_column(id_seq),
+          * col_list, * fk_constraint_list, * null_constraint_list, * unique_constraint_list, * index_list,
+          ** partition_kw)
     return
 
 
+def partitioned_tables(dirpath='CDF_schema_def_info'):
+    """Returns a dictionary of the tables partitioned (where the backend allows) by the values of a column,
+    as given by partition_by.txt in the schema definition in <dirpath>: table -> column"""
+    return {t['name']:t['partition_by'] for t in load_schema(dirpath)['tables'] if t.get('partition_by')}
+
+
+def create_partitions(conn,dirpath,value):
+    """Creates, if the backend partitions and they do not yet exist, the partition of each partitioned
+    table for the partition column value <value>, e.g. for a datafile before its vote counts are loaded"""
+    backend = dbb.for_engine(conn.engine)
+    for table, column in partitioned_tables(dirpath).items():
+        backend.create_partition(conn,table,column,value)
+
+
+def table_indexes(table):
+    """Returns a list of (index name, list of columns) for the secondary indexes of <table>,
+    a dictionary from the compiled schema"""
+    return [(f'{table["short_name"]}_ix{i}',cols) for i,cols in enumerate(table.get('indexes',[]))]
+
+
+def create_indexes(session,dirpath='CDF_schema_def_info',tables=None):
+    """Creates any missing secondary indexes of the <tables> (default: all tables)
+    defined in the schema definition in <dirpath>"""
+    for table in load_schema(dirpath)['tables']:
+        if tables is None or table['name'] in tables:
+            for index_name,cols in table_indexes(table):
+                col_str = ','.join([f'"{c}"' for c in cols])
+                session.execute(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table["name"]}" ({col_str})')
+    session.commit()
+
+
+def drop_indexes(session,dirpath='CDF_schema_def_info',tables=None):
+    """Drops the secondary indexes of the <tables> (default: all tables) defined in the schema definition
+    in <dirpath>, e.g., before a bulk load"""
+    for table in load_schema(dirpath)['tables']:
+        if tables is None or table['name'] in tables:
+            for index_name,cols in table_indexes(table):
+                session.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+    session.commit()
+
+
+def load_schema(dirpath='CDF_schema_def_info'):
+    """Returns the schema defined by the files in <dirpath>, compiled by compile_schema.
+    The compiled schema is read from the file compiled_schema.json in <dirpath> if that is up to date
+    (i.e., was compiled from the present contents of the files); otherwise it is compiled in memory
+    (see save_compiled_schema to bring the file up to date). Either way this happens once per process:
+    later calls return the schema already loaded."""
+    key = os.path.abspath(dirpath)
+    if key in schemas.keys():
+        return schemas[key]
+
+    fingerprint = schema_fingerprint(dirpath)
+    compiled_file = os.path.join(dirpath,compiled_file_name)
+    schema = None
+    if os.path.isfile(compiled_file):
+        with open(compiled_file) as f:
+            schema = json.load(f)
+    if schema is None or schema.get('fingerprint') != fingerprint:
+        schema = compile_schema(dirpath)
+        schema['fingerprint'] = fingerprint
+    schemas[key] = schema
+    return schema
+
+
+def save_compiled_schema(dirpath='CDF_schema_def_info'):
+    """Compiles the schema definition in <dirpath> and saves it as compiled_schema.json there,
+    to be committed along with any change to the schema definition files"""
+    schema = compile_schema(dirpath)
+    schema['fingerprint'] = schema_fingerprint(dirpath)
+    with open(os.path.join(dirpath,compiled_file_name),'w') as f:
+        json.dump(schema,f,indent=1)
+    schemas[os.path.abspath(dirpath)] = schema
+
+
+def schema_fingerprint(dirpath):
+    """Hash of the names and contents of the schema definition files in <dirpath>"""
+    h = hashlib.sha256()
+    for sub_dir in ['enumerations','elements','joins']:
+        for root, dirs, files in sorted(os.walk(os.path.join(dirpath,sub_dir))):
+            for f in sorted(files):
+                if f[0] != '.':
+                    h.update(os.path.relpath(os.path.join(root,f),dirpath).encode())
+                    with open(os.path.join(root,f),'rb') as g:
+                        h.update(g.read())
+    return h.hexdigest()
+
+
+def compile_schema(dirpath='CDF_schema_def_info'):
+    """Reads the schema definition files in <dirpath> into a dictionary whose 'tables' entry lists
+    a dictionary for each table (enumerations, elements and joins), with its columns, foreign keys,
+    constraints, secondary indexes, partition column, enumerations, name field and, for enumerations, values. Tables come after every table
+    they refer to (and so can be created in the order listed, and dropped in the reverse order)."""
+    tables = {}
+    for e in enum_table_list(dirpath):
+        values = pd.read_csv(
+            os.path.join(dirpath,'enumerations',f'{e}.txt'),header=None,names=['value'],dtype=str).value
+        tables[e] = {
+            'name':e,'table_type':'enumerations','name_field':enum_name_field(e),'values':list(values)}
+
+    for table_type in ['elements','joins']:
+        t_path = os.path.join(dirpath,table_type)
+        for name in [f for f in os.listdir(t_path) if f[0] != '.']:
+            with open(os.path.join(t_path,name,'short_name.txt'),'r') as f:
+                short_name = f.read().strip()
+            fk = pd.read_csv(os.path.join(t_path,name,'foreign_keys.txt'),sep='\t')
+            foreign_keys = [
+                {'fieldname':r['fieldname'],'refers_to':r['refers_to'].split(';')} for i,r in fk.iterrows()]
+            index_file = os.path.join(t_path,name,'indexes.txt')
+            if os.path.isfile(index_file):
+                indexes = [i.split(',') for i in pd.read_csv(index_file,sep='\t')['index']]
+            else:
+                indexes = []
+            partition_file = os.path.join(t_path,name,'partition_by.txt')
+            if os.path.isfile(partition_file):
+                partition_by = pd.read_csv(partition_file,sep='\t')['partition_by'].iloc[0]
+            else:
+                partition_by = None
+            if table_type == 'joins':
+                tables[name] = {
+                    'name':name,'table_type':table_type,'short_name':short_name,
+                    'columns':[{'fieldname':r['fieldname'],'datatype':'Integer'} for i,r in fk.iterrows()],
+                    'enumerations':[],'foreign_keys':foreign_keys,'not_null':list(fk.fieldname),
+                    'unique_constraints':[],'indexes':indexes,'partition_by':partition_by,'name_field':None}
+                continue
+
+            df = {}
+            for filename in ['enumerations','fields','not_null_fields','unique_constraints']:
+                df[filename] = pd.read_csv(os.path.join(t_path,name,f'{filename}.txt'),sep='\t')
+            enumerations = list(df['enumerations'].enumeration)
+            fields = df['fields']
+            columns = [{'fieldname':r['fieldname'],'datatype':r['datatype']} for i,r in fields.iterrows()] + \
+                [{'fieldname':f'{e}_Id','datatype':'Integer'} for e in enumerations] + \
+                [{'fieldname':f'Other{e}','datatype':'String'} for e in enumerations] + \
+                [{'fieldname':fk['fieldname'],'datatype':'Integer'} for fk in foreign_keys]
+            if not fields.empty and fields.datatype.iloc[0] == 'String':
+                name_field = fields.fieldname.iloc[0]
+            else:
+                name_field = None
+            tables[name] = {
+                'name':name,'table_type':table_type,'short_name':short_name,'columns':columns,
+                'enumerations':enumerations,
+                'foreign_keys':foreign_keys + [{'fieldname':f'{e}_Id','refers_to':[e]} for e in enumerations],
+                'not_null':list(df['not_null_fields'].not_null_fields),
+                'unique_constraints':[u.split(',') for u in df['unique_constraints'].unique_constraint],
+                'indexes':indexes,'partition_by':partition_by,'name_field':name_field}
+
+    return {'tables':[tables[t] for t in dependency_order(tables)]}
+
+
+def dependency_order(tables):
+    """Returns the names of the tables in the dictionary <tables> (as in compile_schema) ordered so that
+    each comes after all the tables its foreign keys refer to; ties are broken by table type, then name"""
+    depends_on = {
+        t:{r for fk in d.get('foreign_keys',[]) for r in fk['refers_to'] if r != t} for t,d in tables.items()}
+    type_rank = {'enumerations':0,'elements':1,'joins':2}
+    ordered = []
+    while depends_on:
+        ready = sorted(
+            [t for t,deps in depends_on.items() if not deps - set(ordered)],
+            key=lambda t:(type_rank[tables[t]['table_type']],t))
+        if not ready:
+            raise Exception(f'Circular or missing foreign key references among {", ".join(sorted(depends_on))}')
+        ordered += ready
+        for t in ready:
+            depends_on.pop(t)
+    return ordered
+
+
+def enum_name_field(enum):
+    if enum == 'BallotMeasureSelection':
+        return 'Selection'
+    return 'Txt'
+
+
+def name_fields(dirpath='CDF_schema_def_info'):
+    """Returns a dictionary giving, for each enumeration and element, the field holding the plain-text
+    name of each record: for enumerations, the text field; for elements, the first field listed
+    in fields.txt, if it is a String"""
+    return {t['name']:t['name_field'] for t in load_schema(dirpath)['tables'] if t['name_field']}
+
+
 def enum_table_list(dirpath='CDF_schema_def_info'):
     enum_path = os.path.join(dirpath, 'enumerations')
     file_list = os.listdir(enum_path)
@@ -157,16 +303,13 @@ def enum_table_list(dirpath='CDF_schema_def_info'):
 
 def fill_cdf_enum_tables(session,schema,dirpath='CDF_schema_def_info'):
     """takes lines of text from file and inserts each line into the txt field of the enumeration table"""
-    e_table_list = enum_table_list(dirpath)
-    for f in e_table_list:
-        if f == 'BallotMeasureSelection':
-            txt_col='Selection'
-        else:
-            txt_col='Txt'
-        dframe = pd.read_csv(os.path.join(dirpath, 'enumerations', f + '.txt'), header=None, names=[txt_col])
-        dframe.to_sql(f,session.bind,schema=schema,if_exists='append',index=False)
+    from election_anomaly import db_routines as dbr
+    enums = [t for t in load_schema(dirpath)['tables'] if t['table_type'] == 'enumerations']
+    for t in enums:
+        dframe = pd.DataFrame({t['name_field']:t['values']})
+        dbr.append_to_table(dframe,session,t['name'],schema=schema)
     session.flush()
-    return e_table_list
+    return [t['name'] for t in enums]
 
 
 def reset_db(session, dirpath):
@@ -174,26 +317,7 @@ def reset_db(session, dirpath):
     Used if a DB is created for a user but not populated, for example."""
 
     eng = session.bind
-    conn = eng.connect()
-    conn.execute('DROP SEQUENCE IF EXISTS id_seq CASCADE;')
+    # drop tables before the tables they refer to
+    table_names = [t['name'] for t in reversed(load_schema(dirpath)['tables'])]
+    dbb.for_engine(eng).drop_tables(eng,table_names)
     session.commit()
-
-    # create enumeration tables 
-    e_table_list = enum_table_list(dirpath)
-    for table in e_table_list:
-        conn.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE;')
-        session.commit()
-    
-    element_path = os.path.join(dirpath, 'elements')
-    elements_to_process = [f for f in os.listdir(element_path) if f[0] != '.']
-    # dynamic list of elements whose tables haven't been created yet
-    for table in elements_to_process:
-        conn.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE;')
-        session.commit()
-
-    join_path = os.path.join(dirpath,'joins')
-    joins_to_process = [f for f in os.listdir(join_path) if f[0] != '.']
-    for table in joins_to_process:
-        conn.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE;')
-        session.commit()
-    conn.close()
\ No newline at end of file
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os.path
+import time
 
 from election_anomaly import db_routines
 from election_anomaly import db_routines as dbr
+from election_anomaly.db_routines import create_cdf_db as db_cdf
 import pandas as pd
 from election_anomaly import munge_routines as mr
 from election_anomaly import user_interface as ui
@@ -64,26 +68,35 @@ class Jurisdiction:
                 finished = True
         return changed
 
-    def load_juris_to_db(self,session,project_root):
-        """Load info from each element in the Jurisdiction's directory into the db"""
+    def load_juris_to_db(self,session,project_root,workers=1):
+        """Load info from each element in the Jurisdiction's directory into the db.
+        Elements whose files (and the files of the elements they refer to) are unchanged since
+        they were last loaded (see element_hashes) are skipped; the others are loaded once each,
+        in dependency order (see load_juris_elements), by <workers> threads at once.
+        The time taken for each element is kept in self.load_timings."""
         # for element in Jurisdiction directory (except dictionary, remark)
         juris_elements = [
             x[:-4] for x in os.listdir(self.path_to_juris_dir)
             if x != 'remark.txt' and x != 'dictionary.txt' and x[0] != '.']
-        # reorder juris_elements for efficiency
-        leading = ['ReportingUnit','Office','Party','CandidateContest']
-        trailing = ['ExternalIdentifier']
-        juris_elements = leading + [
-            x for x in juris_elements if x not in leading and x not in trailing
-        ] + trailing
+        # elements every jurisdiction needs, reported if their files are missing
+        juris_elements += [
+            x for x in ['ReportingUnit','Office','Party','CandidateContest','ExternalIdentifier'] if x not in juris_elements]
+        hashes = element_hashes(
+            self.path_to_juris_dir,juris_elements,os.path.join(project_root,'election_anomaly/CDF_schema_def_info'))
+        loaded = dbr.get_element_hashes(session,self.short_name)
+        # (an element without a file is 'loaded' too, to report the missing file)
+        to_load = [e for e in juris_elements if e not in hashes.keys() or loaded.get(e) != hashes[e]]
         error = {}
-        for element in juris_elements:
-            # read df from Jurisdiction directory
-            load_juris_dframe_into_cdf(session,element,self.path_to_juris_dir,project_root,error)
+        incomplete = set()
+        self.load_timings = load_juris_elements(
+            session,self.path_to_juris_dir,project_root,to_load,error,workers=workers,incomplete=incomplete)
         if error:
             for element in juris_elements:
                 dbr.truncate_table(session, element)
             return error
+        # elements with records the db refused are tried again next time
+        dbr.save_element_hashes(
+            session,self.short_name,{e:hashes[e] for e in to_load if e in hashes.keys() and e not in incomplete})
         return None
 
     def __init__(self,short_name,path_to_parent_dir):
@@ -93,6 +106,7 @@ class Jurisdiction:
         """
         self.short_name = short_name
         self.path_to_juris_dir = os.path.join(path_to_parent_dir, self.short_name)
+        self.load_timings = []
 
         remark_path = os.path.join(self.path_to_juris_dir,'remark.txt')
         if os.path.exists(remark_path):
@@ -623,14 +637,123 @@ def juris_dependency_dictionary():
 
 # TODO before processing jurisdiction files into db, alert user to any duplicate names.
 #  Enforce name change? Or just suggest?
-def load_juris_dframe_into_cdf(session,element,juris_path,project_root,error,load_refs=True):
-    """ TODO
-    """
+def element_hashes(juris_path,elements,cdf_schema_def_dir):
+    """Returns a dictionary of element -> hash for each of the <elements> with a file in <juris_path>.
+    The hash covers the contents of the element's file and the hashes of the elements it refers to,
+    so it changes when anything the element's records depend on changes"""
+    file_hashes = {}
+    for element in elements:
+        element_fpath = os.path.join(juris_path,f'{element}.txt')
+        if os.path.isfile(element_fpath):
+            file_hashes[element] = ui.file_hash(element_fpath)
+
+    hashes = {}
+
+    def element_hash(element,seen):
+        if element not in hashes.keys():
+            h = hashlib.sha256(file_hashes[element].encode())
+            fk_file_path = os.path.join(cdf_schema_def_dir,'elements',element,'foreign_keys.txt')
+            if os.path.isfile(fk_file_path):
+                refs = set(';'.join(pd.read_csv(fk_file_path,sep='\t')['refers_to']).split(';'))
+                for r in sorted(refs):
+                    # (enumerations and the like have no file in the jurisdiction)
+                    if r in file_hashes.keys() and r not in seen:
+                        h.update(element_hash(r,seen | {element}).encode())
+            hashes[element] = h.hexdigest()
+        return hashes[element]
+
+    for element in file_hashes.keys():
+        element_hash(element,set())
+    return hashes
+
+
+def juris_load_order(elements,cdf_schema_def_dir):
+    """Returns the <elements> ordered so that each comes after every element it refers to, as given by
+    the foreign_keys.txt files in <cdf_schema_def_dir> (including references to any of several elements,
+    e.g., ExternalIdentifier's Foreign_Id). Elements not in the schema definition come last."""
+    schema_order = [t['name'] for t in db_cdf.load_schema(cdf_schema_def_dir)['tables']]
+    return [e for e in schema_order if e in elements] + [e for e in elements if e not in schema_order]
+
+
+def juris_load_levels(elements,cdf_schema_def_dir):
+    """Returns the <elements> as a list of dependency levels (lists of elements): the elements in each level
+    refer only to elements in earlier levels (or not among the <elements>), so can be loaded together"""
+    refers_to = {
+        t['name']:{r for fk in t.get('foreign_keys',[]) for r in fk['refers_to'] if r != t['name']}
+        for t in db_cdf.load_schema(cdf_schema_def_dir)['tables']}
+    level = {}
+    for element in juris_load_order(elements,cdf_schema_def_dir):
+        level[element] = 1 + max([level[r] for r in refers_to.get(element,[]) if r in level.keys()],default=-1)
+    return [[e for e in level.keys() if level[e] == i] for i in range(max(level.values(),default=-1) + 1)]
+
+
+def load_juris_elements(session,juris_path,project_root,elements,error,workers=1,incomplete=None):
+    """Loads each of the <elements> of the jurisdiction in <juris_path> into the db exactly once,
+    in dependency order (see juris_load_levels). Foreign keys are resolved against a map of name -> Id
+    for each element referred to, built from the rows just loaded (or, for an element not being loaded,
+    read once from the db). Problems are recorded in the dictionary <error>, and elements some of whose
+    records the db refused (see dframe_to_sql) are added to the set <incomplete>, if given.
+    If <workers> is more than 1, the element files are read in a pool of that many threads, and the
+    elements of each dependency level (see juris_load_levels) are written to the db at the same time,
+    each over its own pooled connection.
+    Returns a list with a dictionary for each element of its dependency level ('level') and the time
+    (in seconds) taken reading the file ('read') and resolving ids and writing to the db ('write')."""
+    name_ids = {}
     cdf_schema_def_dir = os.path.join(project_root,'election_anomaly/CDF_schema_def_info')
+    timings = {}
+
+    def read(element):
+        start = time.perf_counter()
+        df = read_juris_element(element,juris_path,cdf_schema_def_dir,error)
+        timings[element] = {'element':element,'read':time.perf_counter() - start}
+        return df
+
+    def write(s,element,df):
+        start = time.perf_counter()
+        if df is not None:
+            load_juris_dframe_into_cdf(
+                s,element,juris_path,project_root,error,load_refs=False,name_ids=name_ids,df=df,
+                incomplete=incomplete)
+        timings[element]['write'] = time.perf_counter() - start
+
+    levels = juris_load_levels(elements,cdf_schema_def_dir)
+    if workers is None or workers <= 1:
+        for i, level in enumerate(levels):
+            for element in level:
+                write(session,element,read(element))
+                timings[element]['level'] = i
+        return list(timings.values())
+
+    def write_in_own_session(element,df):
+        s = Session()
+        try:
+            write(s,element,df)
+        finally:
+            s.close()
+
+    from sqlalchemy.orm import sessionmaker
+    Session = sessionmaker(bind=session.bind)
+    # so that the other connections see everything done so far
+    session.commit()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        read_futures = {e:pool.submit(read,e) for level in levels for e in level}
+        for i, level in enumerate(levels):
+            write_futures = [pool.submit(write_in_own_session,e,read_futures[e].result()) for e in level]
+            for f in write_futures:
+                f.result()
+            for e in level:
+                timings[e]['level'] = i
+    return list(timings.values())
+
+
+def read_juris_element(element,juris_path,cdf_schema_def_dir,error):
+    """Reads the file for <element> in <juris_path> into a dataframe ready for loading (with a
+    'none or unknown' record and without duplicates), recording problems in the dictionary <error>.
+    Returns None if there is no file."""
     element_fpath = os.path.join(juris_path,f'{element}.txt')
     if not os.path.exists(element_fpath):
         error[f'{element}.txt'] = "file not found"
-        return
+        return None
     df = pd.read_csv(element_fpath,sep='\t',encoding='iso-8859-1') \
         .fillna('none or unknown')
     # TODO check that df has the right format
@@ -664,16 +787,32 @@ def load_juris_dframe_into_cdf(session,element,juris_path,project_root,error,loa
     # replace nulls with empty strings
     df.fillna('',inplace=True)
 
+    return df
+
+
+def load_juris_dframe_into_cdf(
+        session,element,juris_path,project_root,error,load_refs=True,name_ids=None,df=None,incomplete=None):
+    """Loads the records of <element> from its file in <juris_path> (or, if given, from <df>, as read by
+    read_juris_element) into the db, recording problems in the dictionary <error>. If <load_refs>,
+    elements referred to by records not yet in the db are loaded first. If <name_ids> (see load_juris_elements)
+    is given, foreign keys are resolved against it, and the names and Ids of <element> are added to it.
+    If the db refuses the records, <element> is added to the set <incomplete>, if given.
+    """
+    cdf_schema_def_dir = os.path.join(project_root,'election_anomaly/CDF_schema_def_info')
+    if df is None:
+        df = read_juris_element(element,juris_path,cdf_schema_def_dir,error)
+        if df is None:
+            return
+
     # replace plain text enumerations from file system with id/othertext from db
     enum_file = os.path.join(cdf_schema_def_dir,'elements',element,'enumerations.txt')
     if os.path.isfile(enum_file):  # (if not, there are no enums for this element)
         enums = pd.read_csv(enum_file,sep='\t')
-        # get all relevant enumeration tables
+        registry = mr.get_enum_registry(session.bind)
         for e in enums['enumeration']:  # e.g., e = "ReportingUnitType"
-            cdf_e = pd.read_sql_table(e,session.bind)
             # for every instance of the enumeration in the current table, add id and othertype columns to the dataframe
             if e in df.columns:
-                df = mr.enum_col_to_id_othertext(df,e,cdf_e)
+                df = registry.col_to_id_othertext(df,e)
         # TODO skipping assignment of CountItemStatus to ReportingUnit for now,
         #  since we can't assign an ReportingUnit as ElectionDistrict to Office
         #  (unless Office has a CountItemStatus; can't be right!)
@@ -686,80 +825,107 @@ def load_juris_dframe_into_cdf(session,element,juris_path,project_root,error,loa
     fk_file_path = os.path.join(
             cdf_schema_def_dir,'elements',element,'foreign_keys.txt')
     if os.path.isfile(fk_file_path):
-        foreign_keys = pd.read_csv(fk_file_path,sep='\t',index_col='fieldname')
+        fk_df = pd.read_csv(fk_file_path,sep='\t',index_col='fieldname')
+        foreign_keys = {fn:fk_df.loc[fn,'refers_to'].split(';') for fn in fk_df.index}
 
-        for fn in foreign_keys.index:
-            refs = foreign_keys.loc[fn,'refers_to'].split(';')
-
-            try:
-                df = get_ids_for_foreign_keys(session,df,element,fn,refs,load_refs,error)
-            except ForeignKeyException as e:
+        try:
+            df, missing = get_ids_for_foreign_keys(session,df,element,foreign_keys,name_ids=name_ids)
+        except Exception as e:
+            if not element in error:
+                error[element] = {}
+            error[element]["jurisdiction"] = \
+                f"""{e}\nThere may be something wrong with the file {element}.txt.
+                You may need to make changes to the Jurisdiction directory and try again."""
+        else:
+            if not missing.empty:
+                missing_fks = list(missing['foreign_key'].unique())
                 if load_refs:
-                    for r in refs:
-                        load_juris_dframe_into_cdf(session,r,juris_path,project_root,error)
+                    for r in dict.fromkeys([r for fn in missing_fks for r in foreign_keys[fn]]):
+                        load_juris_dframe_into_cdf(
+                            session,r,juris_path,project_root,error,incomplete=incomplete)
                     # try again to load main element (but don't load referred-to again)
-                    load_juris_dframe_into_cdf(session,element,juris_path,project_root,error,load_refs=False)
-            except Exception as e:
+                    load_juris_dframe_into_cdf(
+                        session,element,juris_path,project_root,error,load_refs=False,name_ids=name_ids,
+                        incomplete=incomplete)
+                    return
                 if not element in error:
                     error[element] = {}
-                error[element]["jurisdiction"] = \
-                    f"""{e}\nThere may be something wrong with the file {element}.txt.
-                    You may need to make changes to the Jurisdiction directory and try again."""
+                error[element]["foreign_key"] = \
+                    f"For some {element} records, {', '.join(fn[:-3] for fn in missing_fks)} was not found:\n" \
+                    f"{missing.to_string(index=False)}"
 
     # commit info in df to corresponding cdf table to db
     data, err = dbr.dframe_to_sql(df,session,element)
+    if err and 'integrity' in err.keys():
+        # as before, the load carries on without the refused records
+        print(f'WARNING: {element} records not loaded: {err.pop("integrity")}')
+        if incomplete is not None:
+            incomplete.add(element)
     if err:
         if not element in error:
             error[element] = {}
         error[element]["database"] = err
+    name_field = dbr.get_name_field(element)
+    if name_ids is not None and name_field in data.columns:
+        # data holds all the element's rows in the db, including those just loaded
+        ids = data['Id'] if 'Id' in data.columns else data.index
+        name_ids[element] = dict(zip(data[name_field],ids))
     return
 
 
-def get_ids_for_foreign_keys(session,df1,element,foreign_key,refs,load_refs,error):
-    """ TODO <fn> is foreign key"""
+def get_ids_for_foreign_keys(session,df1,element,foreign_keys,name_ids=None):
+    """Adds to <df1> the Ids for each of its <foreign_keys> (a dictionary of fieldname, e.g. 'Party_Id',
+    -> list of the elements referred to), looked up by the names in the corresponding column (e.g. 'Party';
+    for ExternalIdentifier, 'internal_name', in the element given in 'cdf_element').
+    Only the names in <df1> are read from the db, in one query per element referred to for all the
+    <foreign_keys> together, and only those not already in <name_ids> (a dictionary of element ->
+    dictionary of name -> Id, e.g. as kept by load_juris_elements), to which they are added.
+    Returns the dataframe and a dataframe of the references not found, with columns foreign_key,
+    refers_to, name and records (the number of records with that name)."""
     df = df1.copy()
-    # append the Id corresponding to <fn> from the db
-    foreign_elt = f'{foreign_key[:-3]}'
-    interim = f'{foreign_elt}_Name'
-
-    target_list = []
-    for r in refs:
-        ref_name_field = db_routines.get_name_field(r)
+    if name_ids is None:
+        name_ids = {}
 
-        r_target = pd.read_sql_table(r,session.bind)[['Id',ref_name_field]]
-        r_target.rename(columns={'Id':foreign_key,ref_name_field:interim},inplace=True)
+    def name_col(fk):
         if element == 'ExternalIdentifier':
-            # add column for cdf_table of referent
-            r_target.loc[:,'cdf_element'] = r
-
-        target_list.append(r_target)
-
-    target = pd.concat(target_list)
-
-    if element == 'ExternalIdentifier':
-        # join on cdf_element name as well
-        df = df.merge(
-            target,how='left',left_on=['cdf_element','internal_name'],right_on=['cdf_element',interim])
-        # rename 'Foreign_Id' to 'Foreign' for consistency in definition of missing
-        # TODO why is ExternalIdentifier special in this regard?
-        #  Is it that ExternalIdentifier doesn't have a name field?
-        df.rename(columns={foreign_key:foreign_elt},inplace=True)
-    else:
-        df = df.merge(target,how='left',left_on=foreign_elt,right_on=interim)
+            return 'internal_name'
+        return fk[:-3]
 
-    missing = df[(df[foreign_elt].notnull()) & (df[interim].isnull())]
-    if missing.empty:
-        df.drop([interim],axis=1)
+    def names_in(fk,r):
+        names = df[name_col(fk)]
+        if element == 'ExternalIdentifier':
+            names = names[df['cdf_element'] == r]
+        return names.dropna()
+
+    # collect the names needed from each element, then read each element's at once
+    needed = {}
+    for fk, refs in foreign_keys.items():
+        for r in refs:
+            needed.setdefault(r,[]).extend(names_in(fk,r).unique())
+    for r, names in needed.items():
+        dbr.read_name_ids(session,r,names,name_ids.setdefault(r,{}))
+
+    missing = []
+    for fk, refs in foreign_keys.items():
+        names = df[name_col(fk)]
+        ids = pd.Series(np.nan,index=df.index)
+        for r in refs:
+            r_ids = names.map(name_ids[r])
+            if element == 'ExternalIdentifier':
+                r_ids = r_ids.where(df['cdf_element'] == r)
+            # the first element referred to with the name wins
+            ids = ids.fillna(r_ids)
+        df[fk] = ids
+        not_found = names.notnull() & ids.isnull()
+        if not_found.any():
+            refers_to = df.loc[not_found,'cdf_element'] if element == 'ExternalIdentifier' else ';'.join(refs)
+            missing.append(pd.DataFrame({'foreign_key':fk,'refers_to':refers_to,'name':names[not_found]}))
+    if missing:
+        missing = pd.concat(missing).groupby(
+            ['foreign_key','refers_to','name']).size().reset_index(name='records')
     else:
-        if load_refs:
-            # Always try to handle/fill in the missing IDs
-            raise ForeignKeyException(f'For some {element} records, {foreign_elt} was not found')
-        else:
-            if not element in error:
-                error[element] = {}
-            error[element]["foreign_key"] = \
-            f"For some {element} records, {foreign_elt} was not found"
-    return df
+        missing = pd.DataFrame(columns=['foreign_key','refers_to','name','records'])
+    return df, missing
 
 
 def check_element_against_raw_results(el,results_df,munger,numerical_columns,d):
@@ -160,24 +160,121 @@ def replace_raw_with_internal_ids(
     return row_df
 
 
+class EnumRegistry:
+    """Id <-> plaintext maps for the enumerations (e.g., CountItemType) in the database behind the engine <eng>,
+    each read from the database once. Use get_enum_registry(eng) rather than creating an EnumRegistry directly."""
+    def __init__(self,eng):
+        self.eng = eng
+        self.to_id = {}  # enumeration -> {plaintext:id}
+        self.from_id = {}  # enumeration -> {id:plaintext}
+
+    def maps(self,enum):
+        """Returns the pair of dictionaries {plaintext:id} and {id:plaintext} for <enum>"""
+        if enum not in self.to_id.keys():
+            txt_col = dbr.get_name_field(enum)
+            enum_df = pd.read_sql(f'SELECT "Id", "{txt_col}" FROM "{enum}"',self.eng)
+            self.to_id[enum] = dict(zip(enum_df[txt_col],enum_df['Id']))
+            self.from_id[enum] = dict(zip(enum_df['Id'],enum_df[txt_col]))
+        return self.to_id[enum], self.from_id[enum]
+
+    def table(self,enum):
+        """Returns the enumeration table <enum> as a dataframe (as pd.read_sql_table would)"""
+        from_id = self.maps(enum)[1]
+        return pd.DataFrame({'Id':list(from_id.keys()),dbr.get_name_field(enum):list(from_id.values())})
+
+    def is_enumeration(self,table):
+        return table in dbr.get_cdf_db_table_names(self.eng)[1]
+
+    def col_from_id_othertext(self,df,enum,drop_old=True):
+        return enum_col_from_id_othertext(df,enum,self.maps(enum)[1],drop_old=drop_old)
+
+    def col_to_id_othertext(self,df,type_col,drop_old=True):
+        return enum_col_to_id_othertext(df,type_col,self.maps(type_col)[0],drop_old=drop_old)
+
+    def value_from_id_othertext(self,enum,idx,othertext):
+        return plaintext_from_id_othertext(pd.Series([idx]),pd.Series([othertext]),self.maps(enum)[1])[0]
+
+    def value_to_id_othertext(self,enum,value):
+        ids, othertext = id_othertext_from_plaintext(pd.Series([value]),self.maps(enum)[0])
+        return ids[0], othertext[0]
+
+    def refresh(self,enum=None):
+        """Forget the maps for <enum> (or for all enumerations), e.g., after the database is recreated"""
+        if enum is None:
+            self.to_id = {}
+            self.from_id = {}
+        else:
+            self.to_id.pop(enum,None)
+            self.from_id.pop(enum,None)
+
+
+# one EnumRegistry per engine
+enum_registries = {}
+
+
+def get_enum_registry(eng):
+    if eng not in enum_registries.keys():
+        enum_registries[eng] = EnumRegistry(eng)
+    return enum_registries[eng]
+
+
+def map_col(col,mapping):
+    """Returns the series <col> mapped through the dictionary <mapping> (NaN where there is no match),
+    looking up each distinct value of <col> only once"""
+    cat = col.astype('category')
+    mapped = dict(enumerate(cat.cat.categories.map(mapping.get)))
+    return cat.cat.codes.map(mapped)
+
+
+def plaintext_from_id_othertext(ids,othertext,from_id):
+    """Returns the series of plaintext values for the series <ids> and <othertext> (e.g., a
+    CountItemType_Id and an OtherCountItemType column), using the dictionary <from_id>
+    of the enumeration. Where the id is that of 'other', the othertext (if any) is used instead."""
+    plaintext = map_col(ids,from_id)
+    use_other = (plaintext == 'other') & othertext.notnull() & (othertext != '')
+    return plaintext.mask(use_other,othertext)
+
+
+def id_othertext_from_plaintext(plaintext,to_id):
+    """Returns a pair of series (ids, othertexts) for the series of plaintext values <plaintext>,
+    using the dictionary <to_id> of the enumeration. Values not in the enumeration get the id of 'other'
+    (if the enumeration has one) with the value itself as othertext; other values get an empty othertext."""
+    ids = map_col(plaintext,to_id)
+    othertext = pd.Series('',index=plaintext.index)
+    if 'other' in to_id.keys():
+        unmatched = ids.isnull()
+        othertext = othertext.mask(unmatched,plaintext)
+        ids = ids.fillna(to_id['other'])
+    if not ids.isnull().any():
+        ids = ids.astype('int64')
+    return ids, othertext
+
+
+def enum_dict(enum_df,direction='from_id'):
+    """Given an enumeration dframe (with cols 'Id' and 'Txt', or index and column 'Txt'), returns the
+    dictionary {id:plaintext} (or, if <direction> is 'to_id', {plaintext:id})"""
+    if isinstance(enum_df,dict):
+        return enum_df
+    if 'Id' in enum_df.columns:
+        enum_df = enum_df.set_index('Id')
+    if direction == 'to_id':
+        return dict(zip(enum_df['Txt'],enum_df.index))
+    return dict(zip(enum_df.index,enum_df['Txt']))
+
+
 def enum_col_from_id_othertext(df,enum,enum_df,drop_old=True):
     """Returns a copy of dataframe <df>, replacing id and othertext columns
     (e.g., 'CountItemType_Id' and 'OtherCountItemType)
     with a plaintext <type> column (e.g., 'CountItemType')
-        using the enumeration given in <enum_df>"""
+        using the enumeration given in <enum_df> (a dataframe, or a dictionary {id:plaintext}).
+    Rows whose id is not in the enumeration are dropped."""
     assert f'{enum}_Id' in df.columns,f'Dataframe lacks {enum}_Id column'
     assert f'Other{enum}' in df.columns,f'Dataframe lacks Other{enum} column'
-    assert 'Txt' in enum_df.columns,'Enumeration dataframe should have column \'Txt\''
-
-    # ensure Id is in the index of enum_df (otherwise df index will be lost in merge)
-    if 'Id' in enum_df.columns:
-        enum_df = enum_df.set_index('Id')
-
-    df = df.merge(enum_df,left_on=f'{enum}_Id',right_index=True)
+    from_id = enum_dict(enum_df)
 
-    # if Txt value is 'other', use Other{enum} value instead
-    df['Txt'].mask(df['Txt']!='other', other=df[f'Other{enum}'])
-    df.rename(columns={'Txt':enum},inplace=True)
+    df = df[df[f'{enum}_Id'].isin(from_id.keys())].copy()
+    # if the plaintext is 'other', use Other{enum} value instead
+    df[enum] = plaintext_from_id_othertext(df[f'{enum}_Id'],df[f'Other{enum}'],from_id)
     if drop_old:
         df.drop([f'{enum}_Id',f'Other{enum}'],axis=1,inplace=True)
     return df
@@ -186,38 +283,15 @@ def enum_col_from_id_othertext(df,enum,enum_df,drop_old=True):
 def enum_col_to_id_othertext(df,type_col,enum_df,drop_old=True):
     """Returns a copy of dataframe <df>, replacing a plaintext <type_col> column (e.g., 'CountItemType') with
     the corresponding two id and othertext columns (e.g., 'CountItemType_Id' and 'OtherCountItemType
-    using the enumeration given in <enum_df>"""
+    using the enumeration given in <enum_df> (a dataframe, or a dictionary {plaintext:id})"""
+    df = df.copy()
     if df.empty:
         # add two columns
         df[f'{type_col}_Id'] = df[f'Other{type_col}'] = df.iloc[:,0]
     else:
         assert type_col in df.columns
-        assert 'Txt' in enum_df.columns,'Enumeration dataframe should have a \'Txt\' column'
-
-        # ensure Id is a column, not the index, of enum_df (otherwise df index will be lost in merge)
-        if 'Id' not in enum_df.columns:
-            enum_df['Id'] = enum_df.index
-
-        for c in ['Id','Txt']:
-            if c in df.columns:
-                # avoid conflict by temporarily renaming the column in the main dataframe
-                assert c*3 not in df.colums, 'Column name '+c*3+' conflicts with variable used in code'
-                df.rename(columns={c:c*3},inplace=True)
-        df = df.merge(enum_df,how='left',left_on=type_col,right_on='Txt')
-        df.rename(columns={'Id':f'{type_col}_Id'},inplace=True)
-        df.loc[:,f'Other{type_col}']=''
-
-        other_id_df = enum_df[enum_df['Txt']=='other']
-        if not other_id_df.empty:
-            other_id = other_id_df.iloc[0]['Id']
-            df[f'{type_col}_Id'] = df[f'{type_col}_Id'].fillna(other_id)
-            df.loc[
-                df[f'{type_col}_Id'] == other_id,'Other'+type_col] = df.loc[df[f'{type_col}_Id'] == other_id,type_col]
-        df = df.drop(['Txt'],axis=1)
-        for c in ['Id','Txt']:
-            if c*3 in df.columns:
-                # avoid restore name renaming the column in the main dataframe
-                df.rename(columns={c*3:c},inplace=True)
+        df[f'{type_col}_Id'], df[f'Other{type_col}'] = id_othertext_from_plaintext(
+            df[type_col],enum_dict(enum_df,direction='to_id'))
     if drop_old:
         df = df.drop([type_col],axis=1)
     return df
@@ -276,23 +350,21 @@ def enum_plaintext_dict_from_db_record(session,element,db_record):
     """Return a dictionary of <enum>:<plaintext> for all enumerations in
     <db_record>, which is itself a dictionary of <field>:<value>"""
     enum_plaintext_dict = {}
-    element_df_columns = pd.read_sql_table(element,session.bind,index_col='Id').columns
-    # TODO INEFFICIENT don't need all of element_df; just need columns
+    element_df_columns = dbr.get_catalog(session.bind).table_columns(element)
     # identify enumerations by existence of `<enum>Other` field
     enum_list = [x[5:] for x in element_df_columns if x[:5] == 'Other']
+    registry = get_enum_registry(session.bind)
     for e in enum_list:
-        enum_df = pd.read_sql_table(e,session.bind)
-        enum_plaintext_dict[e] = enum_value_from_id_othertext(enum_df,db_record[f'{e}_Id'],db_record[f'Other{e}'])
+        enum_plaintext_dict[e] = registry.value_from_id_othertext(e,db_record[f'{e}_Id'],db_record[f'Other{e}'])
     return enum_plaintext_dict
 
 
 def db_record_from_file_record(session,element,file_record):
     db_record = file_record.copy()
     enum_list = dbr.get_enumerations(session,element)
+    registry = get_enum_registry(session.bind)
     for e in enum_list:
-        enum_df = pd.read_sql_table(e,session.bind)
-        db_record[f'{e}_Id'],db_record[f'Other{e}'] = \
-            enum_value_to_id_othertext(enum_df,db_record[e])
+        db_record[f'{e}_Id'],db_record[f'Other{e}'] = registry.value_to_id_othertext(e,db_record[e])
         db_record.pop(e)
     fk_df = dbr.get_foreign_key_df(session,element)
     for fk in fk_df.index:
@@ -415,9 +487,13 @@ def raw_elements_to_cdf(session,project_root,juris,mu,raw,count_cols,ids=None):
     # get ids for remaining info sourced from rows and columns
     element_list = [t for t in mu.cdf_elements[mu.cdf_elements.source != 'other'].index if
                     (t[-7:] != 'Contest' and t[-9:] != 'Selection')]
+    registry = get_enum_registry(session.bind)
     for t in element_list:
         # capture id from db in new column and erase any now-redundant cols
-        df = pd.read_sql_table(t,session.bind)
+        if registry.is_enumeration(t):
+            df = registry.table(t)
+        else:
+            df = pd.read_sql_table(t,session.bind)
         name_field = dbr.get_name_field(t)
         # set drop_unmatched = True for fields necessary to BallotMeasure rows,
         #  drop_unmatched = False otherwise to prevent losing BallotMeasureContests for BM-inessential fields
@@ -430,7 +506,7 @@ def raw_elements_to_cdf(session,project_root,juris,mu,raw,count_cols,ids=None):
         # working = add_non_id_cols_from_id(working,df,t)
 
     # append BallotMeasureSelection_Id, drop BallotMeasureSelection
-    df_selection = pd.read_sql_table(f'BallotMeasureSelection',session.bind)
+    df_selection = registry.table('BallotMeasureSelection')
     working = replace_raw_with_internal_ids(
         working,juris,df_selection,'BallotMeasureSelection',dbr.get_name_field('BallotMeasureSelection'),
         mu.path_to_munger_dir,
@@ -470,17 +546,25 @@ def raw_elements_to_cdf(session,project_root,juris,mu,raw,count_cols,ids=None):
     working = append_multi_foreign_key(working,ref_d)
 
     # add extra columns to VoteCount table temporarily to allow proper join
-    extra_cols = ['ElectionContestJoin_Id','ContestSelectionJoin_Id','_datafile_Id']
+    extra_cols = ['ElectionContestJoin_Id','ContestSelectionJoin_Id']
     dbr.add_integer_cols(session,'VoteCount',extra_cols)
-
-    # upload to VoteCount table, pull  Ids
-    working_fat, err = dbr.dframe_to_sql(working,session,'VoteCount',raw_to_votecount=True)
-    working_fat.rename(columns={'Id':'VoteCount_Id'},inplace=True)
-    session.commit()
-
-    # TODO check that all candidates in munged contests (including write ins!) are munged
-    # upload to ElectionContestSelectionVoteCountJoin
-    data, err = dbr.dframe_to_sql(working_fat,session,'ElectionContestSelectionVoteCountJoin')
+    datafile_ids = list(working['_datafile_Id'].unique())
+    for datafile_id in datafile_ids:
+        dbr.create_datafile_partitions(session,datafile_id)
+
+    # on the first load, build the indexes of the vote count tables after loading, not row by row
+    with dbr.indexes_deferred(session,['VoteCount','ElectionContestSelectionVoteCountJoin']):
+        # upload to VoteCount table, pull  Ids
+        # compare only with the vote counts already loaded from this datafile
+        working_fat, err = dbr.dframe_to_sql(
+            working,session,'VoteCount',raw_to_votecount=True,restrict={'_datafile_Id':datafile_ids})
+        working_fat.rename(columns={'Id':'VoteCount_Id'},inplace=True)
+        session.commit()
+
+        # TODO check that all candidates in munged contests (including write ins!) are munged
+        # upload to ElectionContestSelectionVoteCountJoin
+        data, err = dbr.dframe_to_sql(
+            working_fat,session,'ElectionContestSelectionVoteCountJoin',restrict={'_datafile_Id':datafile_ids})
 
     # drop extra columns
     dbr.drop_cols(session,'VoteCount',extra_cols)
@@ -0,0 +1,192 @@
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+# CountItemTypes a synthetic results file may use, with the raw labels used in the file.
+#  Must be values of the CDF CountItemType enumeration, since dictionary.txt maps raw labels to those.
+count_item_type_labels = {
+    'election-day':'Election Day','absentee-mail':'Absentee by Mail','early':'Early Voting',
+    'provisional':'Provisional','absentee-in-person':'Absentee in Person','uocava':'UOCAVA',
+    'absentee-fwab':'FWAB','absentee':'Absentee Other','write-in':'Write-in Ballots'}
+
+party_labels = {
+    'Democratic Party':'DEM','Republican Party':'REP','Libertarian Party':'LIB','Green Party':'GRN'}
+
+
+def create_synthetic(
+        project_root,juris_name='Synthetic',n_counties=100,wards_per_county=10,precincts_per_ward=100,
+        n_congressional=10,n_statewide=3,n_ballot_measures=2,candidates_per_contest=3,n_count_item_types=4,
+        n_results_files=1,election='2018 General',seed=0):
+    """Writes a consistent synthetic jurisdiction to <project_root>/jurisdictions/<juris_name>,
+    a munger for its results to <project_root>/mungers/<juris_name> (lower case)
+    and <n_results_files> results files (split by county) to <project_root>/results/<juris_name>.
+    The state has <n_counties> counties, each with <wards_per_county> wards,
+    each with <precincts_per_ward> precincts (so the defaults give 100,000 precincts).
+    Contests: <n_statewide> statewide, one per congressional district (<n_congressional> districts,
+    each a block of consecutive counties), one per county, and <n_ballot_measures> statewide ballot measures.
+    Counts are given for <n_count_item_types> CountItemTypes (at most len(count_item_type_labels)).
+    The same <seed> always produces the same files.
+    Returns a dictionary with the paths to the jurisdiction, the munger and the list of results files."""
+    if n_count_item_types > len(count_item_type_labels):
+        raise Exception(f'At most {len(count_item_type_labels)} CountItemTypes are available')
+    rng = np.random.default_rng(seed)
+    state = juris_name
+    juris_dir = os.path.join(project_root,'jurisdictions',juris_name)
+    munger_dir = os.path.join(project_root,'mungers',juris_name.lower())
+    results_dir = os.path.join(project_root,'results',juris_name)
+    for d in [juris_dir,munger_dir,results_dir]:
+        Path(d).mkdir(parents=True,exist_ok=True)
+
+    # reporting units, with raw names as they appear in the results file
+    county = np.repeat(np.arange(n_counties),wards_per_county*precincts_per_ward)
+    ward = np.tile(np.repeat(np.arange(wards_per_county),precincts_per_ward),n_counties)
+    precinct = np.tile(np.arange(precincts_per_ward),n_counties*wards_per_county)
+    precincts = pd.DataFrame({
+        'County':[f'County {c}' for c in county],
+        'Ward':[f'Ward {w}' for w in ward],
+        'Precinct':[f'Precinct {p}' for p in precinct],
+        'county_number':county})
+    precincts['raw'] = precincts.County + ';' + precincts.Ward + ';' + precincts.Precinct
+    precincts['Name'] = state + ';' + precincts.raw
+    counties = [f'{state};County {c}' for c in range(n_counties)]
+    wards = sorted(set(state + ';' + precincts.County + ';' + precincts.Ward))
+    cd_of_county = np.arange(n_counties)*n_congressional//n_counties
+    districts = [f'{state};Congressional District {k + 1}' for k in range(n_congressional)]
+    ru = pd.concat([
+        pd.DataFrame({'Name':[state],'ReportingUnitType':'state'}),
+        pd.DataFrame({'Name':districts,'ReportingUnitType':'congressional'}),
+        pd.DataFrame({'Name':counties,'ReportingUnitType':'county'}),
+        pd.DataFrame({'Name':wards,'ReportingUnitType':'ward'}),
+        pd.DataFrame({'Name':precincts.Name,'ReportingUnitType':'precinct'})])
+
+    # contests: (internal name, raw name, district, kind, counties covered)
+    contests = []
+    for k in range(n_statewide):
+        contests.append((f'{state};Statewide Office {k + 1}',f'STATEWIDE OFFICE {k + 1}',state,'Candidate',None))
+    for k in range(n_congressional):
+        contests.append((
+            f'{districts[k]}',f'CONGRESS DISTRICT {k + 1}',districts[k],'Candidate',np.flatnonzero(cd_of_county == k)))
+    for c in range(n_counties):
+        contests.append((f'{counties[c]};Commissioner',f'COUNTY {c} COMMISSIONER',counties[c],'Candidate',[c]))
+    for k in range(n_ballot_measures):
+        contests.append((f'{state};Question {k + 1}',f'QUESTION {k + 1}',state,'BallotMeasure',None))
+
+    parties = list(party_labels.keys())
+    candidate_rows = []
+    selection_rows = []  # (contest index, raw choice, raw party)
+    for i, (name, raw, district, kind, covered) in enumerate(contests):
+        if kind == 'Candidate':
+            for j in range(candidates_per_contest):
+                party = parties[j % len(parties)]
+                candidate_rows.append((f'Candidate {i}-{j + 1}',party,f'CANDIDATE {i}-{j + 1}'))
+                selection_rows.append((i,f'CANDIDATE {i}-{j + 1}',party_labels[party]))
+        else:
+            for choice in ['YES','NO']:
+                selection_rows.append((i,choice,''))
+    candidate_contests = [c for c in contests if c[3] == 'Candidate']
+    candidate_df = pd.DataFrame(candidate_rows,columns=['BallotName','Party','raw'])
+
+    # jurisdiction files
+    write_tab(juris_dir,'ReportingUnit',ru)
+    write_tab(juris_dir,'Party',pd.DataFrame({'Name':parties}))
+    write_tab(juris_dir,'Office',pd.DataFrame({
+        'Name':[c[0] for c in candidate_contests],'ElectionDistrict':[c[2] for c in candidate_contests]}))
+    write_tab(juris_dir,'CandidateContest',pd.DataFrame({
+        'Name':[c[0] for c in candidate_contests],'VotesAllowed':1,'NumberElected':1,'NumberRunoff':0,
+        'IsPartisan':'TRUE','Office':[c[0] for c in candidate_contests],'PrimaryParty':''}))
+    write_tab(juris_dir,'Candidate',candidate_df[['BallotName','Party']])
+    write_tab(juris_dir,'BallotMeasureContest',pd.DataFrame({
+        'Name':[c[0] for c in contests if c[3] == 'BallotMeasure'],
+        'ElectionDistrict':[c[2] for c in contests if c[3] == 'BallotMeasure'],'Election':election}))
+    write_tab(juris_dir,'Election',pd.DataFrame({
+        'Name':[election],'EndDate':['2018-11-06'],'StartDate':['2018-11-06'],'ElectionType':['general']}))
+    write_tab(juris_dir,'ExternalIdentifier',pd.DataFrame(
+        columns=['cdf_element','internal_name','external_name','IdentifierType']))
+    cits = list(count_item_type_labels.keys())[:n_count_item_types]
+    dictionary = pd.concat([
+        pd.DataFrame({'cdf_element':'ReportingUnit','cdf_internal_name':precincts.Name,
+            'raw_identifier_value':precincts.raw}),
+        pd.DataFrame({'cdf_element':'Party','cdf_internal_name':parties,
+            'raw_identifier_value':[party_labels[p] for p in parties]}),
+        pd.DataFrame({'cdf_element':[f'{c[3]}Contest' for c in contests],'cdf_internal_name':[c[0] for c in contests],
+            'raw_identifier_value':[c[1] for c in contests]}),
+        pd.DataFrame({'cdf_element':'Candidate','cdf_internal_name':candidate_df.BallotName,
+            'raw_identifier_value':candidate_df.raw}),
+        pd.DataFrame({'cdf_element':'BallotMeasureSelection','cdf_internal_name':['Yes','No'],
+            'raw_identifier_value':['YES','NO']}),
+        pd.DataFrame({'cdf_element':'CountItemType','cdf_internal_name':cits,
+            'raw_identifier_value':[count_item_type_labels[c] for c in cits]})])
+    write_tab(juris_dir,'dictionary',dictionary)
+    with open(os.path.join(juris_dir,'remark.txt'),'w') as f:
+        f.write(f'Synthetic jurisdiction generated with seed {seed}. Not real election results.\n')
+
+    # munger
+    write_tab(munger_dir,'cdf_elements',pd.DataFrame([
+        ['ReportingUnit','<County>;<Ward>;<Precinct>','row'],
+        ['Election','','other'],
+        ['Party','<Party>','row'],
+        ['CandidateContest','<Contest>','row'],
+        ['Candidate','<Choice>','row'],
+        ['BallotMeasureContest','<Contest>','row'],
+        ['BallotMeasureSelection','<Choice>','row'],
+        ['CountItemType','<0>','column']],columns=['name','raw_identifier_formula','source']))
+    info_cols = ['County','Ward','Precinct','Contest','Choice','Party']
+    write_tab(munger_dir,'format',pd.DataFrame([
+        ['header_row_count','1'],
+        ['field_name_row','0'],
+        ['count_columns',','.join(str(len(info_cols) + k) for k in range(len(cits)))],
+        ['file_type','txt'],
+        ['encoding','iso-8859-1'],
+        ['thousands_separator','None']],columns=['item','value']))
+
+    # results: one row per (precinct, selection), for every contest covering the precinct
+    selections = pd.DataFrame(selection_rows,columns=['contest','Choice','Party'])
+    selections['Contest'] = [contests[i][1] for i in selections.contest]
+    rows = []
+    for i, (name, raw, district, kind, covered) in enumerate(contests):
+        if covered is None:
+            p_idx = np.arange(len(precincts))
+        else:
+            p_idx = np.flatnonzero(np.isin(precincts.county_number.values,covered))
+        sel = selections[selections.contest == i]
+        n_sel = len(sel)
+        # statewide support for each selection, shifted county by county
+        base = rng.dirichlet(np.full(n_sel,5.0))
+        county_shift = rng.normal(0,0.3,(n_counties,n_sel))
+        logits = np.log(base) + county_shift[precincts.county_number.values[p_idx]] \
+            + rng.normal(0,0.15,(len(p_idx),n_sel))
+        shares = np.exp(logits)
+        shares /= shares.sum(axis=1,keepdims=True)
+        turnout = rng.lognormal(6,0.5,len(p_idx)).astype(int)
+        votes = rng.binomial(turnout[:,None],shares)
+        # split each selection's votes across CountItemTypes
+        cit_shares = rng.dirichlet(np.full(len(cits),3.0),len(p_idx))
+        block = pd.DataFrame({
+            'County':np.repeat(precincts.County.values[p_idx],n_sel),
+            'Ward':np.repeat(precincts.Ward.values[p_idx],n_sel),
+            'Precinct':np.repeat(precincts.Precinct.values[p_idx],n_sel),
+            'Contest':raw,
+            'Choice':np.tile(sel.Choice.values,len(p_idx)),
+            'Party':np.tile(sel.Party.values,len(p_idx)),
+            'county_number':np.repeat(precincts.county_number.values[p_idx],n_sel)})
+        by_cit = rng.multinomial(votes.reshape(-1),np.repeat(cit_shares,n_sel,axis=0))
+        for k, c in enumerate(cits):
+            block[count_item_type_labels[c]] = by_cit[:,k]
+        rows.append(block)
+    results = pd.concat(rows,ignore_index=True)
+
+    results_files = []
+    file_of_county = np.arange(n_counties)*n_results_files//n_counties
+    for k in range(n_results_files):
+        f_path = os.path.join(results_dir,f'{juris_name.lower()}_results_{k + 1}.txt')
+        part = results[file_of_county[results.county_number.values] == k].drop(columns='county_number')
+        part.to_csv(f_path,sep='\t',index=False,encoding='iso-8859-1')
+        results_files.append(f_path)
+
+    return {'jurisdiction':juris_dir,'munger':munger_dir,'results_files':results_files}
+
+
+def write_tab(dir_path,element,df):
+    df.to_csv(os.path.join(dir_path,f'{element}.txt'),sep='\t',index=False,encoding='iso-8859-1')
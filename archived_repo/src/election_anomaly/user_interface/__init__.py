@@ -13,9 +13,9 @@ from pathlib import Path
 import ntpath
 import re
 import datetime
+import hashlib
 from election_anomaly import juris_and_munger as sf
 import random
-from tkinter import filedialog
 from configparser import MissingSectionHeaderError
 
 
@@ -105,6 +105,8 @@ def pick_path(initialdir='~/',mode='file'):
 		fpath = input(
 			f'Enter path to {mode} (or hit return to use pop-up window to find it).\n').strip()
 		if not fpath:
+			# tkinter (and a display) are needed only for the pop-up window
+			from tkinter import filedialog
 			print(f'Use pop-up window to pick your {mode}.')
 			if mode == 'file':
 				fpath = filedialog.askopenfilename(
@@ -299,39 +301,87 @@ def pick_or_create_record(sess,project_root,element,known_info_d=None):
 	return db_idx, db_style_record, enum_plaintext_dict, fk_plaintext_dict
 
 
-def pick_record_from_db(sess,element,known_info_d=None,required=False,db_idx=None):
+def pick_one_from_pages(get_page,return_col,item='row',required=False,page_size=40):
+	"""Returns index and <return_col> value of item chosen by user, as pick_one does, but
+	the choices are fetched a page at a time: <get_page>(name_prefix,offset,limit) returns a dataframe.
+	The user may also ask for the next or previous page, or for only the choices whose name
+	starts with a given text"""
+	offset = 0
+	prefix = None
+	while True:
+		page = get_page(prefix,offset,page_size + 1)
+		has_next = page.shape[0] > page_size
+		page = page.iloc[:page_size]
+		if page.empty and prefix:
+			print(f'No {item} name starts with {prefix}.')
+			offset, prefix = 0, None
+			continue
+		elif page.empty:
+			return None, None
+		df = page.copy()
+		df.index = range(page.shape[0])
+		with pd.option_context('display.max_rows',page_size,'display.max_columns',None):
+			print(df)
+
+		options = []
+		if has_next:
+			options.append('> for the next page')
+		if offset > 0:
+			options.append('< for the previous page')
+		options.append('/ followed by the first letters of the name to search by name')
+		if not required:
+			options.append('nothing, if your choice is not on the list')
+		choice_str = input(f'Enter the number of the desired {item} (or {", ".join(options)}):\n')
+		if choice_str == '' and not required:
+			return None, None
+		elif choice_str == '>' and has_next:
+			offset += page_size
+		elif choice_str == '<' and offset > 0:
+			offset = max(0,offset - page_size)
+		elif choice_str[:1] == '/':
+			offset, prefix = 0, choice_str[1:] or None
+		else:
+			try:
+				choice = int(choice_str)
+			except ValueError:
+				choice = -1
+			if choice in df.index:
+				print(f'Chosen {item} is {df.loc[choice,return_col]}\n\n')
+				return page.index[choice], df.loc[choice,return_col]
+			print(f'Enter an option from the leftmost column (or one of the other options). Please try again.')
+
+
+def pick_record_from_db(sess,element,known_info_d=None,required=False,db_idx=None,page_size=40):
 	"""Get id and info from database, if it exists.
-	If <db_idx> is passed, return that index and a dictionary with the rest of the record"""
+	If <db_idx> is passed, return that index and a dictionary with the rest of the record.
+	Otherwise the user picks from the records matching <known_info_d>, fetched from the
+	database <page_size> at a time"""
 	if not known_info_d:
 		known_info_d = {}
 
-	element_df = pd.read_sql_table(element,sess.bind,index_col='Id')
-	if element_df.empty:
+	if db_idx:
+		d = dbr.record_by_id(sess,element,db_idx)
+		if d is None:
+			return None,None
+		return db_idx, d
+	if dbr.query_records(sess,element,limit=1).empty:
 		return None,None
-	elif db_idx:
-		return db_idx, element_df.loc[db_idx].to_dict()
-
-	# add columns for plaintext of any enumerations
-	# FIXME also add columns for foreign key plaintext
-	enums = dbr.read_enums_from_db_table(sess,element)
-	element_enhanced_df = element_df.copy()
-	for e in enums:
-		e_df = pd.read_sql_table(e,sess.bind,index_col='Id')
-		element_enhanced_df = mr.enum_col_from_id_othertext(element_enhanced_df,e,e_df,drop_old=False)
 
 	# filter by known_info_d
-	d = {k:v for k,v in known_info_d.items() if k in element_enhanced_df.columns}
-	filtered = element_enhanced_df.loc[(element_enhanced_df[list(d)] == pd.Series(d)).all(axis=1)]
-	# TODO if filtered is empty, offer all
-	if filtered.empty:
+	# FIXME also add columns for foreign key plaintext
+	filters = known_info_d
+	if dbr.query_records(sess,element,filters=filters,limit=1).empty:
 		print('Nothing meets the filter criteria. Unfiltered options will be offered.')
-		filtered = element_enhanced_df
+		filters = None
 
 	print(f'Pick the {element} record from the database:')
 	name_field = db_routines.get_name_field(element)
-	element_idx, values = pick_one(filtered,name_field,element)
-	if element_idx in element_df.index:
-		d = dict(element_df.loc[element_idx])
+	element_idx, values = pick_one_from_pages(
+		lambda prefix,offset,limit:dbr.query_records(
+			sess,element,filters=filters,name_prefix=prefix,limit=limit,offset=offset),
+		name_field,element,page_size=page_size)
+	if element_idx is not None:
+		d = dbr.record_by_id(sess,element,element_idx)
 	else:
 		d = None
 	if required and element_idx is None:
@@ -353,7 +403,7 @@ def pick_record_from_db(sess,element,known_info_d=None,required=False,db_idx=Non
 
 
 def pick_enum(sess,e):
-	e_df = pd.read_sql_table(e,sess.bind,index_col='Id')
+	e_df = mr.get_enum_registry(sess.bind).table(e).set_index('Id')
 	e_idx,e_plaintext = pick_one(e_df,'Txt',item=e,required=True)
 	if e_plaintext == 'other':
 		# get plaintext from user
@@ -458,7 +508,7 @@ def get_record_info_from_user(sess,element,known_info_d={},mode='database'):
 	# get enumeration tables from db
 	e_df = {}
 	for e in enum_list:
-		e_df[e] = pd.read_sql_table(e,sess.bind,index_col='Id')
+		e_df[e] = mr.get_enum_registry(sess.bind).table(e).set_index('Id')
 
 	# add cols to all_from_db for showing user and update show_user_cols
 	for e in enum_list:
@@ -601,10 +651,20 @@ def read_datafile(munger,f_path):
 		return pd.DataFrame()
 
 
-def new_datafile(session,munger,raw_path,project_root=None,juris=None,results_info=None):
+def file_hash(f_path,block_size=2**20):
+	"""Returns the sha256 hex digest of the contents of the file at <f_path>"""
+	h = hashlib.sha256()
+	with open(f_path,'rb') as f:
+		for block in iter(lambda: f.read(block_size),b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def new_datafile(session,munger,raw_path,project_root=None,juris=None,results_info=None,load_juris=True):
 	"""Guide user through process of uploading data in <raw_file>
 	into common data format.
-	Assumes cdf db exists already"""
+	Assumes cdf db exists already.
+	If <load_juris> is False, the jurisdiction is assumed to be in the db already."""
 	if not project_root:
 		get_project_root()
 	if not juris:
@@ -631,7 +691,8 @@ def new_datafile(session,munger,raw_path,project_root=None,juris=None,results_in
 	# check jurisdiction against raw results file, adapting jurisdiction files as necessary
 	# TODO: incorporate juris.check_against_raw_results(raw,munger,count_columns_by_name)
 	# if jurisdction changed, load to db
-	juris.load_juris_to_db(session,project_root)
+	if load_juris:
+		juris.load_juris_to_db(session,project_root)
 
 	try:
 		mr.raw_elements_to_cdf(session,project_root,juris,munger,raw,count_columns_by_name,results_info)
@@ -640,6 +701,10 @@ def new_datafile(session,munger,raw_path,project_root=None,juris=None,results_in
 			'Please check compatibilty between the two and try again.')
 		return
 
+	if results_info:
+		# rollups calculated before this load are out of date
+		from election_anomaly import analyze_via_pandas as avp
+		avp.rollup_cache.invalidate(results_info[1])
 	print(f'Datafile contents uploaded to database {session.bind.engine}')
 	return
 